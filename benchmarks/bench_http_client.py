@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Per-call latency: shared pooled client vs. a new client per call.
+
+Compares the current call_openrouter (one long-lived httpx.AsyncClient) with
+the previous behaviour of opening and closing a client on every request,
+using the local OpenRouter stub.
+
+Usage:
+    python benchmarks/bench_http_client.py --calls 200
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+
+import httpx
+
+import sonar_mcp_server as server
+from openrouter_stub import running_stub
+
+MESSAGES = [{"role": "user", "content": "latest developments in quantum computing"}]
+
+
+async def per_call_client(url: str) -> None:
+    """The pre-pooling request path: a fresh client per call."""
+    async with httpx.AsyncClient(timeout=server.REQUEST_TIMEOUT) as client:
+        response = await client.post(url, json={
+            "model": server.DEFAULT_SEARCH_MODEL,
+            "messages": MESSAGES,
+            "max_tokens": 1000,
+            "temperature": 0.2
+        })
+        response.raise_for_status()
+        response.json()
+
+
+async def shared_client() -> None:
+    """The current request path through call_openrouter."""
+    await server.call_openrouter(MESSAGES, server.DEFAULT_SEARCH_MODEL, 1000)
+
+
+async def measure(label: str, call, calls: int) -> None:
+    samples = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        await call()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(
+        f"{label:<16} mean {statistics.fmean(samples):7.2f} ms  "
+        f"p50 {statistics.median(samples):7.2f} ms  p95 {p95:7.2f} ms"
+    )
+
+
+async def main(calls: int, latency: float) -> None:
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    async with running_stub(latency=latency) as url:
+        server.OPENROUTER_API_URL = url
+        await measure("per-call client", lambda: per_call_client(url), calls)
+        await measure("shared client", shared_client, calls)
+        await server.close_http_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared vs per-call HTTP client latency")
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0, help="stub latency in seconds")
+    args = parser.parse_args()
+    asyncio.run(main(args.calls, args.latency))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Near-duplicate query index: insert and lookup cost at scale.
+
+Fills the MinHash LSH index behind SONAR_SIMILAR_CACHE with synthetic
+search queries, then times lookups of rephrased queries (expected hits)
+and unrelated queries (expected misses), and reports the index's memory.
+
+Usage:
+    python benchmarks/bench_near_duplicate.py --entries 100000
+"""
+
+import argparse
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sonar_mcp_server import NearDuplicateIndex
+
+FILLER = ["latest", "news", "how", "does", "the", "best", "compare", "what", "is", "2024", "guide"]
+# Interchangeable wordings of the filler words; stop words may be dropped
+REWORDINGS = {
+    "latest": ["newest", "recent", "current"],
+    "news": ["updates", "developments"],
+    "best": ["top"],
+    "compare": ["versus", "comparison"],
+    "how": [], "does": [], "the": [], "what": [], "is": []
+}
+
+
+def make_vocabulary(size: int, rng: random.Random) -> list:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(4, 10))) for _ in range(size)]
+
+
+def make_query(vocabulary: list, rng: random.Random) -> list:
+    return rng.sample(vocabulary, rng.randint(4, 7)) + rng.sample(FILLER, 2)
+
+
+def rephrase(words: list, rng: random.Random) -> str:
+    """Reword, reorder and re-case a query; its significant terms stay the same."""
+    words = [rng.choice(REWORDINGS[w] or [""]) if w in REWORDINGS else w for w in words]
+    words = [w for w in words if w] + rng.sample(["tell me", "please", "the", "about"], 2)
+    rng.shuffle(words)
+    return " ".join(words).upper() if rng.random() < 0.3 else " ".join(words)
+
+
+def timed_lookups(index: NearDuplicateIndex, queries: list) -> tuple:
+    samples, found = [], 0
+    for query in queries:
+        start = time.perf_counter()
+        found += index.lookup("search", query) is not None
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return samples, found
+
+
+def report(label: str, samples: list, found: int) -> None:
+    print(
+        f"{label:<8} p50 {statistics.median(samples):7.1f} us  "
+        f"p99 {samples[int(len(samples) * 0.99) - 1]:7.1f} us  "
+        f"max {samples[-1]:8.1f} us  matched {found}/{len(samples)}"
+    )
+
+
+def main(entries: int, lookups: int, seed: int) -> None:
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(20000, rng)
+    stored = [make_query(vocabulary, rng) for _ in range(entries)]
+    
+    texts = [" ".join(words) for words in stored]
+    keys = [f"key-{n}" for n in range(entries)]
+    
+    index = NearDuplicateIndex(max_entries=entries)
+    start = time.perf_counter()
+    for text, key in zip(texts, keys):
+        index.add("search", text, key)
+    elapsed = time.perf_counter() - start
+    
+    # Build a second copy under tracemalloc, which would distort the timing
+    tracemalloc.start()
+    traced = NearDuplicateIndex(max_entries=entries)
+    for text, key in zip(texts, keys):
+        traced.add("search", text, key)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del traced
+    print(
+        f"indexed {entries} queries in {elapsed:.2f} s "
+        f"({elapsed / entries * 1e6:.1f} us/insert), index memory {memory / 2**20:.1f} MiB"
+    )
+    
+    hits = [rephrase(rng.choice(stored), rng) for _ in range(lookups)]
+    misses = [" ".join(make_query(vocabulary, rng)) for _ in range(lookups)]
+    report("hits", *timed_lookups(index, hits))
+    report("misses", *timed_lookups(index, misses))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--lookups", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    main(args.entries, args.lookups, args.seed)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Load test for the MCP tools against the local OpenRouter stub.
+
+Starts the stub in a separate process, connects an in-memory MCP client
+session to the server and drives sonar_search, sonar_ask, sonar_research and
+sonar_reason at each requested concurrency level. For every tool and level it
+reports throughput, p50/p95/p99 latency, errors, peak RSS and CPU time per
+request, and writes the results as JSON so runs can be compared between
+commits.
+
+CPU and memory are measured for this process, which holds the server and the
+in-memory MCP client; the stub's cost is excluded. Queries are unique per
+request unless --distinct-queries is set, so the response cache only helps
+when asked to. The client-side rate limit is disabled unless overridden with
+--env SONAR_RATE_LIMIT_RPS=...
+
+Usage:
+    python benchmarks/load_test.py --concurrency 1,8,32 --requests 200 \\
+        --latency 0.05 --distribution lognormal --jitter 0.5 --output before.json
+    python benchmarks/load_test.py --concurrency 1,8,32 --compare before.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+from openrouter_stub import DISTRIBUTIONS, free_port
+
+TOOLS = ("sonar_search", "sonar_ask", "sonar_research", "sonar_reason")
+
+
+def tool_arguments(tool: str, query: str) -> Dict[str, Any]:
+    """Arguments for one call of a tool."""
+    if tool == "sonar_search":
+        params = {"query": query, "depth": "quick"}
+    elif tool == "sonar_ask":
+        params = {"question": f"What is known about {query}?"}
+    elif tool == "sonar_research":
+        params = {"topic": query, "max_tokens": 2000}
+    else:
+        params = {"problem": f"Compare the main approaches to {query}"}
+    return {"params": params}
+
+
+def percentile(sorted_samples: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_samples:
+        return 0.0
+    rank = max(1, int(round(fraction * len(sorted_samples) + 0.5)))
+    return sorted_samples[min(rank, len(sorted_samples)) - 1]
+
+
+def peak_rss_mb() -> float:
+    """Process RSS high-water mark in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def git_revision() -> Optional[str]:
+    """Current commit of the working tree, if available."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def start_stub(args: argparse.Namespace) -> "tuple[asyncio.subprocess.Process, str]":
+    """Launch the stub process and wait until it accepts connections."""
+    port = free_port()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, str(BENCH_DIR / "openrouter_stub.py"),
+        "--port", str(port),
+        "--latency", str(args.latency),
+        "--distribution", args.distribution,
+        "--jitter", str(args.jitter),
+        "--response-chars", str(args.response_chars),
+        "--chunk-delay", str(args.chunk_delay),
+        "--rate-limit-rate", str(args.rate_limit_rate),
+        "--error-rate", str(args.error_rate),
+        "--retry-after", str(args.retry_after),
+        "--seed", str(args.seed)
+    )
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return process, f"http://127.0.0.1:{port}/chat/completions"
+        except OSError:
+            await asyncio.sleep(0.05)
+    process.kill()
+    raise RuntimeError("OpenRouter stub did not start")
+
+
+async def run_level(
+    session: Any,
+    tool: str,
+    concurrency: int,
+    requests: int,
+    queries: "itertools.count[int]",
+    distinct: int
+) -> Dict[str, Any]:
+    """Issue `requests` calls of one tool with `concurrency` callers."""
+    remaining = requests
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+
+    async def caller() -> None:
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            n = next(queries)
+            query = f"load test topic {n % distinct if distinct else n}"
+            started = time.perf_counter()
+            try:
+                result = await session.call_tool(tool, tool_arguments(tool, query))
+                if result.isError:
+                    text = result.content[0].text if result.content else "error"
+                    kind = text.split(":", 2)[1].strip() if text.count(":") >= 2 else text[:60]
+                    errors[kind] = errors.get(kind, 0) + 1
+                    continue
+            except Exception as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    await asyncio.gather(*(caller() for _ in range(concurrency)))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    latencies.sort()
+    to_ms = lambda seconds: round(seconds * 1000, 2)
+    return {
+        "tool": tool,
+        "concurrency": concurrency,
+        "requests": requests,
+        "ok": len(latencies),
+        "errors": sum(errors.values()),
+        "error_types": errors,
+        "duration_s": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        "latency_ms": {
+            "p50": to_ms(percentile(latencies, 0.50)),
+            "p95": to_ms(percentile(latencies, 0.95)),
+            "p99": to_ms(percentile(latencies, 0.99)),
+            "mean": to_ms(sum(latencies) / len(latencies)) if latencies else 0.0,
+            "max": to_ms(latencies[-1]) if latencies else 0.0
+        },
+        "cpu_ms_per_request": round(cpu * 1000 / requests, 3),
+        "peak_rss_mb": round(peak_rss_mb(), 1)
+    }
+
+
+def print_table(results: List[Dict[str, Any]], baseline: Optional[Dict[str, Any]]) -> None:
+    """Human-readable summary on stderr, with deltas against a baseline run."""
+    previous = {
+        (r["tool"], r["concurrency"]): r for r in (baseline or {}).get("results", [])
+    }
+    header = (
+        f"{'tool':<16}{'conc':>5}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}"
+        f"{'p99 ms':>10}{'err':>6}{'cpu ms':>9}{'rss MB':>9}"
+    )
+    print(header, file=sys.stderr)
+    for r in results:
+        line = (
+            f"{r['tool']:<16}{r['concurrency']:>5}{r['throughput_rps']:>10.1f}"
+            f"{r['latency_ms']['p50']:>10.1f}{r['latency_ms']['p95']:>10.1f}"
+            f"{r['latency_ms']['p99']:>10.1f}{r['errors']:>6}"
+            f"{r['cpu_ms_per_request']:>9.2f}{r['peak_rss_mb']:>9.1f}"
+        )
+        before = previous.get((r["tool"], r["concurrency"]))
+        if before and before["throughput_rps"] and before["latency_ms"]["p95"]:
+            rps = (r["throughput_rps"] / before["throughput_rps"] - 1) * 100
+            p95 = (r["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1) * 100
+            line += f"   rps {rps:+.1f}%  p95 {p95:+.1f}%"
+        print(line, file=sys.stderr)
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    stub, url = await start_stub(args)
+    # Configure the server before importing it; it reads settings at import
+    os.environ["OPENROUTER_API_URL"] = url
+    os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+    os.environ.setdefault("SONAR_RATE_LIMIT_RPS", "0")
+    for item in args.env:
+        key, _, value = item.partition("=")
+        os.environ[key] = value
+
+    import sonar_mcp_server as server
+    from mcp.shared.memory import create_connected_server_and_client_session
+
+    tools = [t.strip() for t in args.tools.split(",") if t.strip()]
+    levels = [int(c) for c in args.concurrency.split(",")]
+    queries = itertools.count()
+    results = []
+    try:
+        async with create_connected_server_and_client_session(server.mcp._mcp_server) as session:
+            for tool in tools:
+                await run_level(session, tool, 1, args.warmup, queries, args.distinct_queries)
+                for concurrency in levels:
+                    results.append(await run_level(
+                        session, tool, concurrency, args.requests, queries, args.distinct_queries
+                    ))
+    finally:
+        stub.terminate()
+        await stub.wait()
+
+    return {
+        "meta": {
+            "timestamp": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "stub": {
+                "latency": args.latency,
+                "distribution": args.distribution,
+                "jitter": args.jitter,
+                "response_chars": args.response_chars,
+                "chunk_delay": args.chunk_delay,
+                "rate_limit_rate": args.rate_limit_rate,
+                "error_rate": args.error_rate,
+                "seed": args.seed
+            },
+            "requests_per_level": args.requests,
+            "distinct_queries": args.distinct_queries,
+            "env": {k: v for k, v in os.environ.items() if k.startswith("SONAR_")}
+        },
+        "results": results
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tools", default=",".join(TOOLS), help="Comma-separated tool names")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated levels")
+    parser.add_argument("--requests", type=int, default=100, help="Calls per tool and level")
+    parser.add_argument("--warmup", type=int, default=5, help="Unmeasured calls per tool")
+    parser.add_argument("--distinct-queries", type=int, default=0,
+                        help="Cycle through this many queries (0: every query unique)")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS, default="fixed")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--response-chars", type=int, default=2000)
+    parser.add_argument("--chunk-delay", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Server setting applied before import (repeatable)")
+    parser.add_argument("--output", help="Write JSON results here instead of stdout")
+    parser.add_argument("--compare", help="Baseline JSON from an earlier run")
+    args = parser.parse_args()
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("mcp").setLevel(logging.WARNING)
+    report = asyncio.run(main(args))
+    baseline = json.loads(Path(args.compare).read_text()) if args.compare else None
+    print_table(report["results"], baseline)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2) + "\n")
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Local OpenRouter stub for benchmarks.
+
+Serves a minimal OpenAI-compatible /chat/completions endpoint so the server
+can be exercised without network access or API spend. Point the server at it
+with OPENROUTER_API_URL=http://127.0.0.1:<port>/chat/completions.
+
+Latency can be fixed or drawn from a distribution, and a fraction of requests
+can be answered with 429 (with Retry-After) or 5xx to exercise the retry and
+rate-limit paths.
+
+Run standalone:
+    python benchmarks/openrouter_stub.py --port 8765 --latency 0.05
+    python benchmarks/openrouter_stub.py --latency 0.2 --distribution lognormal \\
+        --jitter 0.5 --rate-limit-rate 0.02 --error-rate 0.01
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import socket
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Optional
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+
+def latency_sampler(
+    latency: float,
+    distribution: str = "fixed",
+    jitter: float = 0.0,
+    rng: Optional[random.Random] = None
+) -> Callable[[], float]:
+    """
+    Build a function returning one simulated upstream latency per call.
+    
+    Args:
+        latency: Mean latency in seconds (median for lognormal)
+        distribution: One of DISTRIBUTIONS
+        jitter: Spread; +/- fraction of latency for uniform, sigma for lognormal
+        rng: Random source, seeded for reproducible runs
+        
+    Returns:
+        Zero-argument function returning seconds
+    """
+    rng = rng or random.Random()
+    if latency <= 0 or distribution == "fixed":
+        return lambda: max(0.0, latency)
+    if distribution == "uniform":
+        return lambda: rng.uniform(latency * (1 - jitter), latency * (1 + jitter))
+    if distribution == "exponential":
+        return lambda: rng.expovariate(1 / latency)
+    if distribution == "lognormal":
+        return lambda: rng.lognormvariate(math.log(latency), jitter)
+    raise ValueError(f"Unknown latency distribution '{distribution}'")
+
+
+def create_app(
+    latency: float = 0.0,
+    response_chars: int = 1000,
+    chunk_chars: int = 40,
+    chunk_delay: float = 0.0,
+    citations: int = 3,
+    distribution: str = "fixed",
+    jitter: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    error_rate: float = 0.0,
+    error_status: int = 503,
+    retry_after: float = 1.0,
+    seed: Optional[int] = None
+) -> Starlette:
+    """
+    Build the stub application.
+    
+    Args:
+        latency: Seconds to wait before answering (before the first chunk when streaming)
+        response_chars: Length of the generated completion text (capped at max_tokens * 4)
+        chunk_chars: Characters per SSE chunk for streaming requests
+        chunk_delay: Seconds between SSE chunks
+        citations: Number of source URLs returned with each answer
+        distribution: Latency distribution, one of DISTRIBUTIONS
+        jitter: Latency spread (see latency_sampler)
+        rate_limit_rate: Fraction of requests answered with 429
+        error_rate: Fraction of requests answered with error_status
+        error_status: Status code used for injected server errors
+        retry_after: Retry-After seconds sent with injected 429s
+        seed: Seed for latency and fault injection
+        
+    Returns:
+        Starlette application
+    """
+    rng = random.Random(seed)
+    sample_latency = latency_sampler(latency, distribution, jitter, rng)
+    
+    async def chat_completions(request: Request):
+        payload = await request.json()
+        delay = sample_latency()
+        if delay:
+            await asyncio.sleep(delay)
+        roll = rng.random()
+        if roll < rate_limit_rate:
+            return JSONResponse(
+                {"error": {"code": 429, "message": "Rate limit exceeded (stub)"}},
+                status_code=429, headers={"Retry-After": f"{retry_after:g}"}
+            )
+        if roll < rate_limit_rate + error_rate:
+            return JSONResponse(
+                {"error": {"code": error_status, "message": "Injected upstream error (stub)"}},
+                status_code=error_status
+            )
+        size = min(response_chars, payload.get("max_tokens", response_chars) * 4)
+        text = ("lorem ipsum " * (size // 12 + 1))[:size]
+        prompt = payload["messages"][-1].get("content", "")
+        sources = [
+            f"https://example.com/{(len(prompt) + n) % 7}" for n in range(citations)
+        ]
+        if sources:
+            text += " " + "".join(f"[{n}]" for n in range(1, citations + 1))
+        completion_tokens = max(1, len(text) // 4)
+        prompt_tokens = sum(len(m.get("content", "")) for m in payload["messages"]) // 4
+        response_id = f"stub-{time.monotonic_ns()}"
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+        
+        if payload.get("stream"):
+            async def events():
+                yield ": OPENROUTER PROCESSING\n\n"
+                for start in range(0, len(text), chunk_chars):
+                    chunk = {
+                        "id": response_id,
+                        "model": payload["model"],
+                        "choices": [{"delta": {"content": text[start:start + chunk_chars]}}]
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                    if chunk_delay:
+                        await asyncio.sleep(chunk_delay)
+                final = {
+                    "id": response_id,
+                    "model": payload["model"],
+                    "choices": [{"delta": {}, "finish_reason": "stop"}],
+                    "usage": usage,
+                    "citations": sources
+                }
+                yield f"data: {json.dumps(final)}\n\n"
+                yield "data: [DONE]\n\n"
+            return StreamingResponse(events(), media_type="text/event-stream")
+        
+        return JSONResponse({
+            "id": response_id,
+            "model": payload["model"],
+            "choices": [{"message": {"role": "assistant", "content": text}}],
+            "usage": usage,
+            "citations": sources
+        })
+
+    return Starlette(routes=[Route("/chat/completions", chat_completions, methods=["POST"])])
+
+
+def free_port() -> int:
+    """Return an unused local TCP port."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@asynccontextmanager
+async def running_stub(port: int = 0, **app_options) -> AsyncIterator[str]:
+    """
+    Run the stub on the current event loop for the duration of the block.
+    
+    Yields:
+        The chat completions URL of the running stub
+    """
+    port = port or free_port()
+    config = uvicorn.Config(
+        create_app(**app_options), host="127.0.0.1", port=port,
+        log_level="warning", lifespan="off"
+    )
+    server = uvicorn.Server(config)
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}/chat/completions"
+    finally:
+        server.should_exit = True
+        await task
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--response-chars", type=int, default=1000)
+    parser.add_argument("--chunk-chars", type=int, default=40)
+    parser.add_argument("--chunk-delay", type=float, default=0.0)
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS, default="fixed")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    uvicorn.run(
+        create_app(
+            args.latency, args.response_chars, args.chunk_chars, args.chunk_delay,
+            distribution=args.distribution, jitter=args.jitter,
+            rate_limit_rate=args.rate_limit_rate, error_rate=args.error_rate,
+            error_status=args.error_status, retry_after=args.retry_after, seed=args.seed
+        ),
+        host="127.0.0.1", port=args.port, log_level="warning"
+    )
@@ -13,33 +13,543 @@ Requires OpenRouter API key: https://openrouter.ai/keys
 """
 
 import asyncio
+import contextvars
+import functools
+import hashlib
+import inspect
 import json
+import logging
 import os
+import random
+import re
+import secrets
+import signal
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager, nullcontext
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from enum import Enum
-from typing import Any, Dict, List, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
 
 import httpx
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import Context, FastMCP
+from mcp.server.fastmcp.tools import Tool, ToolManager
+from mcp.server.fastmcp.utilities.func_metadata import FuncMetadata, func_metadata
 from pydantic import BaseModel, Field, ConfigDict, field_validator
+from starlette.requests import Request
+from starlette.responses import JSONResponse
 
 # =============================================================================
 # CONSTANTS AND CONFIGURATION
 # =============================================================================
 
-CHARACTER_LIMIT = 50000  # Sonar responses can be comprehensive
-OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+def _env_int(name: str, default: int) -> int:
+    """Read an integer setting from the environment."""
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_float(name: str, default: float) -> float:
+    """Read a float setting from the environment."""
+    value = os.getenv(name)
+    return float(value) if value not in (None, "") else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    """Read a boolean setting from the environment ('1', 'true', 'yes', 'on')."""
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+logger = logging.getLogger("sonar_mcp_server")
+
+
+def _env_json_object(
+    name: str,
+    default: Dict[str, Any],
+    valid: Callable[[str, Any], bool],
+    expected: str
+) -> Dict[str, Any]:
+    """
+    Read a JSON object setting from the environment, merged over its defaults.
+    
+    Malformed JSON and entries rejected by valid(key, value) are logged and
+    ignored, so a typo falls back to the defaults instead of stopping the
+    server.
+    """
+    value = os.getenv(name)
+    if value in (None, ""):
+        return dict(default)
+    try:
+        overrides = json.loads(value)
+    except ValueError as e:
+        logger.warning("Ignoring %s: invalid JSON (%s)", name, e)
+        return dict(default)
+    if not isinstance(overrides, dict):
+        logger.warning("Ignoring %s: expected a JSON object, got %r", name, overrides)
+        return dict(default)
+    merged = dict(default)
+    for key, item in overrides.items():
+        if valid(key, item):
+            merged[key] = item
+        else:
+            logger.warning("Ignoring %s entry %r: %r (expected %s)", name, key, item, expected)
+    return merged
+
+
+def _env_list(name: str, default: str, parse: Callable[[str], Any], expected: str) -> Tuple[Any, ...]:
+    """
+    Read a comma-separated setting, converting each entry with parse().
+    
+    Entries parse() rejects with ValueError or KeyError are logged and
+    skipped; if none of the entries given is valid, the default is used.
+    """
+    def parse_all(value: str, log: bool) -> List[Any]:
+        items = []
+        for entry in (e.strip() for e in value.split(",")):
+            if not entry:
+                continue
+            try:
+                items.append(parse(entry))
+            except (ValueError, KeyError):
+                if log:
+                    logger.warning("Ignoring %s entry %r (expected %s)", name, entry, expected)
+        return items
+    
+    value = os.getenv(name)
+    if value is None:
+        return tuple(parse_all(default, False))
+    items = parse_all(value, True)
+    if not items and value.strip():
+        logger.warning("No valid %s entries; using %r", name, default)
+        return tuple(parse_all(default, False))
+    return tuple(items)
+
+
+def _status_code(entry: str) -> int:
+    code = int(entry)
+    if not 100 <= code <= 599:
+        raise ValueError(entry)
+    return code
+
+
+PAGE_TOKENS = _env_int("SONAR_PAGE_TOKENS", 12500)  # estimated tokens per result page (~50,000 chars)
+JSON_PRETTY = _env_bool("SONAR_JSON_PRETTY", False)  # indented JSON output instead of compact
+OPENROUTER_API_URL = os.getenv(
+    "OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions"
+)
 API_KEY_ENV = "OPENROUTER_API_KEY"
-REQUEST_TIMEOUT = 120.0  # seconds
+REQUEST_TIMEOUT = _env_float("SONAR_READ_TIMEOUT", 120.0)  # seconds, longest wait for response data
+
+# Timeouts and deadlines
+CONNECT_TIMEOUT = _env_float("SONAR_CONNECT_TIMEOUT", 10.0)  # seconds
+WRITE_TIMEOUT = _env_float("SONAR_WRITE_TIMEOUT", 10.0)  # seconds
+POOL_TIMEOUT = _env_float("SONAR_POOL_TIMEOUT", 10.0)  # seconds waiting for a pooled connection
+# Whole-call deadlines (retries included) per tool or tool:depth; SONAR_TOOL_TIMEOUTS (JSON) overrides
+DEFAULT_TOOL_TIMEOUTS = {
+    "sonar_search:quick": 30.0,
+    "sonar_search:standard": 60.0,
+    "sonar_search:detailed": 90.0,
+    "sonar_batch_search": 120.0,
+    "sonar_ask": 90.0,
+    "sonar_research": 240.0,
+    "sonar_reason": 180.0
+}
+_TIMEOUT_TOOLS = {key.partition(":")[0] for key in DEFAULT_TOOL_TIMEOUTS}
+
+
+def _valid_tool_timeout(key: str, seconds: Any) -> bool:
+    """'tool' or 'sonar_search:<depth>' mapped to a positive number of seconds."""
+    tool, _, depth = key.partition(":")
+    if tool not in _TIMEOUT_TOOLS or (depth and key not in DEFAULT_TOOL_TIMEOUTS):
+        return False
+    return isinstance(seconds, (int, float)) and not isinstance(seconds, bool) and 0 < seconds < float("inf")
+
+
+TOOL_TIMEOUTS = _env_json_object(
+    "SONAR_TOOL_TIMEOUTS", DEFAULT_TOOL_TIMEOUTS, _valid_tool_timeout,
+    "a tool name or sonar_search:<depth> mapped to positive seconds"
+)
+# Adaptive read timeout: p99 latency per model and token budget times a multiplier
+ADAPTIVE_TIMEOUTS = _env_bool("SONAR_ADAPTIVE_TIMEOUTS", False)
+ADAPTIVE_TIMEOUT_MULTIPLIER = _env_float("SONAR_ADAPTIVE_TIMEOUT_MULTIPLIER", 3.0)
+ADAPTIVE_TIMEOUT_MIN = _env_float("SONAR_ADAPTIVE_TIMEOUT_MIN", 10.0)  # seconds
+ADAPTIVE_MIN_SAMPLES = 20
+
+# Transport: 'stdio' (one client per process), 'streamable-http' or 'sse'
+SERVER_TRANSPORT = os.getenv("SONAR_TRANSPORT", "stdio")
+SERVER_HOST = os.getenv("SONAR_HOST", "0.0.0.0")
+SERVER_PORT = _env_int("SONAR_PORT", 8000)
+SERVER_WORKERS = _env_int("SONAR_WORKERS", 1)
+DRAIN_TIMEOUT = _env_float("SONAR_DRAIN_TIMEOUT", 30.0)  # seconds
+# Precomputed tool schemas (written by --write-tool-cache); ignored when stale
+TOOL_CACHE_PATH = os.getenv("SONAR_TOOL_CACHE") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "tool_schemas.json"
+)
+
+# Shared HTTP connection pool
+HTTP2_ENABLED = _env_bool("SONAR_HTTP2", False)  # requires the 'h2' package
+POOL_MAX_CONNECTIONS = _env_int("SONAR_POOL_MAX_CONNECTIONS", 20)
+POOL_MAX_KEEPALIVE = _env_int("SONAR_POOL_MAX_KEEPALIVE", 10)
+POOL_KEEPALIVE_EXPIRY = _env_float("SONAR_POOL_KEEPALIVE_EXPIRY", 30.0)  # seconds
+
+# Response cache
+CACHE_ENABLED = _env_bool("SONAR_CACHE_ENABLED", True)
+CACHE_MAX_ENTRIES = _env_int("SONAR_CACHE_MAX_ENTRIES", 1000)
+CACHE_DB_PATH = os.getenv("SONAR_CACHE_DB", "")  # empty = memory only
+SEARCH_CACHE_TTL = _env_float("SONAR_SEARCH_CACHE_TTL", 300.0)  # seconds
+ASK_CACHE_TTL = _env_float("SONAR_ASK_CACHE_TTL", 600.0)  # seconds
+# Near-duplicate matching of rephrased queries (opt-in)
+SIMILAR_CACHE_ENABLED = _env_bool("SONAR_SIMILAR_CACHE", False)
+SIMILAR_CACHE_THRESHOLD = _env_float("SONAR_SIMILAR_CACHE_THRESHOLD", 0.8)  # Jaccard of query terms
+SIMILAR_CACHE_MAX_ENTRIES = _env_int("SONAR_SIMILAR_CACHE_MAX_ENTRIES", CACHE_MAX_ENTRIES)
+
+# Full results of long answers, fetched page by page with sonar_get_page
+RESULT_STORE_MAX_CHARS = _env_int("SONAR_RESULT_STORE_MAX_CHARS", 20_000_000)
+RESULT_STORE_TTL = _env_float("SONAR_RESULT_STORE_TTL", 3600.0)  # seconds
+
+# Conversation sessions (sonar_ask with session_id)
+SESSION_MAX = _env_int("SONAR_SESSION_MAX", 1000)  # sessions kept, least recently used dropped first
+SESSION_TTL = _env_float("SONAR_SESSION_TTL", 1800.0)  # seconds idle before a session is dropped
+SESSION_HISTORY_TOKENS = _env_int("SONAR_SESSION_HISTORY_TOKENS", 1500)  # estimated, sent per follow-up
+SESSION_RECENT_TURNS = _env_int("SONAR_SESSION_RECENT_TURNS", 2)  # turns sent verbatim; older ones condensed
+
+# Upstream rate governor
+RATE_LIMIT_RPS = _env_float("SONAR_RATE_LIMIT_RPS", 10.0)  # 0 disables the token bucket
+RATE_LIMIT_BURST = _env_int("SONAR_RATE_LIMIT_BURST", 20)
+CONCURRENCY_INITIAL = _env_int("SONAR_CONCURRENCY_INITIAL", 8)
+CONCURRENCY_MAX = _env_int("SONAR_CONCURRENCY_MAX", POOL_MAX_CONNECTIONS)
+QUEUE_MAX_WAIT = _env_float("SONAR_QUEUE_MAX_WAIT", 30.0)  # seconds
+
+# Upstream routing: several endpoints/keys with failover
+API_KEYS_ENV = "OPENROUTER_API_KEYS"  # comma-separated keys, one endpoint each
+UPSTREAMS_CONFIG = os.getenv("SONAR_UPSTREAMS", "")  # JSON list of endpoints
+ROUTING_STRATEGIES = ("least-loaded", "ordered")
+ROUTING_STRATEGY = os.getenv("SONAR_ROUTING", "least-loaded").strip().lower()
+if ROUTING_STRATEGY not in ROUTING_STRATEGIES:
+    logger.warning("Ignoring SONAR_ROUTING %r (expected one of %s)", ROUTING_STRATEGY, ", ".join(ROUTING_STRATEGIES))
+    ROUTING_STRATEGY = "least-loaded"
+UPSTREAM_FAILURE_THRESHOLD = _env_int("SONAR_UPSTREAM_FAILURE_THRESHOLD", 3)  # consecutive
+UPSTREAM_COOLDOWN = _env_float("SONAR_UPSTREAM_COOLDOWN", 30.0)  # seconds ejected
+UPSTREAM_MAX_COOLDOWN = _env_float("SONAR_UPSTREAM_MAX_COOLDOWN", 300.0)  # seconds
+
+# Per-model circuit breakers
+BREAKER_WINDOW = _env_float("SONAR_BREAKER_WINDOW", 60.0)  # seconds of outcomes considered
+BREAKER_MIN_CALLS = _env_int("SONAR_BREAKER_MIN_CALLS", 5)  # before rates are judged
+BREAKER_FAILURE_RATE = _env_float("SONAR_BREAKER_FAILURE_RATE", 0.5)
+BREAKER_SLOW_CALL = _env_float("SONAR_BREAKER_SLOW_CALL", 90.0)  # seconds; slower calls are 'slow'
+BREAKER_SLOW_RATE = _env_float("SONAR_BREAKER_SLOW_RATE", 0.8)
+BREAKER_OPEN_SECONDS = _env_float("SONAR_BREAKER_OPEN_SECONDS", 30.0)
+BREAKER_HALF_OPEN_PROBES = _env_int("SONAR_BREAKER_HALF_OPEN_PROBES", 2)
+# Model to use while a model's circuit is open, as 'model=fallback,...' ('' disables)
+MODEL_FALLBACKS = dict(
+    pair.strip().split("=", 1)
+    for pair in os.getenv(
+        "SONAR_MODEL_FALLBACKS", "perplexity/sonar-reasoning-pro=perplexity/sonar-pro"
+    ).split(",")
+    if "=" in pair
+)
+
+# Retries and hedging
+RETRY_MAX_ATTEMPTS = _env_int("SONAR_RETRY_MAX_ATTEMPTS", 3)
+RETRY_STATUSES = _env_list("SONAR_RETRY_STATUSES", "429,500,502,503,504", _status_code, "an HTTP status code")
+RETRY_BASE_DELAY = _env_float("SONAR_RETRY_BASE_DELAY", 0.5)  # seconds
+RETRY_MAX_DELAY = _env_float("SONAR_RETRY_MAX_DELAY", 10.0)  # seconds
+RETRY_BUDGET_RATIO = _env_float("SONAR_RETRY_BUDGET_RATIO", 0.1)  # extra requests per request
+RETRY_BUDGET_CAPACITY = _env_float("SONAR_RETRY_BUDGET_CAPACITY", 10.0)
+REQUEST_DEADLINE = _env_float("SONAR_REQUEST_DEADLINE", 180.0)  # seconds, when no tool deadline applies
+HEDGE_QUICK_SEARCH = _env_bool("SONAR_HEDGE_QUICK_SEARCH", False)
+HEDGE_DEFAULT_DELAY = _env_float("SONAR_HEDGE_DEFAULT_DELAY", 3.0)  # seconds, until p95 is known
+HEDGE_MIN_SAMPLES = 20
+
+# Batch search
+BATCH_MAX_QUERIES = _env_int("SONAR_BATCH_MAX_QUERIES", 20)
+BATCH_MAX_CONCURRENCY = _env_int("SONAR_BATCH_MAX_CONCURRENCY", 8)
+
+# Request pipeline: middleware run around every tool's upstream call, in this order
+# ('warmer' counts searches for the cache warmer, 'timings' adds per-stage times to answers)
+PIPELINE_MIDDLEWARE = [
+    name.strip() for name in os.getenv("SONAR_PIPELINE_MIDDLEWARE", "warmer").split(",") if name.strip()
+]
+
+# Model routing ('router' middleware): simple sonar_search / sonar_ask requests use a cheaper tier
+# Tier -> model; a tier left out uses the tool's DEFAULT_*_MODEL. SONAR_MODEL_TIERS (JSON) overrides
+MODEL_TIER_NAMES = ("fast", "standard")
+MODEL_TIERS = _env_json_object(
+    "SONAR_MODEL_TIERS", {"fast": "perplexity/sonar"},
+    lambda tier, model: tier in MODEL_TIER_NAMES and isinstance(model, str) and bool(model.strip()),
+    f"a tier ({', '.join(MODEL_TIER_NAMES)}) mapped to a model name"
+)
+ROUTER_FAST_MAX_WORDS = _env_int("SONAR_ROUTER_FAST_MAX_WORDS", 12)  # longer questions go to 'standard'
+
+# Research fan-out (one sub-query per focus area)
+FANOUT_MIN_BRANCH_TOKENS = _env_int("SONAR_FANOUT_MIN_BRANCH_TOKENS", 1000)
+FANOUT_BRANCH_TIMEOUT = _env_float("SONAR_FANOUT_BRANCH_TIMEOUT", 90.0)  # seconds
+
+# Cache warmer: refreshes popular sonar_search queries before they expire (opt-in)
+WARMER_ENABLED = _env_bool("SONAR_WARMER", False)
+WARMER_HOURS = os.getenv("SONAR_WARMER_HOURS", "")  # local hours, e.g. "6-9" or "22-2"; empty = always
+WARMER_INTERVAL = _env_float("SONAR_WARMER_INTERVAL", 60.0)  # seconds between passes
+WARMER_TOP_QUERIES = _env_int("SONAR_WARMER_TOP_QUERIES", 20)
+WARMER_MIN_COUNT = _env_float("SONAR_WARMER_MIN_COUNT", 3.0)  # decayed request count to qualify
+WARMER_REFRESH_AHEAD = _env_float("SONAR_WARMER_REFRESH_AHEAD", 60.0)  # seconds before expiry
+WARMER_DAILY_TOKENS = _env_int("SONAR_WARMER_DAILY_TOKENS", 50000)
+WARMER_CONCURRENCY = _env_int("SONAR_WARMER_CONCURRENCY", 2)
+WARMER_HALF_LIFE = _env_float("SONAR_WARMER_HALF_LIFE", 259200.0)  # seconds (3 days)
+WARMER_STATE_PATH = os.getenv("SONAR_WARMER_STATE", "")  # empty = not persisted
 
-# Default model selection
+# Background jobs (sonar_research / sonar_reason with background=true)
+JOB_WORKERS = _env_int("SONAR_JOB_WORKERS", 2)  # jobs running at once
+JOB_QUEUE_MAX = _env_int("SONAR_JOB_QUEUE_MAX", 50)  # queued jobs before submissions are refused
+JOB_RESULT_TTL = _env_float("SONAR_JOB_RESULT_TTL", 3600.0)  # seconds a finished job is kept
+JOB_MAX_KEPT = _env_int("SONAR_JOB_MAX_KEPT", 500)  # finished jobs kept, oldest dropped first
+JOB_DB_PATH = os.getenv("SONAR_JOB_DB", "")  # empty = memory only
+# Lower runs first; SONAR_JOB_PRIORITIES (JSON) overrides
+DEFAULT_JOB_PRIORITIES = {"sonar_reason": 0, "sonar_research": 1}
+JOB_PRIORITIES = _env_json_object(
+    "SONAR_JOB_PRIORITIES", DEFAULT_JOB_PRIORITIES,
+    lambda tool, priority: tool in DEFAULT_JOB_PRIORITIES
+    and isinstance(priority, int) and not isinstance(priority, bool),
+    f"a background tool ({', '.join(DEFAULT_JOB_PRIORITIES)}) mapped to an integer"
+)
+
+# Token and cost budgets (per-client quotas are off while both limits are 0)
+BUDGET_WINDOW = _env_float("SONAR_BUDGET_WINDOW", 86400.0)  # rolling window, seconds
+BUDGET_CLIENT_TOKENS = _env_int("SONAR_BUDGET_CLIENT_TOKENS", 0)
+BUDGET_CLIENT_COST = _env_float("SONAR_BUDGET_CLIENT_COST", 0.0)  # USD
+BUDGET_SOFT_LIMIT = _env_float("SONAR_BUDGET_SOFT_LIMIT", 0.8)  # fraction before degrading
+BUDGET_MIN_TOKENS = _env_int("SONAR_BUDGET_MIN_TOKENS", 300)
+BUDGET_STATE_PATH = os.getenv("SONAR_BUDGET_STATE", "")  # empty = not persisted
+BUDGET_SAVE_INTERVAL = 30.0  # seconds
+
+# Metrics (Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics)
+METRICS_PORT = _env_int("SONAR_METRICS_PORT", 0)  # 0 disables the listener
+METRICS_HOST = os.getenv("SONAR_METRICS_HOST", "0.0.0.0")
+
+# Tracing (OpenTelemetry, requires opentelemetry-sdk): '' off, 'console' (stderr), 'file' or 'otlp'
+TRACING_EXPORTER = os.getenv("SONAR_TRACING", "").strip().lower()
+TRACE_FILE_PATH = os.getenv("SONAR_TRACE_FILE", "sonar_traces.jsonl")  # one JSON span per line
+TRACE_SAMPLE_RATIO = _env_float("SONAR_TRACE_SAMPLE_RATIO", 1.0)  # share of tool calls traced
+
+# Streaming (sonar_research / sonar_reason)
+STREAM_PROGRESS_INTERVAL = _env_float("SONAR_STREAM_PROGRESS_INTERVAL", 1.0)  # seconds
+
+# Default model selection (with the 'router' middleware: the 'standard' tier and the fallback)
 DEFAULT_SEARCH_MODEL = "perplexity/sonar-pro"
 DEFAULT_ASK_MODEL = "perplexity/sonar-pro"
 DEFAULT_RESEARCH_MODEL = "perplexity/sonar-pro"
 DEFAULT_REASON_MODEL = "perplexity/sonar-reasoning-pro"
 
+
+
+@asynccontextmanager
+async def server_lifespan(server: FastMCP):
+    """
+    Start the metrics listener and cache warmer on startup; on shutdown stop
+    background jobs and the warmer, close the listener and the HTTP client
+    and save budgets and query counts.
+    """
+    global _client_users
+    _client_users += 1
+    if _client_users == 1:
+        await start_metrics_listener()
+        cache_warmer.start()
+    try:
+        yield {}
+    finally:
+        _client_users -= 1
+        if _client_users == 0:
+            job_manager.shutdown()
+            cache_warmer.stop()
+            await close_http_client()
+            await stop_metrics_listener()
+            await budget.save(force=True)
+            await cache_warmer.save()
+            tracing.flush()
+
+
+# =============================================================================
+# TOOL SCHEMA CACHE
+# =============================================================================
+
+def tool_cache_fingerprint() -> str:
+    """
+    Hash of this file, the pydantic version and the FastMCP modules that
+    build tool schemas (by path and mtime; reading package metadata would
+    cost more than the cache saves).
+    """
+    import pydantic
+    from mcp.server.fastmcp.tools import base
+    
+    digest = hashlib.sha256()
+    with open(os.path.abspath(__file__), "rb") as source:
+        digest.update(source.read())
+    digest.update(pydantic.VERSION.encode())
+    for module in (base, sys.modules[func_metadata.__module__]):
+        digest.update(f"{module.__file__}:{os.stat(module.__file__).st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def load_tool_cache(path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Read precomputed tool schemas, keyed by tool name.
+    
+    Returns an empty dict when the file is missing, unreadable or was built
+    from a different version of the server, so tools are registered the
+    normal way.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("fingerprint") != tool_cache_fingerprint():
+        return {}
+    return data.get("tools") or {}
+
+
+class LazyTool(Tool):
+    """
+    A tool registered from cached schemas.
+    
+    tools/list is answered from the cached input and output schemas; the
+    pydantic argument model that validates calls is built on the first call.
+    """
+    
+    fn_metadata: Optional[FuncMetadata] = None
+    cached_output_schema: Optional[Dict[str, Any]] = None
+    
+    @property
+    def output_schema(self) -> Optional[Dict[str, Any]]:
+        if self.fn_metadata is None:
+            return self.cached_output_schema
+        return self.fn_metadata.output_schema
+    
+    async def run(self, arguments: Dict[str, Any], context: Any = None, convert_result: bool = False) -> Any:
+        if self.fn_metadata is None:
+            self.fn_metadata = func_metadata(
+                self.fn, skip_names=[self.context_kwarg] if self.context_kwarg else []
+            )
+        return await super().run(arguments, context=context, convert_result=convert_result)
+
+
+class CachedToolManager(ToolManager):
+    """
+    ToolManager that skips schema generation for tools found in the cache.
+    
+    Building each tool's argument model and JSON schema is most of the
+    server's own import time; with a valid cache, registration only wraps
+    the function and the rest is deferred to the tool's first call.
+    """
+    
+    def __init__(self, cache: Dict[str, Dict[str, Any]]):
+        super().__init__()
+        self.cache = cache
+    
+    def add_tool(self, fn: Callable[..., Any], name: Optional[str] = None, **kwargs: Any) -> Tool:
+        entry = self.cache.get(name or fn.__name__)
+        if entry is None or kwargs.get("structured_output") is not None:
+            return super().add_tool(fn, name=name, **kwargs)
+        try:
+            tool = LazyTool(
+                fn=fn,
+                name=name or fn.__name__,
+                title=kwargs.get("title"),
+                description=kwargs.get("description") or fn.__doc__ or "",
+                parameters=entry["parameters"],
+                cached_output_schema=entry.get("output_schema"),
+                is_async=True,
+                context_kwarg=entry.get("context_kwarg"),
+                annotations=kwargs.get("annotations"),
+                icons=kwargs.get("icons"),
+                meta=kwargs.get("meta")
+            )
+        except (TypeError, ValueError, KeyError) as e:
+            # Cache entry or Tool fields not as expected: register the normal way
+            logger.debug("Tool schema cache not used for %s: %s", name or fn.__name__, e)
+            return super().add_tool(fn, name=name, **kwargs)
+        self._tools.setdefault(tool.name, tool)
+        return self._tools[tool.name]
+
+
+# Private FastMCP API CachedToolManager and LazyTool depend on
+_LAZY_TOOL_FIELDS = {
+    "fn", "name", "title", "description", "parameters", "fn_metadata",
+    "is_async", "context_kwarg", "annotations", "icons", "meta"
+}
+_ADD_TOOL_PARAMETERS = {"fn", "name", "title", "description", "annotations", "icons", "meta", "structured_output"}
+
+
+def install_cached_tool_manager(server: FastMCP, cache: Dict[str, Dict[str, Any]]) -> bool:
+    """
+    Replace the server's tool manager with a CachedToolManager if it is safe.
+    
+    FastMCP has no public hook for this: the swap replaces the private
+    server._tool_manager and LazyTool is built from Tool's fields directly.
+    Unless both still look the way this code expects (an empty stock
+    ToolManager holding a _tools dict, the Tool fields, run() and add_tool()
+    parameters used here), the stock manager is kept and tools are
+    registered normally, just without the startup saving.
+    
+    Returns:
+        True if the cached manager was installed
+    """
+    if not cache:
+        return False
+    manager = getattr(server, "_tool_manager", None)
+    try:
+        compatible = (
+            type(manager) is ToolManager
+            and getattr(manager, "_tools", None) == {}
+            and _LAZY_TOOL_FIELDS <= set(Tool.model_fields)
+            and hasattr(Tool, "output_schema")
+            and {"arguments", "context", "convert_result"} <= set(inspect.signature(Tool.run).parameters)
+            and _ADD_TOOL_PARAMETERS <= set(inspect.signature(ToolManager.add_tool).parameters)
+        )
+    except (TypeError, ValueError, AttributeError):
+        compatible = False
+    if not compatible:
+        logger.warning("Installed mcp version does not match the tool schema cache; registering tools normally")
+        return False
+    replacement = CachedToolManager(cache)
+    replacement.warn_on_duplicate_tools = getattr(manager, "warn_on_duplicate_tools", True)
+    server._tool_manager = replacement
+    return True
+
+
+def write_tool_cache(path: str) -> int:
+    """
+    Build every registered tool's schemas from scratch and save them.
+    
+    Returns:
+        Number of tools written
+    """
+    tools = {}
+    for registered in mcp._tool_manager.list_tools():
+        tool = Tool.from_function(registered.fn, name=registered.name)
+        tools[tool.name] = {
+            "parameters": tool.parameters,
+            "output_schema": tool.output_schema,
+            "context_kwarg": tool.context_kwarg
+        }
+    temporary = f"{path}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": tool_cache_fingerprint(), "tools": tools}, f, indent=2)
+    os.replace(temporary, path)
+    return len(tools)
+
+
 # Initialize MCP server
-mcp = FastMCP("sonar-pro-search")
+mcp = FastMCP("sonar-pro-search", lifespan=server_lifespan)
+# Tools registered below take their schemas from TOOL_CACHE_PATH when it is current
+install_cached_tool_manager(mcp, load_tool_cache(TOOL_CACHE_PATH))
 
 
 # =============================================================================
@@ -59,6 +569,18 @@ class SearchDepth(str, Enum):
     DETAILED = "detailed"  # Comprehensive, ~4000 tokens
 
 
+class BatchOrder(str, Enum):
+    """Order of results returned by batch tools."""
+    INPUT = "input"            # Same order as the submitted queries
+    COMPLETION = "completion"  # Fastest results first
+
+
+class StatsFormat(str, Enum):
+    """Output format for server statistics."""
+    JSON = "json"
+    PROMETHEUS = "prometheus"
+
+
 # =============================================================================
 # PYDANTIC MODELS FOR INPUT VALIDATION
 # =============================================================================
@@ -96,6 +618,21 @@ class SonarSearchInput(BaseModel):
         default=ResponseFormat.MARKDOWN,
         description="Output format: 'markdown' for human-readable or 'json' for machine-readable"
     )
+    
+    use_cache: bool = Field(
+        default=True,
+        description="Reuse a recent cached answer for the same query; set false to force a fresh search"
+    )
+    
+    timeout_seconds: Optional[float] = Field(
+        default=None,
+        description=(
+            "Give up after this many seconds, retries included "
+            "(default: the server's timeout for this tool and depth)"
+        ),
+        ge=1,
+        le=600
+    )
 
 
 class SonarAskInput(BaseModel):
@@ -128,6 +665,17 @@ class SonarAskInput(BaseModel):
         max_length=500
     )
     
+    session_id: Optional[str] = Field(
+        default=None,
+        description=(
+            "Continue a conversation: questions with the same ID see the earlier "
+            "questions and answers, so follow-ups need not repeat them. Pick any ID "
+            "for a new conversation; idle sessions expire. "
+            "Example: 'db-choice'"
+        ),
+        pattern=r"^[A-Za-z0-9_.:-]{1,64}$"
+    )
+    
     max_tokens: int = Field(
         default=2000,
         description="Maximum tokens in response (500-4000)",
@@ -139,6 +687,21 @@ class SonarAskInput(BaseModel):
         default=ResponseFormat.MARKDOWN,
         description="Output format: 'markdown' or 'json'"
     )
+    
+    use_cache: bool = Field(
+        default=True,
+        description="Reuse a recent cached answer for the same question; set false to force a fresh answer"
+    )
+    
+    timeout_seconds: Optional[float] = Field(
+        default=None,
+        description=(
+            "Give up after this many seconds, retries included "
+            "(default: the server's timeout for this tool)"
+        ),
+        ge=1,
+        le=600
+    )
 
 
 class SonarResearchInput(BaseModel):
@@ -183,6 +746,41 @@ class SonarResearchInput(BaseModel):
         description="Output format: 'markdown' or 'json'"
     )
     
+    fan_out: bool = Field(
+        default=False,
+        description=(
+            "Research each focus area in a separate, concurrent request and merge "
+            "the sections (faster for several focus areas; partial results are "
+            "returned if one area fails)"
+        )
+    )
+    
+    stream: bool = Field(
+        default=True,
+        description=(
+            "Stream the response from the model and report progress while it "
+            "is generated (recommended for long responses)"
+        )
+    )
+    
+    background: bool = Field(
+        default=False,
+        description=(
+            "Run as a background job: return a job ID at once and fetch the result "
+            "later with sonar_job_result (the job keeps running if the client disconnects)"
+        )
+    )
+    
+    timeout_seconds: Optional[float] = Field(
+        default=None,
+        description=(
+            "Give up after this many seconds, retries included "
+            "(default: the server's timeout for this tool)"
+        ),
+        ge=1,
+        le=600
+    )
+    
     @field_validator('focus_areas')
     @classmethod
     def validate_focus_areas(cls, v: Optional[List[str]]) -> Optional[List[str]]:
@@ -236,231 +834,4889 @@ class SonarReasonInput(BaseModel):
         default=ResponseFormat.MARKDOWN,
         description="Output format: 'markdown' or 'json'"
     )
-
-
-# =============================================================================
-# HELPER FUNCTIONS
-# =============================================================================
-
-def get_api_key() -> str:
-    """
-    Get OpenRouter API key from environment.
     
-    Returns:
-        API key string
-        
-    Raises:
-        ValueError: If API key not found
-    """
-    api_key = os.getenv(API_KEY_ENV)
-    if not api_key:
-        raise ValueError(
-            f"OpenRouter API key not found. Please set the {API_KEY_ENV} environment variable.\n"
-            f"Get your key at: https://openrouter.ai/keys\n\n"
-            f"In Docker, set it in your .env file:\n"
-            f"OPENROUTER_API_KEY=your_key_here"
+    stream: bool = Field(
+        default=True,
+        description=(
+            "Stream the response from the model and report progress while it "
+            "is generated (recommended for long responses)"
         )
-    return api_key
+    )
+    
+    background: bool = Field(
+        default=False,
+        description=(
+            "Run as a background job: return a job ID at once and fetch the result "
+            "later with sonar_job_result (the job keeps running if the client disconnects)"
+        )
+    )
+    
+    timeout_seconds: Optional[float] = Field(
+        default=None,
+        description=(
+            "Give up after this many seconds, retries included "
+            "(default: the server's timeout for this tool)"
+        ),
+        ge=1,
+        le=600
+    )
 
 
-async def call_openrouter(
-    messages: List[Dict[str, str]],
-    model: str,
-    max_tokens: int,
-    temperature: float = 0.2
-) -> Dict[str, Any]:
-    """
-    Make an API request to OpenRouter.
-    
-    Args:
-        messages: List of message dicts with 'role' and 'content'
-        model: Model identifier (e.g., 'perplexity/sonar-pro')
-        max_tokens: Maximum tokens in response
-        temperature: Response temperature (0.0-1.0)
-        
-    Returns:
-        API response dictionary with 'choices', 'usage', etc.
-        
-    Raises:
-        httpx.HTTPStatusError: On HTTP errors (401, 429, 500, etc.)
-        httpx.TimeoutException: On request timeout
-        ValueError: On invalid API response structure
-    """
-    api_key = get_api_key()
+class BatchSearchQuery(BaseModel):
+    """One query in a batch search."""
     
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "https://github.com/sonar-mcp-server",
-        "X-Title": "Sonar MCP Server"
-    }
+    model_config = ConfigDict(
+        str_strip_whitespace=True,
+        validate_assignment=True,
+        extra='forbid'
+    )
     
-    payload = {
-        "model": model,
-        "messages": messages,
-        "max_tokens": max_tokens,
-        "temperature": temperature
-    }
+    query: str = Field(
+        ...,
+        description="Search query in natural language (same as sonar_search)",
+        min_length=3,
+        max_length=500
+    )
     
-    try:
-        async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
-            response = await client.post(
-                OPENROUTER_API_URL,
-                json=payload,
-                headers=headers
-            )
-            response.raise_for_status()
-            return response.json()
-            
-    except httpx.HTTPStatusError as e:
-        status_code = e.response.status_code
-        if status_code == 401:
-            raise ValueError(
-                "Authentication failed. Please check your OPENROUTER_API_KEY. "
-                "Get a key at: https://openrouter.ai/keys"
-            )
-        elif status_code == 429:
-            raise ValueError(
-                "Rate limit exceeded. Please wait a moment and try again. "
-                "Consider upgrading your OpenRouter plan for higher limits."
-            )
-        elif status_code >= 500:
-            raise ValueError(
-                f"OpenRouter service error ({status_code}). Please try again later."
-            )
-        else:
-            raise ValueError(f"API request failed with status {status_code}: {e.response.text}")
+    depth: SearchDepth = Field(
+        default=SearchDepth.STANDARD,
+        description="Search depth: 'quick', 'standard' or 'detailed'"
+    )
     
-    except httpx.TimeoutException:
-        raise ValueError(
-            f"Request timed out after {REQUEST_TIMEOUT} seconds. "
-            "Try a shorter query or reduce max_tokens."
-        )
+    use_cache: bool = Field(
+        default=True,
+        description="Reuse a recent cached answer for the same query"
+    )
 
 
-def extract_content(response: Dict[str, Any]) -> str:
-    """
-    Extract content from OpenRouter API response.
+class SonarBatchSearchInput(BaseModel):
+    """Input model for running many web searches concurrently."""
     
-    Args:
-        response: API response dictionary
-        
-    Returns:
-        Extracted content string
-        
-    Raises:
-        ValueError: If response structure is invalid
-    """
-    try:
-        return response["choices"][0]["message"]["content"]
-    except (KeyError, IndexError) as e:
-        raise ValueError(f"Invalid API response structure: {e}\nResponse: {response}")
-
-
+    model_config = ConfigDict(
+        str_strip_whitespace=True,
+        validate_assignment=True,
+        extra='forbid'
+    )
+    
+    queries: List[BatchSearchQuery] = Field(
+        ...,
+        description=(
+            "Searches to run, each with its own query, depth and use_cache. "
+            "Example: [{'query': 'latest Rust release'}, "
+            "{'query': 'Go 1.23 features', 'depth': 'quick'}]"
+        ),
+        min_length=1,
+        max_length=BATCH_MAX_QUERIES
+    )
+    
+    max_concurrency: int = Field(
+        default=5,
+        description=f"Maximum searches running at the same time (1-{BATCH_MAX_CONCURRENCY})",
+        ge=1,
+        le=BATCH_MAX_CONCURRENCY
+    )
+    
+    order: BatchOrder = Field(
+        default=BatchOrder.INPUT,
+        description="Result order: 'input' (as submitted) or 'completion' (fastest first)"
+    )
+    
+    response_format: ResponseFormat = Field(
+        default=ResponseFormat.MARKDOWN,
+        description="Output format: 'markdown' or 'json'"
+    )
+    
+    timeout_seconds: Optional[float] = Field(
+        default=None,
+        description=(
+            "Give up after this many seconds, retries included "
+            "(default: the server's timeout for this tool)"
+        ),
+        ge=1,
+        le=600
+    )
+
+
+class SonarGetPageInput(BaseModel):
+    """Input model for fetching further pages of a long result."""
+    
+    model_config = ConfigDict(
+        str_strip_whitespace=True,
+        validate_assignment=True,
+        extra='forbid'
+    )
+    
+    handle: str = Field(
+        ...,
+        description="Result handle from the 'page' information of an earlier tool call",
+        min_length=1,
+        max_length=64
+    )
+    
+    offset: int = Field(
+        ...,
+        description="Character offset to start from: 'next_offset' of the previous page",
+        ge=0
+    )
+    
+    max_tokens: int = Field(
+        default=PAGE_TOKENS,
+        description=f"Approximate size of the page in tokens (default {PAGE_TOKENS})",
+        ge=500,
+        le=50000
+    )
+    
+    response_format: ResponseFormat = Field(
+        default=ResponseFormat.MARKDOWN,
+        description="Output format: 'markdown' or 'json'"
+    )
+
+
+class SonarJobInput(BaseModel):
+    """Input model for background job status, result and cancellation."""
+    
+    model_config = ConfigDict(
+        str_strip_whitespace=True,
+        validate_assignment=True,
+        extra='forbid'
+    )
+    
+    job_id: str = Field(
+        ...,
+        description="Job ID returned when the job was submitted",
+        min_length=1,
+        max_length=64
+    )
+    
+    response_format: ResponseFormat = Field(
+        default=ResponseFormat.MARKDOWN,
+        description="Output format of the job status: 'markdown' or 'json'"
+    )
+
+
+class SonarStatsInput(BaseModel):
+    """Input model for server statistics."""
+    
+    model_config = ConfigDict(
+        validate_assignment=True,
+        extra='forbid'
+    )
+    
+    format: StatsFormat = Field(
+        default=StatsFormat.JSON,
+        description=(
+            "Output format: 'json' for a subsystem summary or 'prometheus' for "
+            "all metrics (counters, latency histograms) in Prometheus text format"
+        )
+    )
+
+
+# =============================================================================
+# METRICS
+# =============================================================================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Pipeline stages range from microseconds (formatting) to minutes (upstream)
+STAGE_BUCKETS = (0.0001, 0.0005, 0.001) + LATENCY_BUCKETS
+
+LabelValues = Tuple[str, ...]
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+    
+    kind = "counter"
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values: Dict[LabelValues, float] = {}
+    
+    def inc(self, *label_values: str, amount: float = 1.0) -> None:
+        self.values[label_values] = self.values.get(label_values, 0.0) + amount
+    
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels."""
+    
+    kind = "histogram"
+    
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self.values: Dict[LabelValues, List[float]] = {}
+    
+    def observe(self, value: float, *label_values: str) -> None:
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [0.0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        else:
+            series[len(self.buckets)] += 1
+        series[-1] += value
+    
+    def samples(self):
+        for label_values, series in self.values.items():
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket", {**labels, "le": le}, cumulative
+            yield f"{self.name}_count", labels, cumulative
+            yield f"{self.name}_sum", labels, series[-1]
+
+
+class CallbackMetric:
+    """Gauge or counter whose value is read from a callback when rendered."""
+    
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        read: Callable[[], Any],
+        kind: str = "gauge",
+        labels: Tuple[str, ...] = ()
+    ):
+        self.name = name
+        self.help = help_text
+        self.read = read
+        self.kind = kind
+        self.labels = labels
+    
+    def samples(self):
+        if not self.labels:
+            yield self.name, {}, float(self.read())
+            return
+        # Labelled callbacks return {label values: value}
+        for label_values, value in self.read().items():
+            yield self.name, dict(zip(self.labels, label_values)), float(value)
+
+
+def _escape_label(value: Any) -> str:
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRegistry:
+    """Holds all metrics and renders them in Prometheus text format."""
+    
+    def __init__(self):
+        self.metrics: List[Any] = []
+    
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help_text, labels)
+        self.metrics.append(metric)
+        return metric
+    
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ) -> Histogram:
+        metric = Histogram(name, help_text, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+    
+    def callback(
+        self,
+        name: str,
+        help_text: str,
+        read: Callable[[], Any],
+        kind: str = "gauge",
+        labels: Tuple[str, ...] = ()
+    ) -> CallbackMetric:
+        metric = CallbackMetric(name, help_text, read, kind, labels)
+        self.metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    rendered = ",".join(
+                        f'{key}="{_escape_label(val)}"' for key, val in labels.items()
+                    )
+                    lines.append(f"{name}{{{rendered}}} {value:g}")
+                else:
+                    lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+TOOL_REQUESTS = metrics.counter(
+    "sonar_tool_requests_total", "Tool calls by tool and outcome", ("tool", "status")
+)
+TOOL_ERRORS = metrics.counter(
+    "sonar_tool_errors_total", "Failed tool calls by error class", ("tool", "error_class")
+)
+TOOL_DURATION = metrics.histogram(
+    "sonar_tool_duration_seconds", "End-to-end tool call latency", ("tool",)
+)
+TOOL_PROCESSING = metrics.histogram(
+    "sonar_tool_processing_seconds",
+    "Tool time outside queueing and upstream calls (validation, prompt build, formatting)",
+    ("tool",)
+)
+QUEUE_WAIT = metrics.histogram(
+    "sonar_queue_wait_seconds", "Time spent waiting for an upstream slot"
+)
+UPSTREAM_REQUESTS = metrics.counter(
+    "sonar_upstream_requests_total", "Upstream requests by model and HTTP status", ("model", "status")
+)
+UPSTREAM_LATENCY = metrics.histogram(
+    "sonar_upstream_latency_seconds", "Upstream request latency", ("model",)
+)
+TIME_TO_FIRST_TOKEN = metrics.histogram(
+    "sonar_time_to_first_token_seconds", "Streaming time to first content chunk", ("model",)
+)
+PROMPT_TOKENS = metrics.counter(
+    "sonar_prompt_tokens_total", "Prompt tokens reported by the upstream", ("model",)
+)
+COMPLETION_TOKENS = metrics.counter(
+    "sonar_completion_tokens_total", "Completion tokens reported by the upstream", ("model",)
+)
+COST_USD = metrics.counter(
+    "sonar_cost_usd_total", "Estimated upstream spend from the price table", ("model",)
+)
+CIRCUIT_TRANSITIONS = metrics.counter(
+    "sonar_circuit_transitions_total", "Model circuit breaker state changes", ("model", "state")
+)
+MODEL_FALLBACK_CALLS = metrics.counter(
+    "sonar_model_fallbacks_total", "Calls served by a fallback model while a circuit was open",
+    ("model", "fallback")
+)
+JOB_QUEUE_WAIT = metrics.histogram(
+    "sonar_job_queue_wait_seconds", "Time background jobs waited for a worker", ("tool",)
+)
+JOB_RUN_TIME = metrics.histogram(
+    "sonar_job_run_seconds", "Background job run time", ("tool",)
+)
+JOBS_FINISHED = metrics.counter(
+    "sonar_jobs_finished_total", "Background jobs by final status", ("tool", "status")
+)
+PIPELINE_STAGE = metrics.histogram(
+    "sonar_pipeline_stage_seconds", "Time per request pipeline stage", ("tool", "stage"), STAGE_BUCKETS
+)
+ROUTER_DECISIONS = metrics.counter(
+    "sonar_router_decisions_total", "Model tier chosen by the router", ("tool", "tier", "reason")
+)
+ROUTER_LATENCY = metrics.histogram(
+    "sonar_router_upstream_seconds", "Upstream time of routed requests, cache hits excluded", ("tier",)
+)
+ROUTER_TOKENS = metrics.counter(
+    "sonar_router_tokens_total", "Tokens used by routed requests", ("tier", "kind")
+)
+
+# Subsystem state, read when metrics are rendered
+metrics.callback("sonar_active_tool_calls", "Tool calls currently running",
+                 lambda: _active_calls)
+metrics.callback("sonar_cache_entries", "Responses in the in-memory cache",
+                 lambda: len(response_cache._entries))
+metrics.callback("sonar_cache_hits_total", "Response cache hits",
+                 lambda: response_cache.hits, "counter")
+metrics.callback("sonar_cache_misses_total", "Response cache misses",
+                 lambda: response_cache.misses, "counter")
+metrics.callback("sonar_cache_evictions_total", "Response cache LRU evictions",
+                 lambda: response_cache.evictions, "counter")
+metrics.callback("sonar_cache_similar_hits_total", "Cached answers served for a rephrased query",
+                 lambda: similar_queries.hits, "counter")
+metrics.callback("sonar_result_store_entries", "Long results kept for sonar_get_page",
+                 lambda: len(result_store._entries))
+metrics.callback("sonar_result_store_chars", "Characters held by the result store",
+                 lambda: result_store._chars)
+metrics.callback("sonar_sessions", "Conversation sessions kept for sonar_ask",
+                 lambda: len(sessions._sessions))
+metrics.callback("sonar_session_tokens_saved_total",
+                 "Estimated prompt tokens saved by condensing session history",
+                 lambda: sessions.tokens_saved, "counter")
+metrics.callback("sonar_jobs_queued", "Background jobs waiting for a worker",
+                 lambda: job_manager.count("queued"))
+metrics.callback("sonar_jobs_running", "Background jobs currently running",
+                 lambda: job_manager.count("running"))
+metrics.callback("sonar_jobs_rejected_total", "Job submissions refused because the queue was full",
+                 lambda: job_manager.rejected, "counter")
+metrics.callback("sonar_warmer_refreshes_total", "Popular queries refreshed ahead of expiry",
+                 lambda: cache_warmer.refreshed, "counter")
+metrics.callback("sonar_warmer_tokens_today", "Tokens spent by the cache warmer today",
+                 lambda: cache_warmer.tokens_today)
+metrics.callback("sonar_upstream_in_flight", "Upstream requests currently running",
+                 lambda: upstream_router.total("in_flight"))
+metrics.callback("sonar_upstream_queue_depth", "Requests waiting for an upstream slot",
+                 lambda: upstream_router.total("waiting"))
+metrics.callback("sonar_upstream_concurrency_limit", "Current adaptive concurrency limit",
+                 lambda: upstream_router.total("limit"))
+metrics.callback("sonar_throttle_events_total", "Upstream 429/503 responses seen by the governor",
+                 lambda: upstream_router.total("throttled"), "counter")
+metrics.callback("sonar_upstream_endpoint_state",
+                 "Endpoint circuit state (0 closed, 1 half-open, 2 open)",
+                 lambda: {(e.name,): CIRCUIT_STATES.index(e.state) for e in upstream_router.endpoints},
+                 labels=("endpoint",))
+metrics.callback("sonar_upstream_endpoint_active", "Requests currently routed to an endpoint",
+                 lambda: {(e.name,): e.active for e in upstream_router.endpoints},
+                 labels=("endpoint",))
+metrics.callback("sonar_upstream_endpoint_requests_total", "Requests routed to an endpoint",
+                 lambda: {(e.name,): e.requests for e in upstream_router.endpoints},
+                 "counter", ("endpoint",))
+metrics.callback("sonar_upstream_endpoint_failures_total", "Endpoint failures (network, 401/403, 429, 5xx)",
+                 lambda: {(e.name,): e.errors for e in upstream_router.endpoints},
+                 "counter", ("endpoint",))
+metrics.callback("sonar_upstream_endpoint_ejections_total", "Times an endpoint was ejected",
+                 lambda: {(e.name,): e.ejections for e in upstream_router.endpoints},
+                 "counter", ("endpoint",))
+metrics.callback("sonar_circuit_state",
+                 "Model circuit breaker state (0 closed, 1 half-open, 2 open)",
+                 lambda: {(m,): CIRCUIT_STATES.index(b.state) for m, b in model_breakers.breakers.items()},
+                 labels=("model",))
+metrics.callback("sonar_circuit_rejected_total", "Calls failed fast by an open model circuit",
+                 lambda: {(m,): b.rejected for m, b in model_breakers.breakers.items()},
+                 "counter", ("model",))
+metrics.callback("sonar_upstream_failovers_total", "Requests moved to another endpoint after a failure",
+                 lambda: upstream_router.failovers, "counter")
+metrics.callback("sonar_coalesced_requests_total", "Requests that joined an identical in-flight request",
+                 lambda: upstream_flights.coalesced, "counter")
+metrics.callback("sonar_retries_total", "Upstream retries",
+                 lambda: retry_stats["retries"], "counter")
+metrics.callback("sonar_budget_degraded_total", "Calls with max_tokens or depth reduced by a budget",
+                 lambda: budget.degraded, "counter")
+metrics.callback("sonar_budget_rejected_total", "Calls rejected because a client budget was used up",
+                 lambda: budget.rejected, "counter")
+metrics.callback("sonar_http_pool_max_connections", "Configured HTTP connection pool size",
+                 lambda: POOL_MAX_CONNECTIONS)
+
+
+class RequestTimings:
+    """Queue and upstream time accumulated during one tool call."""
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queue = 0.0
+        self.upstream = 0.0
+        self.prompt_recorded = False  # time to the first pipeline run, recorded once per call
+
+
+_request_timings: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar(
+    "sonar_request_timings", default=None
+)
+
+
+def classify_error(error: BaseException) -> str:
+    """Map an exception to a metrics error class."""
+    status = getattr(error, "status_code", None)
+    if status in (401, 403):
+        return "auth"
+    if status == 429:
+        return "rate_limit"
+    if status is not None and status >= 500:
+        return "server_error"
+    if status is not None:
+        return "client_error"
+    cause = error.__cause__ if isinstance(error, UpstreamError) else error
+    if isinstance(cause, (httpx.TimeoutException, asyncio.TimeoutError)):
+        return "timeout"
+    if isinstance(cause, httpx.TransportError):
+        return "network"
+    if isinstance(error, ValueError) and str(error).startswith("Server is busy"):
+        return "queue_timeout"
+    if isinstance(error, CircuitOpenError):
+        return "circuit_open"
+    return "other"
+
+
+def record_upstream(model: str, status: str, seconds: float, usage: Optional[Dict[str, Any]]) -> None:
+    """Record one upstream request in the metrics, the current tool's timings and its trace span."""
+    UPSTREAM_REQUESTS.inc(model, status)
+    UPSTREAM_LATENCY.observe(seconds, model)
+    if usage:
+        PROMPT_TOKENS.inc(model, amount=usage.get("prompt_tokens", 0) or 0)
+        COMPLETION_TOKENS.inc(model, amount=usage.get("completion_tokens", 0) or 0)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.upstream += seconds
+    if tracing.enabled:
+        tracing.set_attributes({
+            "sonar.upstream.status": status,
+            "gen_ai.usage.input_tokens": (usage or {}).get("prompt_tokens"),
+            "gen_ai.usage.output_tokens": (usage or {}).get("completion_tokens")
+        })
+
+
+def instrumented(tool: str):
+    """
+    Decorator recording call counts, latency and errors for an MCP tool.
+    
+    Apply below @mcp.tool so the registered function is the wrapper;
+    functools.wraps keeps the signature FastMCP builds the schema from.
+    If the tool takes a Context, the caller's budget key is taken from it
+    (background jobs set it before running the tool).
+    The call's deadline comes from params.timeout_seconds, or else the
+    configured timeout for the tool (and search depth).
+    With tracing on, each call is a root span. Calls are refused once the
+    server has started draining for shutdown.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            global _active_calls
+            if _draining:
+                raise ValueError("Server is shutting down; retry the call on another instance")
+            ctx = next((v for v in kwargs.values() if isinstance(v, Context)), None)
+            client_token = _client_key.set(
+                client_key_from_context(ctx) if ctx is not None else _client_key.get()
+            )
+            params = next((v for v in (*args, *kwargs.values()) if isinstance(v, BaseModel)), None)
+            depth = getattr(params, "depth", None)
+            timeout = getattr(params, "timeout_seconds", None) or tool_timeout(
+                tool, depth.value if isinstance(depth, Enum) else None
+            )
+            deadline_token = _deadline.set(time.monotonic() + timeout)
+            timings = RequestTimings()
+            token = _request_timings.set(timings)
+            _active_calls += 1
+            try:
+                with tracing.span(f"tool {tool}", {"sonar.tool": tool, "sonar.client": _client_key.get()}):
+                    result = await func(*args, **kwargs)
+            except Exception as e:
+                TOOL_REQUESTS.inc(tool, "error")
+                TOOL_ERRORS.inc(tool, classify_error(e))
+                raise
+            finally:
+                _active_calls -= 1
+                elapsed = time.perf_counter() - timings.started
+                _request_timings.reset(token)
+                _client_key.reset(client_token)
+                _deadline.reset(deadline_token)
+                TOOL_DURATION.observe(elapsed, tool)
+                TOOL_PROCESSING.observe(
+                    max(0.0, elapsed - timings.queue - timings.upstream), tool
+                )
+            TOOL_REQUESTS.inc(tool, "ok")
+            return result
+        return wrapper
+    return decorate
+
+
+async def _serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Answer one HTTP request on the metrics listener."""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+_metrics_server: Optional[asyncio.AbstractServer] = None
+
+
+async def start_metrics_listener() -> None:
+    """Start the Prometheus /metrics HTTP listener if METRICS_PORT is set."""
+    global _metrics_server
+    if METRICS_PORT and _metrics_server is None:
+        _metrics_server = await asyncio.start_server(_serve_metrics, METRICS_HOST, METRICS_PORT)
+
+
+async def stop_metrics_listener() -> None:
+    """Stop the metrics listener."""
+    global _metrics_server
+    if _metrics_server is not None:
+        server, _metrics_server = _metrics_server, None
+        server.close()
+        await server.wait_closed()
+
+
+# =============================================================================
+# TRACING
+# =============================================================================
+
+# httpcore trace events (after the connection./http11./http2. prefix) -> span name
+HTTP_TRACE_PHASES = {
+    "connect_tcp": "http connect",
+    "start_tls": "http tls",
+    "send_request_headers": "http send headers",
+    "send_request_body": "http send body",
+    "receive_response_headers": "http wait",  # upstream generation until the response starts
+    "receive_response_body": "http receive"
+}
+_NO_SPAN = nullcontext()
+
+
+class Tracing:
+    """
+    Optional OpenTelemetry spans for tool calls.
+    
+    Off unless SONAR_TRACING names an exporter and opentelemetry-sdk is
+    installed; while off, span() returns a shared no-op context manager
+    and OpenTelemetry is never imported. Each tool call is a root span
+    with the pipeline stages, upstream attempts, queue waits and HTTP
+    connection phases nested under it. Spans are batched and exported to
+    stderr ('console'), a JSON-lines file ('file') or an OTLP/HTTP
+    collector ('otlp', configured by the standard OTEL_EXPORTER_OTLP_*
+    variables). Sampling is decided per tool call.
+    """
+    
+    def __init__(self, exporter: str, sample_ratio: float = 1.0, file_path: str = TRACE_FILE_PATH):
+        self.exporter = exporter
+        self.sample_ratio = sample_ratio
+        self.file_path = file_path
+        self.error: Optional[str] = None
+        self.tracer = None
+        self._provider = None
+        self._otel_trace = None
+        if exporter not in ("", "console", "file", "otlp"):
+            # A typo in an optional setting must not stop the server
+            self.error = f"tracing disabled: unknown exporter '{exporter}' (use console, file or otlp)"
+            logger.warning("SONAR_TRACING: %s", self.error)
+        elif exporter:
+            self._start()
+    
+    def _start(self) -> None:
+        try:
+            from opentelemetry import trace
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+            from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+            if self.exporter == "otlp":
+                from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError as e:
+            self.error = f"tracing disabled: {e}"
+            return
+        if self.exporter == "otlp":
+            exporter = OTLPSpanExporter()
+        elif self.exporter == "file":
+            try:
+                out = open(self.file_path, "a", encoding="utf-8")
+            except OSError as e:
+                self.error = f"tracing disabled: cannot open {self.file_path}: {e}"
+                logger.warning("SONAR_TRACING: %s", self.error)
+                return
+            exporter = ConsoleSpanExporter(
+                out=out, formatter=lambda span: span.to_json(indent=None) + "\n"
+            )
+        else:
+            # stdout carries the MCP protocol on stdio
+            exporter = ConsoleSpanExporter(out=sys.stderr)
+        self._provider = TracerProvider(
+            resource=Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME", "sonar-pro-search")}),
+            sampler=ParentBased(TraceIdRatioBased(self.sample_ratio))
+        )
+        self._provider.add_span_processor(BatchSpanProcessor(exporter))
+        self.tracer = self._provider.get_tracer("sonar_mcp_server")
+        self._otel_trace = trace
+    
+    @property
+    def enabled(self) -> bool:
+        return self.tracer is not None
+    
+    def span(self, name: str, attributes: Optional[Dict[str, Any]] = None):
+        """Context manager for a span under the current one (no-op while tracing is off)."""
+        if self.tracer is None:
+            return _NO_SPAN
+        return self.tracer.start_as_current_span(name, attributes=attributes)
+    
+    def set_attributes(self, attributes: Dict[str, Any]) -> None:
+        """Set attributes on the current span; None values are left out."""
+        if self.tracer is None:
+            return
+        self._otel_trace.get_current_span().set_attributes(
+            {key: value for key, value in attributes.items() if value is not None}
+        )
+    
+    def record(self, name: str, seconds: float) -> None:
+        """Add a finished span under the current one that lasted `seconds` and ended now."""
+        if self.tracer is None:
+            return
+        end = time.time_ns()
+        self.tracer.start_span(name, start_time=end - int(seconds * 1e9)).end(end_time=end)
+    
+    def upstream_attempt(self, max_tokens: int, stream: bool = False):
+        """Decorator running each upstream attempt, send(endpoint, model), in a 'chat <model>' span."""
+        def decorate(send):
+            if self.tracer is None:
+                return send
+            
+            @functools.wraps(send)
+            async def traced(endpoint, model: str):
+                with self.span(f"chat {model}", {
+                    "gen_ai.operation.name": "chat",
+                    "gen_ai.request.model": model,
+                    "gen_ai.request.max_tokens": max_tokens,
+                    "sonar.endpoint": endpoint.name,
+                    "sonar.stream": stream
+                }):
+                    return await send(endpoint, model)
+            return traced
+        return decorate
+    
+    def http_extensions(self) -> Dict[str, Any]:
+        """httpx request extensions reporting connect, TLS, send, wait and receive as spans."""
+        if self.tracer is None:
+            return {}
+        tracer, otel_trace = self.tracer, self._otel_trace
+        open_spans: Dict[str, Any] = {}
+        
+        async def trace(event: str, info: Dict[str, Any]) -> None:
+            phase, _, state = event.rpartition(".")
+            name = HTTP_TRACE_PHASES.get(phase.partition(".")[2])
+            if name is None:
+                return
+            if state == "started":
+                open_spans[phase] = tracer.start_span(name)
+                return
+            span = open_spans.pop(phase, None)
+            if span is not None:
+                # a stream closed after the last event ends its body read with GeneratorExit
+                if state == "failed" and not isinstance(info.get("exception"), GeneratorExit):
+                    span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, repr(info.get("exception"))))
+                span.end()
+        
+        return {"trace": trace}
+    
+    def flush(self) -> None:
+        """Export buffered spans (at shutdown)."""
+        if self._provider is not None:
+            self._provider.force_flush(timeout_millis=5000)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Tracing configuration for sonar_stats."""
+        stats = {"enabled": self.enabled, "exporter": self.exporter or None}
+        if self.exporter:
+            stats["sample_ratio"] = self.sample_ratio
+        if self.exporter == "file":
+            stats["file"] = self.file_path
+        if self.error:
+            stats["error"] = self.error
+        return stats
+
+
+tracing = Tracing(TRACING_EXPORTER, TRACE_SAMPLE_RATIO)
+
+
+# =============================================================================
+# SHARED HTTP CLIENT
+# =============================================================================
+
+_http_client: Optional[httpx.AsyncClient] = None
+_client_users = 0  # active server lifespans sharing the client
+
+
+def _http2_available() -> bool:
+    """Return True if HTTP/2 was requested and the 'h2' package is installed."""
+    if not HTTP2_ENABLED:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Return the process-wide pooled HTTP client, creating it on first use.
+    
+    Reusing one client keeps connections to OpenRouter alive between tool
+    calls, so only the first request pays DNS, TCP and TLS setup.
+    
+    Returns:
+        Shared httpx.AsyncClient instance
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT, write=WRITE_TIMEOUT, pool=POOL_TIMEOUT
+            ),
+            http2=_http2_available(),
+            limits=httpx.Limits(
+                max_connections=POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=POOL_MAX_KEEPALIVE,
+                keepalive_expiry=POOL_KEEPALIVE_EXPIRY
+            )
+        )
+    return _http_client
+
+
+async def close_http_client() -> None:
+    """Close the shared HTTP client and release pooled connections."""
+    global _http_client
+    if _http_client is not None:
+        client, _http_client = _http_client, None
+        await client.aclose()
+
+
+# =============================================================================
+# UPSTREAM RATE GOVERNOR
+# =============================================================================
+
+def _retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    """
+    Read how long to back off from Retry-After or rate-limit headers.
+    
+    Returns:
+        Seconds to wait, or None if the response carries no hint
+    """
+    retry_after = response.headers.get("retry-after")
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after).timestamp()
+                return max(0.0, retry_at - time.time())
+            except (TypeError, ValueError):
+                pass
+    
+    remaining = response.headers.get("x-ratelimit-remaining")
+    reset = response.headers.get("x-ratelimit-reset")
+    if remaining == "0" and reset:
+        try:
+            reset_at = float(reset)
+        except ValueError:
+            return None
+        if reset_at > 1e11:  # OpenRouter reports epoch milliseconds
+            reset_at /= 1000
+        return max(0.0, reset_at - time.time())
+    return None
+
+
+class RateGovernor:
+    """
+    Client-side throttle for upstream calls.
+    
+    Combines a token bucket (requests per second with a burst allowance)
+    with an adaptive concurrency limit: the limit grows additively after
+    successful calls and is halved on HTTP 429/503, and Retry-After or
+    exhausted rate-limit headers pause all new calls. Callers queue for a
+    slot for at most max_wait seconds.
+    """
+    
+    def __init__(
+        self,
+        rate: float = RATE_LIMIT_RPS,
+        burst: int = RATE_LIMIT_BURST,
+        initial_limit: int = CONCURRENCY_INITIAL,
+        max_limit: int = CONCURRENCY_MAX,
+        max_wait: float = QUEUE_MAX_WAIT
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_limit = max_limit
+        self.max_wait = max_wait
+        self.limit = float(min(initial_limit, max_limit))
+        self.in_flight = 0
+        self.waiting = 0
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = asyncio.Condition()
+        self._bucket_lock = asyncio.Lock()
+        self.admitted = 0
+        self.throttled = 0
+        self.queue_timeouts = 0
+        self.wait_total = 0.0
+    
+    def _busy_error(self) -> ValueError:
+        self.queue_timeouts += 1
+        return ValueError(
+            f"Server is busy: no upstream slot became free within {self.max_wait:g} seconds "
+            f"({self.waiting} requests queued). Please try again shortly."
+        )
+    
+    async def _acquire_slot(self, deadline: float) -> None:
+        async with self._cond:
+            while True:
+                now = time.monotonic()
+                paused_for = self._paused_until - now
+                if self.in_flight < int(self.limit) and paused_for <= 0:
+                    self.in_flight += 1
+                    return
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise self._busy_error()
+                timeout = min(remaining, paused_for) if paused_for > 0 else remaining
+                try:
+                    await asyncio.wait_for(self._cond.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+    
+    async def _take_token(self, deadline: float) -> None:
+        if self.rate <= 0:
+            return
+        async with self._bucket_lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    float(self.burst), self._tokens + (now - self._refilled_at) * self.rate
+                )
+                self._refilled_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+                if now + wait > deadline:
+                    raise self._busy_error()
+                await asyncio.sleep(wait)
+    
+    async def _release(self, status_code: Optional[int], retry_after: Optional[float]) -> None:
+        async with self._cond:
+            self.in_flight -= 1
+            if status_code in (429, 503):
+                self.throttled += 1
+                self.limit = max(1.0, self.limit / 2)
+                if retry_after:
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            elif status_code is not None and status_code < 400:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            if retry_after and status_code not in (429, 503):
+                # Rate-limit headers say the window is exhausted
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._cond.notify_all()
+    
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Hold an upstream slot for the duration of one request.
+        
+        Waits at most max_wait seconds, or until the request deadline.
+        
+        Yields:
+            Callable to report the httpx.Response, so the limit can adapt
+            
+        Raises:
+            ValueError: If no slot is available within max_wait seconds
+        """
+        started = time.monotonic()
+        deadline = min(started + self.max_wait, _deadline.get() or float("inf"))
+        self.waiting += 1
+        try:
+            await self._acquire_slot(deadline)
+            try:
+                await self._take_token(deadline)
+            except BaseException:
+                await self._release(None, None)
+                raise
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - started
+        self.admitted += 1
+        self.wait_total += waited
+        QUEUE_WAIT.observe(waited)
+        tracing.record("queue wait", waited)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.queue += waited
+        
+        observed: Dict[str, Any] = {"status": None, "retry_after": None}
+        
+        def observe(response: httpx.Response) -> None:
+            observed["status"] = response.status_code
+            observed["retry_after"] = _retry_after_seconds(response)
+        
+        try:
+            yield observe
+        finally:
+            await self._release(observed["status"], observed["retry_after"])
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return queue depth, current limit and throttle counters."""
+        return {
+            "queue_depth": self.waiting,
+            "in_flight": self.in_flight,
+            "concurrency_limit": round(self.limit, 2),
+            "max_concurrency": self.max_limit,
+            "rate_per_second": self.rate,
+            "paused_for_seconds": round(max(0.0, self._paused_until - time.monotonic()), 2),
+            "admitted": self.admitted,
+            "throttle_events": self.throttled,
+            "queue_timeouts": self.queue_timeouts,
+            "avg_queue_wait_ms": round(self.wait_total / self.admitted * 1000, 1) if self.admitted else 0.0
+        }
+
+
+# =============================================================================
+# UPSTREAM ROUTING
+# =============================================================================
+
+CIRCUIT_STATES = ("closed", "half_open", "open")
+
+
+def is_endpoint_failure(error: BaseException) -> bool:
+    """
+    Return True if an error says the endpoint (not the request) is unwell.
+    
+    Network errors, timeouts, 401/403 (bad or revoked key), 429 and 5xx
+    count against the endpoint; other 4xx answers mean it is healthy.
+    """
+    if not isinstance(error, UpstreamError):
+        return False
+    status = error.status_code
+    return status is None or status in (401, 403, 429) or status >= 500
+
+
+class Endpoint:
+    """
+    One upstream target: an OpenAI-compatible chat completions URL and key.
+    
+    Each endpoint has its own rate governor, since providers rate-limit per
+    key, and a circuit breaker. After failure_threshold consecutive failures,
+    or a single 401/403/429, the endpoint is ejected for a cooldown (or the
+    Retry-After period). It is then half-open and admits one probe request:
+    success closes it again, failure doubles the cooldown.
+    """
+    
+    def __init__(
+        self,
+        name: str,
+        url: str,
+        api_key: Optional[str] = None,
+        api_key_env: str = API_KEY_ENV,
+        weight: float = 1.0,
+        models: Optional[Dict[str, str]] = None,
+        rate: float = RATE_LIMIT_RPS,
+        burst: int = RATE_LIMIT_BURST,
+        failure_threshold: int = UPSTREAM_FAILURE_THRESHOLD,
+        cooldown: float = UPSTREAM_COOLDOWN
+    ):
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.api_key_env = api_key_env
+        self.weight = max(weight, 0.01)
+        self.models = models or {}
+        self.governor = RateGovernor(rate=rate, burst=burst)
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0  # consecutive
+        self.open_until = 0.0
+        self.probing = False
+        self.active = 0
+        self.latency_ewma: Optional[float] = None
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+    
+    def has_key(self) -> bool:
+        return bool(self.api_key or os.getenv(self.api_key_env))
+    
+    def headers(self) -> Dict[str, str]:
+        return build_headers(self.api_key or get_api_key(self.api_key_env))
+    
+    def model_name(self, model: str) -> str:
+        """Translate a model ID for providers that name models differently."""
+        return self.models.get(model, model)
+    
+    def available(self, now: float) -> bool:
+        """Return True if the endpoint may take a request now."""
+        if self.state == "open":
+            return now >= self.open_until
+        if self.state == "half_open":
+            return not self.probing
+        return True
+    
+    def begin(self) -> None:
+        self.active += 1
+        self.requests += 1
+        if self.state == "open" and time.monotonic() >= self.open_until:
+            self.state = "half_open"
+        if self.state == "half_open":
+            self.probing = True
+    
+    def succeeded(self, seconds: Optional[float]) -> None:
+        self.active -= 1
+        self.probing = False
+        self.failures = 0
+        if self.state != "closed":
+            self.state = "closed"
+            self.cooldown = self.base_cooldown
+        if seconds is not None:
+            self.latency_ewma = (
+                seconds if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * seconds
+            )
+    
+    def failed(self, error: "UpstreamError") -> None:
+        self.active -= 1
+        self.errors += 1
+        self.failures += 1
+        status = error.status_code
+        if self.state == "half_open" and self.probing:
+            self.cooldown = min(UPSTREAM_MAX_COOLDOWN, self.cooldown * 2)
+            self._eject(self.cooldown)
+        elif status == 429:
+            self._eject(error.retry_after or self.cooldown)
+        elif status in (401, 403) or self.failures >= self.failure_threshold:
+            self._eject(self.cooldown)
+        self.probing = False
+    
+    def released(self) -> None:
+        """End a request that says nothing about endpoint health (e.g. cancelled)."""
+        self.active -= 1
+        self.probing = False
+    
+    def _eject(self, seconds: float) -> None:
+        if self.state != "open":
+            self.ejections += 1
+        self.state = "open"
+        self.open_until = max(self.open_until, time.monotonic() + seconds)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "url": self.url,
+            "state": self.state,
+            "weight": self.weight,
+            "active": self.active,
+            "requests": self.requests,
+            "failures": self.errors,
+            "consecutive_failures": self.failures,
+            "ejections": self.ejections,
+            "retry_in_seconds": round(max(0.0, self.open_until - time.monotonic()), 1)
+            if self.state == "open" else 0.0,
+            "latency_ewma_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "rate_limiter": self.governor.stats()
+        }
+
+
+class UpstreamRouter:
+    """
+    Spreads upstream requests over endpoints and fails over between them.
+    
+    'least-loaded' picks the available endpoint with the fewest active
+    requests per unit of weight, breaking ties by recent latency; 'ordered'
+    uses the first available endpoint in configuration order. A request
+    that fails with an endpoint failure is retried once on each other
+    available endpoint before the error is returned. If every endpoint is
+    ejected, the one that recovers soonest is still tried rather than
+    failing outright.
+    """
+    
+    def __init__(self, endpoints: List[Endpoint], strategy: str = ROUTING_STRATEGY):
+        if not endpoints:
+            raise ValueError("At least one upstream endpoint is required")
+        if strategy not in ROUTING_STRATEGIES:
+            raise ValueError(f"Unknown routing strategy '{strategy}'")
+        self.endpoints = endpoints
+        self.strategy = strategy
+        self.failovers = 0
+    
+    def choose(self, exclude: List[str]) -> Optional[Endpoint]:
+        """Pick an endpoint not in exclude, or None once failover is exhausted."""
+        now = time.monotonic()
+        candidates = [
+            e for e in self.endpoints if e.name not in exclude and e.available(now)
+        ]
+        if not candidates:
+            if exclude:
+                return None
+            return min(self.endpoints, key=lambda e: e.open_until)
+        if self.strategy == "ordered":
+            return candidates[0]
+        return min(
+            candidates,
+            key=lambda e: ((e.active + 1) / e.weight, e.latency_ewma or 0.0)
+        )
+    
+    async def dispatch(self, send: Callable[[Endpoint], Awaitable[Any]]) -> Any:
+        """
+        Run send(endpoint) on a chosen endpoint, failing over on endpoint errors.
+        
+        Args:
+            send: Coroutine function performing one request against an endpoint
+        
+        Returns:
+            Result of the first successful send
+        
+        Raises:
+            UpstreamError: The last endpoint failure once no endpoint is left
+        """
+        tried: List[str] = []
+        while True:
+            endpoint = self.choose(tried)
+            if endpoint is None:
+                raise last_error
+            if tried:
+                self.failovers += 1
+            tried.append(endpoint.name)
+            endpoint.begin()
+            started = time.perf_counter()
+            try:
+                result = await send(endpoint)
+            except UpstreamError as e:
+                if not is_endpoint_failure(e):
+                    endpoint.succeeded(None)
+                    raise
+                endpoint.failed(e)
+                last_error = e
+                continue
+            except BaseException:
+                endpoint.released()
+                raise
+            endpoint.succeeded(time.perf_counter() - started)
+            return result
+    
+    def has_credentials(self) -> bool:
+        return any(e.has_key() for e in self.endpoints)
+    
+    def total(self, field: str) -> float:
+        """Sum a rate governor attribute over all endpoints."""
+        return sum(getattr(e.governor, field) for e in self.endpoints)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "strategy": self.strategy,
+            "failovers": self.failovers,
+            "endpoints": [e.stats() for e in self.endpoints]
+        }
+
+
+def _endpoint_from_spec(n: int, spec: Any) -> Endpoint:
+    """Build the n-th SONAR_UPSTREAMS endpoint; raises ValueError or TypeError if invalid."""
+    if not isinstance(spec, dict):
+        raise ValueError("expected a JSON object")
+    url = spec.get("url", OPENROUTER_API_URL)
+    if not isinstance(url, str) or not url.startswith(("http://", "https://")):
+        raise ValueError(f"invalid url {url!r}")
+    models = spec.get("models")
+    if models is not None and not (
+        isinstance(models, dict) and all(isinstance(v, str) for v in models.values())
+    ):
+        raise ValueError("models must map model IDs to provider model names")
+    for field in ("name", "api_key", "api_key_env"):
+        if spec.get(field) is not None and not isinstance(spec[field], str):
+            raise ValueError(f"{field} must be a string")
+    return Endpoint(
+        name=spec.get("name") or f"upstream-{n}",
+        url=url,
+        api_key=spec.get("api_key"),
+        api_key_env=spec.get("api_key_env", API_KEY_ENV),
+        weight=float(spec.get("weight", 1.0)),
+        models=models,
+        rate=float(spec.get("rate_limit_rps", RATE_LIMIT_RPS)),
+        burst=int(spec.get("rate_limit_burst", RATE_LIMIT_BURST))
+    )
+
+
+def _configured_endpoints(config: str) -> List[Endpoint]:
+    """Endpoints from a SONAR_UPSTREAMS value; invalid entries are logged and skipped."""
+    try:
+        specs = json.loads(config)
+    except ValueError as e:
+        logger.warning("Ignoring SONAR_UPSTREAMS: invalid JSON (%s)", e)
+        return []
+    if not isinstance(specs, list):
+        logger.warning("Ignoring SONAR_UPSTREAMS: expected a JSON list, got %r", specs)
+        return []
+    endpoints: List[Endpoint] = []
+    for n, spec in enumerate(specs, 1):
+        try:
+            endpoint = _endpoint_from_spec(n, spec)
+        except (TypeError, ValueError) as e:
+            logger.warning("Ignoring SONAR_UPSTREAMS entry %d: %s", n, e)
+            continue
+        if any(e.name == endpoint.name for e in endpoints):
+            logger.warning("Ignoring SONAR_UPSTREAMS entry %d: duplicate name %r", n, endpoint.name)
+            continue
+        endpoints.append(endpoint)
+    return endpoints
+
+
+def _load_endpoints() -> List[Endpoint]:
+    """
+    Build the endpoint list from the environment.
+    
+    SONAR_UPSTREAMS (a JSON list) takes precedence, then OPENROUTER_API_KEYS
+    (one OpenRouter endpoint per key); otherwise a single endpoint uses
+    OPENROUTER_API_URL and OPENROUTER_API_KEY. If SONAR_UPSTREAMS has no
+    usable entry, the next option is used.
+    """
+    if UPSTREAMS_CONFIG:
+        endpoints = _configured_endpoints(UPSTREAMS_CONFIG)
+        if endpoints:
+            return endpoints
+        logger.warning("No usable SONAR_UPSTREAMS entries; using the default endpoint")
+    keys = [key.strip() for key in os.getenv(API_KEYS_ENV, "").split(",") if key.strip()]
+    if keys:
+        return [
+            Endpoint(f"openrouter-{n}", OPENROUTER_API_URL, api_key=key)
+            for n, key in enumerate(keys, 1)
+        ]
+    return [Endpoint("openrouter", OPENROUTER_API_URL)]
+
+
+upstream_router = UpstreamRouter(_load_endpoints())
+
+
+# =============================================================================
+# HELPER FUNCTIONS
+# =============================================================================
+
+def get_api_key(env: str = API_KEY_ENV) -> str:
+    """
+    Get OpenRouter API key from environment.
+    
+    Args:
+        env: Environment variable holding the key
+        
+    Returns:
+        API key string
+        
+    Raises:
+        ValueError: If API key not found
+    """
+    api_key = os.getenv(env)
+    if not api_key:
+        raise ValueError(
+            f"OpenRouter API key not found. Please set the {env} environment variable.\n"
+            f"Get your key at: https://openrouter.ai/keys\n\n"
+            f"In Docker, set it in your .env file:\n"
+            f"OPENROUTER_API_KEY=your_key_here"
+        )
+    return api_key
+
+
+def build_headers(api_key: Optional[str] = None) -> Dict[str, str]:
+    """Build OpenRouter request headers, including the API key."""
+    return {
+        "Authorization": f"Bearer {api_key or get_api_key()}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": "https://github.com/sonar-mcp-server",
+        "X-Title": "Sonar MCP Server"
+    }
+
+
+class UpstreamError(ValueError):
+    """
+    Failed upstream request.
+    
+    Subclasses ValueError so tools surface it like any other input/API
+    error, while keeping the HTTP status and back-off hint for the retry
+    engine. The original httpx exception is chained as __cause__.
+    """
+    
+    def __init__(
+        self,
+        message: str,
+        status_code: Optional[int] = None,
+        retry_after: Optional[float] = None
+    ):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def api_error(error: Exception) -> UpstreamError:
+    """
+    Translate an httpx error into a user-facing UpstreamError.
+    
+    Args:
+        error: httpx.HTTPStatusError or httpx.TransportError
+        
+    Returns:
+        UpstreamError with an actionable message
+    """
+    if isinstance(error, httpx.TimeoutException):
+        phase = {
+            httpx.ConnectTimeout: "connecting to",
+            httpx.WriteTimeout: "sending the request to",
+            httpx.PoolTimeout: "waiting for a free connection to"
+        }.get(type(error), "waiting for a response from")
+        return UpstreamError(
+            f"Request timed out while {phase} OpenRouter. "
+            "Try a shorter query, reduce max_tokens or allow a longer timeout_seconds."
+        )
+    if isinstance(error, httpx.TransportError):
+        return UpstreamError(f"Could not reach OpenRouter: {error!r}. Please try again later.")
+    
+    status_code = error.response.status_code
+    retry_after = _retry_after_seconds(error.response)
+    if status_code == 401:
+        return UpstreamError(
+            "Authentication failed. Please check your OPENROUTER_API_KEY. "
+            "Get a key at: https://openrouter.ai/keys",
+            status_code
+        )
+    elif status_code == 429:
+        return UpstreamError(
+            "Rate limit exceeded. Please wait a moment and try again. "
+            "Consider upgrading your OpenRouter plan for higher limits.",
+            status_code, retry_after
+        )
+    elif status_code >= 500:
+        return UpstreamError(
+            f"OpenRouter service error ({status_code}). Please try again later.",
+            status_code, retry_after
+        )
+    else:
+        return UpstreamError(
+            f"API request failed with status {status_code}: {error.response.text}",
+            status_code
+        )
+
+
+def stream_error(error: Any) -> UpstreamError:
+    """
+    Translate an error chunk received inside an SSE stream.
+    
+    OpenRouter reports failures after the 200 response has started as
+    {"error": {"code": ..., "message": ...}}. A numeric code is kept as the
+    status, so retries, failover and breakers treat it like an HTTP error.
+    """
+    details = error if isinstance(error, dict) else {"message": error}
+    try:
+        status_code: Optional[int] = int(details.get("code"))
+    except (TypeError, ValueError):
+        status_code = None
+    if status_code is not None and not 400 <= status_code <= 599:
+        status_code = None
+    message = details.get("message") or "unknown error"
+    if status_code is None:
+        return UpstreamError(f"OpenRouter stream error: {message}")
+    return UpstreamError(f"OpenRouter stream error ({status_code}): {message}", status_code)
+
+
+async def call_openrouter(
+    messages: List[Dict[str, str]],
+    model: str,
+    max_tokens: int,
+    temperature: float = 0.2
+) -> Dict[str, Any]:
+    """
+    Make an API request to OpenRouter (or another configured endpoint).
+    
+    The request goes to the endpoint chosen by upstream_router and fails
+    over to the next one on network errors, 401/403, 429 or 5xx. The
+    model's circuit breaker fails fast, or switches to the fallback model,
+    while the model keeps failing.
+    
+    Args:
+        messages: List of message dicts with 'role' and 'content'
+        model: Model identifier (e.g., 'perplexity/sonar-pro')
+        max_tokens: Maximum tokens in response
+        temperature: Response temperature (0.0-1.0)
+        
+    Returns:
+        API response dictionary with 'choices', 'usage', etc.
+        
+    Raises:
+        UpstreamError: On HTTP errors (401, 429, 500, etc.), network errors or timeout
+        CircuitOpenError: If the model's circuit is open and no fallback is available
+    """
+    payload = {
+        "model": model,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": temperature
+    }
+    
+    @tracing.upstream_attempt(max_tokens)
+    async def send(endpoint: Endpoint, model: str) -> Dict[str, Any]:
+        try:
+            client = get_http_client()
+            async with endpoint.governor.slot() as observe:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(
+                        endpoint.url,
+                        json={**payload, "model": endpoint.model_name(model)},
+                        headers=endpoint.headers(),
+                        timeout=request_timeout(model, max_tokens),
+                        extensions=tracing.http_extensions()
+                    )
+                except httpx.TransportError as e:
+                    record_upstream(model, classify_error(e), time.perf_counter() - started, None)
+                    raise
+                observe(response)
+            elapsed = time.perf_counter() - started
+            response.raise_for_status()
+            result = response.json()
+            record_upstream(model, str(response.status_code), elapsed, result.get("usage"))
+            adaptive_timeouts.record(model, max_tokens, elapsed)
+            return result
+            
+        except httpx.HTTPStatusError as e:
+            record_upstream(model, str(e.response.status_code), elapsed, None)
+            raise api_error(e) from e
+        except httpx.TransportError as e:
+            raise api_error(e) from e
+    
+    return await model_breakers.call(
+        model, lambda target: upstream_router.dispatch(functools.partial(send, model=target))
+    )
+
+
+class StreamStats:
+    """Running time-to-first-token and duration figures for streamed calls."""
+    
+    def __init__(self):
+        self.streams = 0
+        self.ttft_total = 0.0
+        self.ttft_max = 0.0
+        self.duration_total = 0.0
+    
+    def record(self, ttft: float, duration: float) -> None:
+        self.streams += 1
+        self.ttft_total += ttft
+        self.ttft_max = max(self.ttft_max, ttft)
+        self.duration_total += duration
+    
+    def stats(self) -> Dict[str, Any]:
+        if not self.streams:
+            return {"streams": 0}
+        return {
+            "streams": self.streams,
+            "ttft_avg_ms": round(self.ttft_total / self.streams * 1000, 1),
+            "ttft_max_ms": round(self.ttft_max * 1000, 1),
+            "duration_avg_ms": round(self.duration_total / self.streams * 1000, 1)
+        }
+
+
+stream_stats = StreamStats()
+
+ProgressCallback = Callable[[int, str], Awaitable[None]]
+
+
+async def call_openrouter_stream(
+    messages: List[Dict[str, str]],
+    model: str,
+    max_tokens: int,
+    temperature: float = 0.2,
+    on_progress: Optional[ProgressCallback] = None
+) -> Dict[str, Any]:
+    """
+    Make a streaming (SSE) API request to OpenRouter.
+    
+    Routed, failed over and circuit-broken like call_openrouter; a failed
+    attempt's partial output is discarded. Content deltas are collected in a list and joined once at the end. The
+    result has the same shape as a non-streaming response, so callers can
+    use extract_content() and get_usage_info() unchanged.
+    
+    Args:
+        messages: List of message dicts with 'role' and 'content'
+        model: Model identifier (e.g., 'perplexity/sonar-pro')
+        max_tokens: Maximum tokens in response
+        temperature: Response temperature (0.0-1.0)
+        on_progress: Optional async callback(estimated_tokens, message),
+            called at most every STREAM_PROGRESS_INTERVAL seconds
+        
+    Returns:
+        API response dictionary with 'choices', 'usage', etc.
+        
+    Raises:
+        UpstreamError: On HTTP errors, network errors, timeout or an error chunk
+        ValueError: On a malformed stream
+    """
+    payload = {
+        "model": model,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "stream": True
+    }
+    
+    @tracing.upstream_attempt(max_tokens, stream=True)
+    async def send(endpoint: Endpoint, model: str) -> Dict[str, Any]:
+        parts: List[str] = []
+        annotations: List[Dict[str, Any]] = []
+        received_chars = 0
+        final: Dict[str, Any] = {}
+        started = time.perf_counter()
+        first_token_at: Optional[float] = None
+        
+        try:
+            client = get_http_client()
+            async with endpoint.governor.slot() as observe:
+                started = last_progress = time.perf_counter()
+                async with client.stream(
+                    "POST", endpoint.url,
+                    json={**payload, "model": endpoint.model_name(model)},
+                    headers=endpoint.headers(),
+                    timeout=request_timeout(model, max_tokens, stream=True),
+                    extensions=tracing.http_extensions()
+                ) as response:
+                    observe(response)
+                    if response.is_error:
+                        await response.aread()
+                    response.raise_for_status()
+                    
+                    async for line in response.aiter_lines():
+                        # SSE comments (": OPENROUTER PROCESSING") and blank separators
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        chunk = json.loads(data)
+                        if "error" in chunk:
+                            error = stream_error(chunk["error"])
+                            status = str(error.status_code) if error.status_code else classify_error(error)
+                            record_upstream(model, status, time.perf_counter() - started, None)
+                            raise error
+                        for key in ("id", "model", "usage", "citations", "search_results"):
+                            if chunk.get(key):
+                                final[key] = chunk[key]
+                        
+                        choices = chunk.get("choices") or [{}]
+                        annotations.extend(choices[0].get("delta", {}).get("annotations") or ())
+                        delta = choices[0].get("delta", {}).get("content")
+                        if not delta:
+                            continue
+                        now = time.perf_counter()
+                        if first_token_at is None:
+                            first_token_at = now
+                        parts.append(delta)
+                        received_chars += len(delta)
+                        
+                        if on_progress and now - last_progress >= STREAM_PROGRESS_INTERVAL:
+                            last_progress = now
+                            tokens = received_chars // 4
+                            try:
+                                await on_progress(tokens, f"Receiving response (~{tokens} tokens)")
+                            except Exception as e:
+                                # Progress is best effort; it must not abort the stream
+                                logger.debug("Stream progress callback failed: %s", e)
+        
+        except httpx.HTTPStatusError as e:
+            record_upstream(model, str(e.response.status_code), time.perf_counter() - started, None)
+            raise api_error(e) from e
+        except httpx.TransportError as e:
+            record_upstream(model, classify_error(e), time.perf_counter() - started, None)
+            raise api_error(e) from e
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid chunk in OpenRouter stream: {e}")
+        
+        finished = time.perf_counter()
+        ttft = (first_token_at or finished) - started
+        stream_stats.record(ttft, finished - started)
+        TIME_TO_FIRST_TOKEN.observe(ttft, model)
+        record_upstream(model, "200", finished - started, final.get("usage"))
+        
+        message = {"role": "assistant", "content": "".join(parts)}
+        if annotations:
+            message["annotations"] = annotations
+        final["choices"] = [{"message": message}]
+        return final
+    
+    return await model_breakers.call(
+        model, lambda target: upstream_router.dispatch(functools.partial(send, model=target))
+    )
+
+
+def extract_content(response: Dict[str, Any]) -> str:
+    """
+    Extract content from OpenRouter API response.
+    
+    Args:
+        response: API response dictionary
+        
+    Returns:
+        Extracted content string
+        
+    Raises:
+        ValueError: If response structure is invalid
+    """
+    try:
+        return response["choices"][0]["message"]["content"]
+    except (KeyError, IndexError) as e:
+        raise ValueError(f"Invalid API response structure: {e}\nResponse: {response}")
+
+
 def get_usage_info(response: Dict[str, Any]) -> Optional[Dict[str, int]]:
     """
-    Extract token usage information from API response.
+    Extract token usage information from API response.
+    
+    Args:
+        response: API response dictionary
+        
+    Returns:
+        Dictionary with token usage info or None if not available
+    """
+    try:
+        usage = response.get("usage", {})
+        return {
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0),
+            "total_tokens": usage.get("total_tokens", 0)
+        }
+    except Exception:
+        return None
+
+
+def served_model(response: Dict[str, Any], requested: str) -> str:
+    """Return the model that produced a response (differs after a fallback)."""
+    return response.get("model", requested) if response.get("fallback_from") else requested
+
+
+def get_citations(response: Dict[str, Any]) -> List[str]:
+    """
+    Extract the source URLs Sonar returns alongside the answer.
+    
+    Args:
+        response: API response dictionary
+        
+    Returns:
+        List of citation URLs (empty if none); [n] markers in the content
+        refer to the n-th entry
+    """
+    citations = response.get("citations")
+    return [str(url) for url in citations] if isinstance(citations, list) else []
+
+
+_CITATION_MARKER = re.compile(r"\[(\d+)\]")
+
+
+def renumber_citations(content: str, mapping: Dict[int, int]) -> str:
+    """Rewrite [n] markers in content to [mapping[n]]; unmapped markers are kept."""
+    def renumber(match: "re.Match[str]") -> str:
+        index = int(match.group(1))
+        return f"[{mapping[index]}]" if index in mapping else match.group(0)
+    
+    return _CITATION_MARKER.sub(renumber, content)
+
+
+def extract_citations(response: Dict[str, Any]) -> Tuple[List[Dict[str, str]], Dict[int, int]]:
+    """
+    Build the deduplicated source list of a response.
+    
+    Sources come from the 'citations' URL list (which the [n] markers refer
+    to), Perplexity's 'search_results' and OpenRouter's url_citation
+    annotations; titles and dates are taken from whichever provides them.
+    Each URL appears once.
+    
+    Args:
+        response: API response dictionary
+        
+    Returns:
+        Tuple of (citations as dicts with 'url' and, when known, 'title' and
+        'date'; marker mapping from the response's [n] to the position in
+        that list, for renumber_citations)
+    """
+    positions: Dict[str, int] = {}
+    mapping = {
+        index: positions.setdefault(url, len(positions) + 1)
+        for index, url in enumerate(get_citations(response), 1)
+    }
+    sources = {url: {"url": url} for url in positions}
+    
+    details = list(response.get("search_results") or [])
+    try:
+        annotations = response["choices"][0]["message"].get("annotations") or []
+    except (KeyError, IndexError, AttributeError):
+        annotations = []
+    details += [a.get("url_citation") or {} for a in annotations if isinstance(a, dict)]
+    for detail in details:
+        if not isinstance(detail, dict) or not detail.get("url"):
+            continue
+        source = sources.setdefault(str(detail["url"]), {"url": str(detail["url"])})
+        for field in ("title", "date"):
+            if detail.get(field) and field not in source:
+                source[field] = str(detail[field])
+    return list(sources.values()), mapping
+
+
+def extract_answer(response: Dict[str, Any]) -> Tuple[str, List[Dict[str, str]]]:
+    """
+    Extract the answer text and its deduplicated citations.
+    
+    [n] markers in the text are renumbered when duplicate URLs were merged,
+    so [n] always refers to the n-th citation.
+    
+    Args:
+        response: API response dictionary
+        
+    Returns:
+        Tuple of (content, citations)
+        
+    Raises:
+        ValueError: If response structure is invalid
+    """
+    content = extract_content(response)
+    citations, mapping = extract_citations(response)
+    if any(index != position for index, position in mapping.items()):
+        content = renumber_citations(content, mapping)
+    return content, citations
+
+
+def format_sources(citations: List[Dict[str, str]]) -> str:
+    """Markdown source list: one '[n] title - url' line per citation."""
+    return "\n".join(
+        f"[{n}] {c['title']} - {c['url']}" if c.get("title") else f"[{n}] {c['url']}"
+        for n, c in enumerate(citations, 1)
+    )
+
+
+def _import_orjson() -> Optional[Any]:
+    """Return the 'orjson' module if it is installed, else None."""
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson
+
+
+_orjson = _import_orjson()
+
+
+def dump_json(data: Any) -> str:
+    """
+    Serialize a tool result: compact by default, indented with SONAR_JSON_PRETTY.
+    
+    Uses orjson when it is installed, the standard library otherwise; both
+    keep non-ASCII text unescaped.
+    """
+    if _orjson is not None:
+        option = _orjson.OPT_NON_STR_KEYS | (_orjson.OPT_INDENT_2 if JSON_PRETTY else 0)
+        return _orjson.dumps(data, option=option).decode()
+    if JSON_PRETTY:
+        return json.dumps(data, indent=2, ensure_ascii=False)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+def format_markdown_response(
+    content: str, 
+    metadata: Optional[Dict[str, Any]] = None,
+    citations: Optional[List[Dict[str, str]]] = None
+) -> str:
+    """
+    Format response as Markdown with optional metadata header.
+    
+    Args:
+        content: Main content
+        metadata: Optional metadata (model, tokens, timestamp, etc.); a
+            'page' entry (from paginate()) adds a note on fetching the rest
+        citations: Optional sources, listed once after the content
+        
+    Returns:
+        Formatted Markdown string
+    """
+    output = []
+    
+    if metadata:
+        output.append("---")
+        if metadata.get("model"):
+            model = metadata["model"]
+            if metadata.get("fallback_from"):
+                model += f" (fallback for {metadata['fallback_from']})"
+            output.append(f"**Model:** {model}")
+        if metadata.get("tokens"):
+            tokens = metadata["tokens"]
+            output.append(
+                f"**Tokens:** {tokens.get('total_tokens', 0)} "
+                f"(prompt: {tokens.get('prompt_tokens', 0)}, "
+                f"completion: {tokens.get('completion_tokens', 0)})"
+            )
+        if metadata.get("cached"):
+            output.append("**Cache:** hit")
+        if metadata.get("session"):
+            session = metadata["session"]
+            output.append(
+                f"**Session:** {session['id']}, turn {session['turn']} "
+                f"(history: ~{session['history_tokens']} tokens)"
+            )
+        if metadata.get("timestamp"):
+            output.append(f"**Timestamp:** {metadata['timestamp']}")
+        if metadata.get("timings_ms"):
+            output.append("**Timings:** " + ", ".join(
+                f"{stage} {ms:g} ms" for stage, ms in metadata["timings_ms"].items()
+            ))
+        output.append("---\n")
+    
+    output.append(content)
+    
+    if metadata and metadata.get("page"):
+        output.append(page_footer(metadata["page"]))
+    
+    if citations:
+        output.append("\n## Sources\n\n" + format_sources(citations))
+    
+    return '\n'.join(output)
+
+
+def format_json_response(
+    content: str, 
+    metadata: Optional[Dict[str, Any]] = None,
+    citations: Optional[List[Dict[str, str]]] = None
+) -> str:
+    """
+    Format response as a structured JSON result.
+    
+    Schema: 'answer' (text with [n] markers), 'citations' (each source once;
+    [n] refers to the n-th entry), 'model', 'usage', 'metadata' (the other
+    tool-specific fields; unset ones are left out; 'page' says where the
+    next page of a long answer starts) and 'timestamp'.
+    
+    Args:
+        content: Main content
+        metadata: Optional metadata ('model' and 'tokens' are lifted out)
+        citations: Optional deduplicated sources
+        
+    Returns:
+        JSON string
+    """
+    metadata = {k: v for k, v in (metadata or {}).items() if v is not None}
+    result = {
+        "answer": content,
+        "citations": citations or [],
+        "model": metadata.pop("model", None),
+        "usage": metadata.pop("tokens", None)
+    }
+    if metadata:
+        result["metadata"] = metadata
+    result["timestamp"] = datetime.utcnow().isoformat() + "Z"
+    
+    return dump_json(result)
+
+
+# =============================================================================
+# MODEL CIRCUIT BREAKERS
+# =============================================================================
+
+class CircuitOpenError(UpstreamError):
+    """Call rejected without contacting the upstream because a circuit is open."""
+
+
+def is_model_failure(error: BaseException) -> bool:
+    """
+    Return True if an error suggests the model itself is degraded.
+    
+    Timeouts, network errors and 5xx count; 429, auth and other 4xx
+    answers describe the key or the request, not the model.
+    """
+    if not isinstance(error, UpstreamError) or isinstance(error, CircuitOpenError):
+        return False
+    return error.status_code is None or error.status_code >= 500
+
+
+class CircuitBreaker:
+    """
+    Failure-rate and slow-call circuit breaker for one model.
+    
+    Outcomes from the last `window` seconds are kept. Once at least
+    `min_calls` are recorded, the circuit opens when the failure rate or
+    the share of calls slower than `slow_call` seconds reaches its
+    threshold. While open, calls fail immediately. After `open_seconds`
+    the circuit is half-open and admits `probes` concurrent trial calls:
+    if all succeed it closes, and any failure opens it again.
+    """
+    
+    def __init__(
+        self,
+        name: str,
+        window: float = BREAKER_WINDOW,
+        min_calls: int = BREAKER_MIN_CALLS,
+        failure_rate: float = BREAKER_FAILURE_RATE,
+        slow_call: float = BREAKER_SLOW_CALL,
+        slow_rate: float = BREAKER_SLOW_RATE,
+        open_seconds: float = BREAKER_OPEN_SECONDS,
+        probes: int = BREAKER_HALF_OPEN_PROBES
+    ):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.probes = max(1, probes)
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.outcomes: "deque[Tuple[float, bool, bool]]" = deque()  # (time, failed, slow)
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+        self.rejected = 0
+    
+    def _transition(self, state: str) -> None:
+        self.state = state
+        CIRCUIT_TRANSITIONS.inc(self.name, state)
+        if state == "open":
+            self.opened_at = time.monotonic()
+        elif state == "half_open":
+            self.probes_in_flight = 0
+            self.probe_successes = 0
+        else:
+            self.outcomes.clear()
+    
+    def retry_in(self) -> float:
+        """Seconds until an open circuit admits probes."""
+        return max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+    
+    def allow(self) -> bool:
+        """Admit a call, or return False (and count it) to fail fast."""
+        if self.state == "open":
+            if self.retry_in() > 0:
+                self.rejected += 1
+                return False
+            self._transition("half_open")
+        if self.state == "half_open":
+            if self.probes_in_flight >= self.probes:
+                self.rejected += 1
+                return False
+            self.probes_in_flight += 1
+        return True
+    
+    def record(self, failed: bool, seconds: float) -> None:
+        """Record the outcome of an admitted call."""
+        slow = seconds >= self.slow_call
+        if self.state == "half_open":
+            self.probes_in_flight = max(0, self.probes_in_flight - 1)
+            if failed or slow:
+                self._transition("open")
+            else:
+                self.probe_successes += 1
+                if self.probe_successes >= self.probes:
+                    self._transition("closed")
+            return
+        if self.state == "open":
+            return
+        
+        now = time.monotonic()
+        self.outcomes.append((now, failed, slow))
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            self.outcomes.popleft()
+        calls = len(self.outcomes)
+        if calls < self.min_calls:
+            return
+        failures = sum(1 for _, f, _ in self.outcomes if f)
+        slow_calls = sum(1 for _, _, s in self.outcomes if s)
+        if failures / calls >= self.failure_rate or slow_calls / calls >= self.slow_rate:
+            self._transition("open")
+    
+    def release(self) -> None:
+        """End an admitted call that says nothing about model health."""
+        if self.state == "half_open":
+            self.probes_in_flight = max(0, self.probes_in_flight - 1)
+    
+    def stats(self) -> Dict[str, Any]:
+        calls = len(self.outcomes)
+        return {
+            "state": self.state,
+            "recent_calls": calls,
+            "recent_failure_rate": round(sum(1 for _, f, _ in self.outcomes if f) / calls, 2) if calls else 0.0,
+            "retry_in_seconds": round(self.retry_in(), 1) if self.state == "open" else 0.0,
+            "rejected": self.rejected
+        }
+
+
+class ModelBreakers:
+    """
+    Circuit breakers keyed by model, with optional fallback models.
+    
+    While a model's circuit is open, calls go to its fallback model (if
+    configured and that circuit admits them) and the response is marked
+    with 'fallback_from'; otherwise they fail fast with CircuitOpenError.
+    """
+    
+    def __init__(self, fallbacks: Optional[Dict[str, str]] = None):
+        self.fallbacks = fallbacks or {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+    
+    def get(self, model: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker(model)
+        return breaker
+    
+    async def _run(
+        self,
+        breaker: CircuitBreaker,
+        call: Callable[[str], Awaitable[Dict[str, Any]]],
+        model: str
+    ) -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            result = await call(model)
+        except Exception as e:
+            if is_model_failure(e):
+                breaker.record(True, time.perf_counter() - started)
+            else:
+                breaker.release()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record(False, time.perf_counter() - started)
+        return result
+    
+    async def call(
+        self,
+        model: str,
+        call: Callable[[str], Awaitable[Dict[str, Any]]]
+    ) -> Dict[str, Any]:
+        """
+        Run call(model) through the model's breaker.
+        
+        Args:
+            model: Requested model
+            call: Coroutine function performing the request for a given model
+        
+        Returns:
+            API response dictionary ('fallback_from' is set if another model answered)
+        
+        Raises:
+            CircuitOpenError: If the circuit is open and no fallback is available
+        """
+        breaker = self.get(model)
+        if breaker.allow():
+            return await self._run(breaker, call, model)
+        
+        fallback = self.fallbacks.get(model)
+        if fallback and fallback != model:
+            fallback_breaker = self.get(fallback)
+            if fallback_breaker.allow():
+                MODEL_FALLBACK_CALLS.inc(model, fallback)
+                result = await self._run(fallback_breaker, call, fallback)
+                result["model"] = fallback
+                result["fallback_from"] = model
+                return result
+        raise CircuitOpenError(
+            f"{model} is temporarily unavailable after repeated failures; "
+            f"failing fast for another {breaker.retry_in():.0f} seconds. Please try again later."
+        )
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "fallbacks": self.fallbacks,
+            "models": {model: breaker.stats() for model, breaker in self.breakers.items()}
+        }
+
+
+model_breakers = ModelBreakers(MODEL_FALLBACKS)
+
+
+# =============================================================================
+# RETRY ENGINE
+# =============================================================================
+
+_RETRY_EXCEPTION_TYPES = {
+    "timeout": httpx.TimeoutException,
+    "connect": httpx.ConnectError,
+    "network": httpx.NetworkError,
+    "protocol": httpx.RemoteProtocolError
+}
+RETRY_EXCEPTIONS = _env_list(
+    "SONAR_RETRY_ON", "timeout,network,protocol", _RETRY_EXCEPTION_TYPES.__getitem__,
+    f"one of {', '.join(_RETRY_EXCEPTION_TYPES)}"
+)
+
+
+class RetryPolicy:
+    """
+    Which upstream failures to retry, and how long to back off.
+    
+    Delays use exponential backoff with full jitter: a random value between
+    0 and min(max_delay, base_delay * 2**attempt), raised to the server's
+    Retry-After hint when one is given.
+    """
+    
+    def __init__(
+        self,
+        max_attempts: int = RETRY_MAX_ATTEMPTS,
+        retry_statuses: Tuple[int, ...] = RETRY_STATUSES,
+        retry_exceptions: Tuple[type, ...] = RETRY_EXCEPTIONS,
+        base_delay: float = RETRY_BASE_DELAY,
+        max_delay: float = RETRY_MAX_DELAY
+    ):
+        self.max_attempts = max_attempts
+        self.retry_statuses = retry_statuses
+        self.retry_exceptions = retry_exceptions
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    def is_retryable(self, error: BaseException) -> bool:
+        """Return True if the error is a transient upstream failure."""
+        if isinstance(error, UpstreamError):
+            if error.status_code is not None:
+                return error.status_code in self.retry_statuses
+            return isinstance(error.__cause__, self.retry_exceptions)
+        return isinstance(error, self.retry_exceptions)
+    
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Return the delay before retry number attempt (1-based)."""
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        delay = random.uniform(0, ceiling)
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
+
+class RetryBudget:
+    """
+    Process-wide cap on extra upstream requests (retries and hedges).
+    
+    Every first attempt deposits `ratio` tokens and every extra request
+    withdraws one, so during an outage retries add at most about `ratio`
+    extra load instead of multiplying it.
+    """
+    
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, capacity: float = RETRY_BUDGET_CAPACITY):
+        self.ratio = ratio
+        self.capacity = capacity
+        self.tokens = capacity
+        self.spent = 0
+        self.exhausted = 0
+    
+    def deposit(self) -> None:
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+    
+    def try_spend(self) -> bool:
+        """Withdraw one token; False if the budget is used up."""
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.spent += 1
+            return True
+        self.exhausted += 1
+        return False
+
+
+class LatencyWindow:
+    """Rolling window of recent latencies for percentile estimates."""
+    
+    def __init__(self, size: int = 200):
+        self.samples: "deque[float]" = deque(maxlen=size)
+    
+    def record(self, seconds: float) -> None:
+        self.samples.append(seconds)
+    
+    def percentile(self, fraction: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+retry_policy = RetryPolicy()
+retry_budget = RetryBudget()
+hedge_latencies: Dict[str, LatencyWindow] = {}
+retry_stats = {"retries": 0, "gave_up_deadline": 0, "hedges": 0, "hedge_wins": 0}
+
+
+async def _hedged(call: Callable[[], Awaitable[Any]], delay: float) -> Any:
+    """
+    Run call(); if it has not finished after `delay` seconds, start a second
+    copy and return whichever succeeds first, cancelling the other.
+    """
+    primary = asyncio.ensure_future(call())
+    tasks = {primary}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done or not retry_budget.try_spend():
+            return await primary
+        
+        retry_stats["hedges"] += 1
+        tasks.add(asyncio.ensure_future(call()))
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        retry_stats["hedge_wins"] += 1
+                    return task.result()
+            if not tasks:
+                # Every copy failed; prefer the primary's error
+                return (primary if primary in done else done.pop()).result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def call_with_retries(
+    attempt: Callable[[], Awaitable[Any]],
+    deadline: Optional[float] = None,
+    policy: Optional[RetryPolicy] = None,
+    hedge_key: Optional[str] = None
+) -> Any:
+    """
+    Run an upstream call with retries, a retry budget and a total deadline.
+    
+    Args:
+        attempt: Coroutine factory performing one upstream request
+        deadline: time.monotonic() value no attempt or back-off may pass
+            (default: the current request deadline, else REQUEST_DEADLINE)
+        policy: Retry policy (defaults to the configured one)
+        hedge_key: If set, hedge each attempt after the p95 latency
+            observed for this key
+        
+    Returns:
+        Result of the first successful attempt
+        
+    Raises:
+        UpstreamError: The last failure once retries, budget or time run out
+    """
+    policy = policy or retry_policy
+    if deadline is None:
+        deadline = current_deadline() or time.monotonic() + REQUEST_DEADLINE
+    retry_budget.deposit()
+    # Attempts size their httpx timeouts from the deadline
+    token = _deadline.set(deadline)
+    try:
+        return await _retry_loop(attempt, deadline, policy, hedge_key)
+    finally:
+        _deadline.reset(token)
+
+
+async def _retry_loop(
+    attempt: Callable[[], Awaitable[Any]],
+    deadline: float,
+    policy: RetryPolicy,
+    hedge_key: Optional[str]
+) -> Any:
+    """Attempt loop of call_with_retries."""
+    for number in range(1, policy.max_attempts + 1):
+        remaining = deadline - time.monotonic()
+        started = time.monotonic()
+        try:
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            if hedge_key is not None:
+                window = hedge_latencies.setdefault(hedge_key, LatencyWindow())
+                p95 = window.percentile(0.95) if len(window.samples) >= HEDGE_MIN_SAMPLES else None
+                result = await asyncio.wait_for(
+                    _hedged(attempt, p95 or HEDGE_DEFAULT_DELAY), remaining
+                )
+                window.record(time.monotonic() - started)
+                return result
+            return await asyncio.wait_for(attempt(), remaining)
+        
+        except asyncio.TimeoutError as e:
+            error: Exception = UpstreamError(
+                "Request deadline exceeded before OpenRouter answered. "
+                "Try a shorter query, reduce max_tokens or allow a longer timeout_seconds."
+            )
+            error.__cause__ = e
+            retry_stats["gave_up_deadline"] += 1
+            raise error
+        
+        except Exception as e:
+            if number == policy.max_attempts or not policy.is_retryable(e):
+                raise
+            delay = policy.backoff(number, getattr(e, "retry_after", None))
+            if time.monotonic() + delay >= deadline:
+                retry_stats["gave_up_deadline"] += 1
+                raise
+            if not retry_budget.try_spend():
+                raise
+            retry_stats["retries"] += 1
+            await asyncio.sleep(delay)
+
+
+def retry_engine_stats() -> Dict[str, Any]:
+    """Return retry, hedge and budget counters."""
+    return {
+        **retry_stats,
+        "budget_tokens": round(retry_budget.tokens, 2),
+        "budget_exhausted": retry_budget.exhausted,
+        "hedge_delays_ms": {
+            key: round((window.percentile(0.95) or 0) * 1000, 1)
+            for key, window in hedge_latencies.items()
+        }
+    }
+
+
+# =============================================================================
+# TIMEOUTS AND DEADLINES
+# =============================================================================
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("sonar_deadline", default=None)
+
+
+def tool_timeout(tool: str, depth: Optional[str] = None) -> float:
+    """Return the configured whole-call timeout for a tool (and search depth)."""
+    if depth is not None and f"{tool}:{depth}" in TOOL_TIMEOUTS:
+        return float(TOOL_TIMEOUTS[f"{tool}:{depth}"])
+    return float(TOOL_TIMEOUTS.get(tool, REQUEST_DEADLINE))
+
+
+def current_deadline(within: Optional[float] = None) -> Optional[float]:
+    """
+    Return the current request's deadline as a time.monotonic() value.
+    
+    Args:
+        within: If given, tighten the deadline to at most this many seconds from now
+        
+    Returns:
+        Deadline, or None if neither the request nor `within` sets one
+    """
+    deadline = _deadline.get()
+    if within is not None:
+        limit = time.monotonic() + within
+        deadline = limit if deadline is None else min(deadline, limit)
+    return deadline
+
+
+class AdaptiveTimeouts:
+    """
+    Read timeouts learned from observed latency.
+    
+    Successful non-streaming calls are recorded per model and token budget
+    (max_tokens rounded up to the next thousand). Once enough samples exist,
+    the read timeout is the p99 latency times `multiplier`, kept between
+    `floor` and REQUEST_TIMEOUT, so a hung quick search is abandoned long
+    before a slow but healthy long report would be.
+    """
+    
+    def __init__(
+        self,
+        enabled: bool = ADAPTIVE_TIMEOUTS,
+        multiplier: float = ADAPTIVE_TIMEOUT_MULTIPLIER,
+        floor: float = ADAPTIVE_TIMEOUT_MIN,
+        min_samples: int = ADAPTIVE_MIN_SAMPLES
+    ):
+        self.enabled = enabled
+        self.multiplier = multiplier
+        self.floor = floor
+        self.min_samples = min_samples
+        self.windows: Dict[Tuple[str, int], LatencyWindow] = {}
+    
+    def _window(self, model: str, max_tokens: int) -> Tuple[Tuple[str, int], Optional[LatencyWindow]]:
+        key = (model, -(-max_tokens // 1000) * 1000)
+        return key, self.windows.get(key)
+    
+    def record(self, model: str, max_tokens: int, seconds: float) -> None:
+        key, window = self._window(model, max_tokens)
+        if window is None:
+            window = self.windows[key] = LatencyWindow()
+        window.record(seconds)
+    
+    def read_timeout(self, model: str, max_tokens: int) -> float:
+        """Return the read timeout for the next call of this model and budget."""
+        _, window = self._window(model, max_tokens)
+        if not self.enabled or window is None or len(window.samples) < self.min_samples:
+            return REQUEST_TIMEOUT
+        return min(REQUEST_TIMEOUT, max(self.floor, window.percentile(0.99) * self.multiplier))
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "read_timeouts_s": {
+                f"{model}:{tokens}": round(self.read_timeout(model, tokens), 1)
+                for model, tokens in self.windows
+            }
+        }
+
+
+adaptive_timeouts = AdaptiveTimeouts()
+
+
+def request_timeout(model: str, max_tokens: int, stream: bool = False) -> httpx.Timeout:
+    """
+    Build the httpx timeout for one upstream attempt.
+    
+    Connect, write and pool waits have their own limits. The read timeout
+    is adaptive for non-streaming calls (for streams it bounds the gap
+    between chunks, so the fixed REQUEST_TIMEOUT is used). No phase may run
+    past the current request deadline.
+    """
+    read = REQUEST_TIMEOUT if stream else adaptive_timeouts.read_timeout(model, max_tokens)
+    deadline = _deadline.get()
+    remaining = max(0.1, deadline - time.monotonic()) if deadline is not None else float("inf")
+    return httpx.Timeout(
+        connect=min(CONNECT_TIMEOUT, remaining),
+        read=min(read, remaining),
+        write=min(WRITE_TIMEOUT, remaining),
+        pool=min(POOL_TIMEOUT, remaining)
+    )
+
+
+# =============================================================================
+# TOKEN AND COST BUDGETS
+# =============================================================================
+
+# USD per million tokens (prompt, completion); override with SONAR_PRICE_TABLE
+DEFAULT_PRICE_TABLE: Dict[str, Dict[str, float]] = {
+    "perplexity/sonar": {"prompt": 1.0, "completion": 1.0},
+    "perplexity/sonar-pro": {"prompt": 3.0, "completion": 15.0},
+    "perplexity/sonar-reasoning": {"prompt": 1.0, "completion": 5.0},
+    "perplexity/sonar-reasoning-pro": {"prompt": 2.0, "completion": 8.0},
+    "perplexity/sonar-deep-research": {"prompt": 2.0, "completion": 8.0}
+}
+
+_WINDOW_BUCKETS = 60
+
+
+def _valid_prices(model: str, prices: Any) -> bool:
+    """{'prompt': n, 'completion': n} with non-negative numbers (either may be omitted)."""
+    return (
+        isinstance(prices, dict)
+        and bool(prices)
+        and set(prices) <= {"prompt", "completion"}
+        and all(
+            isinstance(price, (int, float)) and not isinstance(price, bool) and 0 <= price < float("inf")
+            for price in prices.values()
+        )
+    )
+
+
+def _load_price_table() -> Dict[str, Dict[str, float]]:
+    """Return the default price table merged with SONAR_PRICE_TABLE (JSON)."""
+    table = _env_json_object(
+        "SONAR_PRICE_TABLE", DEFAULT_PRICE_TABLE, _valid_prices,
+        "{\"prompt\": USD, \"completion\": USD} per million tokens"
+    )
+    return {model: dict(prices) for model, prices in table.items()}
+
+
+_client_key: contextvars.ContextVar[str] = contextvars.ContextVar("sonar_client_key", default="local")
+
+
+def client_key_from_context(ctx: Any) -> str:
+    """
+    Identify the calling client for per-client quotas.
+    
+    Uses the client_id from the request _meta if the client sends one, then
+    the MCP session ID on HTTP transports, and 'local' otherwise (stdio
+    serves a single client per process).
+    """
+    try:
+        if ctx.client_id:
+            return str(ctx.client_id)
+        request = getattr(ctx.request_context, "request", None)
+        session_id = request.headers.get("mcp-session-id") if request is not None else None
+        if session_id:
+            return f"session:{session_id}"
+    except (AttributeError, LookupError, ValueError):
+        pass
+    return "local"
+
+
+class BudgetTracker:
+    """
+    Running token/cost totals per model and rolling-window quotas per client.
+    
+    Client usage is kept in a fixed number of time buckets covering the
+    window, so recording a call is O(1) and reading usage sums at most
+    _WINDOW_BUCKETS entries. Once a client passes soft_limit of its quota,
+    max_tokens is scaled down (and sonar_search drops to quick depth); at
+    the quota, calls are rejected until the window rolls over.
+    """
+    
+    def __init__(
+        self,
+        window: float = BUDGET_WINDOW,
+        client_tokens: int = BUDGET_CLIENT_TOKENS,
+        client_cost: float = BUDGET_CLIENT_COST,
+        soft_limit: float = BUDGET_SOFT_LIMIT,
+        state_path: str = BUDGET_STATE_PATH
+    ):
+        self.window = window
+        self.bucket_seconds = window / _WINDOW_BUCKETS
+        self.client_tokens = client_tokens
+        self.client_cost = client_cost
+        self.soft_limit = soft_limit
+        self.state_path = state_path
+        self.prices = _load_price_table()
+        self.models: Dict[str, Dict[str, float]] = {}
+        self.clients: Dict[str, Dict[int, List[float]]] = {}
+        self.degraded = 0
+        self.rejected = 0
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        if state_path:
+            self._load()
+    
+    @property
+    def enabled(self) -> bool:
+        return self.client_tokens > 0 or self.client_cost > 0
+    
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        """Return the USD cost of a call according to the price table."""
+        prices = self.prices.get(model)
+        if not prices:
+            return 0.0
+        return (
+            prompt_tokens * prices.get("prompt", 0.0)
+            + completion_tokens * prices.get("completion", 0.0)
+        ) / 1_000_000
+    
+    def _bucket(self) -> int:
+        return int(time.time() // self.bucket_seconds)
+    
+    def usage(self, client: str) -> Tuple[float, float]:
+        """Return (tokens, cost) used by a client in the current window."""
+        buckets = self.clients.get(client)
+        if not buckets:
+            return 0.0, 0.0
+        oldest = self._bucket() - _WINDOW_BUCKETS + 1
+        tokens = cost = 0.0
+        for index, (bucket_tokens, bucket_cost) in buckets.items():
+            if index >= oldest:
+                tokens += bucket_tokens
+                cost += bucket_cost
+        return tokens, cost
+    
+    def used_fraction(self, client: str) -> float:
+        """Return the larger of the token and cost quota fractions used."""
+        if not self.enabled:
+            return 0.0
+        tokens, cost = self.usage(client)
+        fractions = [0.0]
+        if self.client_tokens > 0:
+            fractions.append(tokens / self.client_tokens)
+        if self.client_cost > 0:
+            fractions.append(cost / self.client_cost)
+        return max(fractions)
+    
+    def check(self, client: str) -> None:
+        """
+        Raise if the client has used up its quota.
+        
+        Raises:
+            ValueError: With the time until the oldest usage leaves the window
+        """
+        if self.used_fraction(client) >= 1.0:
+            self.rejected += 1
+            buckets = self.clients.get(client, {})
+            oldest = self._bucket() - _WINDOW_BUCKETS + 1
+            first = min((i for i in buckets if i >= oldest), default=self._bucket())
+            resets_in = (first + _WINDOW_BUCKETS) * self.bucket_seconds - time.time()
+            raise ValueError(
+                f"Usage budget exhausted for this client ({self.window / 3600:g} h window). "
+                f"Capacity frees up in about {max(1, int(resets_in // 60))} minutes."
+            )
+    
+    def adjust_max_tokens(self, client: str, max_tokens: int, record: bool = True) -> int:
+        """Scale max_tokens down once the client is past the soft limit (record=False: don't count it)."""
+        fraction = self.used_fraction(client)
+        if fraction < self.soft_limit:
+            return max_tokens
+        if record:
+            self.degraded += 1
+        factor = max(0.25, (1 - fraction) / (1 - self.soft_limit))
+        adjusted = int(max_tokens * factor)
+        if self.client_tokens > 0:
+            adjusted = min(adjusted, int(self.client_tokens - self.usage(client)[0]))
+        return max(BUDGET_MIN_TOKENS, adjusted)
+    
+    def near_limit(self, client: str) -> bool:
+        """Return True once the client is past the soft limit."""
+        return self.used_fraction(client) >= self.soft_limit
+    
+    def record(self, client: str, model: str, usage: Optional[Dict[str, Any]]) -> None:
+        """Add one upstream call's usage to the model totals and client window."""
+        if not usage:
+            return
+        prompt = usage.get("prompt_tokens", 0) or 0
+        completion = usage.get("completion_tokens", 0) or 0
+        cost = self.cost(model, prompt, completion)
+        
+        totals = self.models.setdefault(
+            model, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+        )
+        totals["requests"] += 1
+        totals["prompt_tokens"] += prompt
+        totals["completion_tokens"] += completion
+        totals["cost_usd"] += cost
+        COST_USD.inc(model, amount=cost)
+        
+        if self.enabled:
+            bucket = self._bucket()
+            buckets = self.clients.setdefault(client, {})
+            entry = buckets.setdefault(bucket, [0.0, 0.0])
+            entry[0] += prompt + completion
+            entry[1] += cost
+            if len(buckets) > _WINDOW_BUCKETS:
+                for index in [i for i in buckets if i <= bucket - _WINDOW_BUCKETS]:
+                    del buckets[index]
+        self._dirty = True
+    
+    def _load(self) -> None:
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring budget state %s: %s", self.state_path, e)
+            return
+        self.models = state.get("models", {})
+        self.clients = {
+            client: {int(index): values for index, values in buckets.items()}
+            for client, buckets in state.get("clients", {}).items()
+        }
+    
+    def _write(self, state: Dict[str, Any]) -> None:
+        directory = os.path.dirname(self.state_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = f"{self.state_path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(state, f, separators=(",", ":"))
+        os.replace(temporary, self.state_path)
+    
+    async def save(self, force: bool = False) -> None:
+        """Persist state if it changed, at most every BUDGET_SAVE_INTERVAL seconds."""
+        if not self.state_path or not self._dirty:
+            return
+        if not force and time.monotonic() - self._saved_at < BUDGET_SAVE_INTERVAL:
+            return
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        state = {
+            "models": self.models,
+            "clients": {
+                client: {str(index): values for index, values in buckets.items()}
+                for client, buckets in self.clients.items()
+            }
+        }
+        await asyncio.to_thread(self._write, state)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return per-model totals and quota counters."""
+        return {
+            "models": {
+                model: {**totals, "cost_usd": round(totals["cost_usd"], 6)}
+                for model, totals in self.models.items()
+            },
+            "total_cost_usd": round(sum(t["cost_usd"] for t in self.models.values()), 6),
+            "quota_enabled": self.enabled,
+            "window_seconds": self.window,
+            "clients_tracked": len(self.clients),
+            "degraded_calls": self.degraded,
+            "rejected_calls": self.rejected
+        }
+
+
+budget = BudgetTracker()
+
+
+# =============================================================================
+# RESPONSE CACHE
+# =============================================================================
+
+class ResponseCache:
+    """
+    Size-bounded LRU cache of upstream responses with per-entry TTL.
+    
+    Entries live in memory; when a database path is given they are also
+    written to SQLite so cached answers survive restarts.
+    """
+    
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, db_path: str = ""):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        if db_path:
+            self._open_db(db_path)
+    
+    def _open_db(self, db_path: str) -> None:
+        """Open (or create) the SQLite store and drop expired rows."""
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, expires_at REAL NOT NULL, response TEXT NOT NULL)"
+        )
+        self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+        self._db.commit()
+    
+    @staticmethod
+    def make_key(
+        messages: List[Dict[str, str]],
+        model: str,
+        max_tokens: int,
+        temperature: float
+    ) -> str:
+        """
+        Build a cache key from the request parameters.
+        
+        Message content is whitespace-collapsed and case-folded so trivially
+        different spellings of the same query share an entry.
+        """
+        normalized = [
+            [m.get("role", ""), " ".join(m.get("content", "").split()).casefold()]
+            for m in messages
+        ]
+        raw = json.dumps([model, normalized, max_tokens, temperature], separators=(",", ":"))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    
+    def _db_get(self, key: str) -> Optional[Tuple[float, Dict[str, Any]]]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT expires_at, response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+    
+    def _db_set(self, key: str, expires_at: float, response: Dict[str, Any]) -> None:
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, expires_at, response) VALUES (?, ?, ?)",
+                (key, expires_at, json.dumps(response, separators=(",", ":")))
+            )
+            self._db.commit()
+    
+    def _db_delete(self, key: str) -> None:
+        with self._db_lock:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._db.commit()
+    
+    def _remember(self, key: str, expires_at: float, response: Dict[str, Any]) -> None:
+        """Insert into the in-memory LRU, evicting the oldest entries if full."""
+        self._entries[key] = (expires_at, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a fresh cached response.
+        
+        Returns:
+            Cached API response dictionary or None on miss/expiry
+        """
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is None and self._db is not None:
+            entry = await asyncio.to_thread(self._db_get, key)
+            if entry is not None and entry[0] > now:
+                self._remember(key, *entry)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, response = entry
+        if expires_at <= now:
+            self._entries.pop(key, None)
+            if self._db is not None:
+                await asyncio.to_thread(self._db_delete, key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return response
+    
+    async def set(self, key: str, response: Dict[str, Any], ttl: float) -> None:
+        """Store a response for ttl seconds."""
+        expires_at = time.time() + ttl
+        self._remember(key, expires_at, response)
+        if self._db is not None:
+            await asyncio.to_thread(self._db_set, key, expires_at, response)
+    
+    def expires_in(self, key: str) -> Optional[float]:
+        """Seconds until an in-memory entry expires, or None if it is not held."""
+        entry = self._entries.get(key)
+        return entry[0] - time.time() if entry is not None else None
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss/eviction counters and current size."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "persistent": self._db is not None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+
+response_cache = ResponseCache(CACHE_MAX_ENTRIES, CACHE_DB_PATH)
+
+
+_QUERY_TOKEN = re.compile(r"[a-z0-9][a-z0-9.+#-]*")
+_QUERY_STOPWORDS = frozenset(
+    "a an and any are as at about be by can could do does for from give how i in "
+    "is it its me my of on or please should show tell that the their there these "
+    "this those to was what whats when where which who why will with would you".split()
+)
+# Words agents use interchangeably in search queries
+_QUERY_SYNONYMS = {
+    **dict.fromkeys(("latest", "newest", "new", "current", "recent"), "recent"),
+    **dict.fromkeys(
+        ("news", "developments", "development", "updates", "update", "advances",
+         "advancements", "progress", "breakthroughs"), "news"
+    ),
+    **dict.fromkeys(("compare", "comparison", "versus", "vs", "difference", "differences"), "vs"),
+    **dict.fromkeys(("best", "top"), "best")
+}
+
+
+class NearDuplicateIndex:
+    """
+    MinHash LSH index for finding cached answers to rephrased queries.
+    
+    Queries are reduced to a set of normalized terms (case-folded, stop
+    words dropped, common synonyms merged, plural 's' stripped). A MinHash
+    signature of that set is split into bands; queries sharing any band
+    within the same scope become candidates, and a candidate matches if the
+    exact Jaccard similarity of the term sets reaches the threshold and the
+    terms containing digits (years, versions) are identical. Lookups touch
+    only the few entries in matching buckets, so they stay fast as the
+    index grows.
+    
+    The index maps to exact response cache keys; freshness is decided by
+    the response cache, and stale keys are dropped when found.
+    """
+    
+    def __init__(
+        self,
+        threshold: float = SIMILAR_CACHE_THRESHOLD,
+        max_entries: int = SIMILAR_CACHE_MAX_ENTRIES,
+        num_perm: int = 32,
+        bands: int = 8,
+        bucket_scan: int = 16
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.bucket_scan = bucket_scan
+        # One blake2b digest per term yields a 16-bit hash for every
+        # permutation at once (64 bytes: at most 32 permutations)
+        self._num_perm = self.rows * bands
+        self._unpack = struct.Struct(f"<{self._num_perm}H").unpack
+        # cache key -> (band bucket ids, terms, numeric terms); tuples take a
+        # fraction of a frozenset's memory
+        self._entries: "OrderedDict[str, Tuple[Tuple[int, ...], Tuple[str, ...], Tuple[str, ...]]]" = OrderedDict()
+        # bucket id -> key, or list of keys once a second key lands there;
+        # nearly all buckets hold a single key
+        self._buckets: Dict[int, Union[str, List[str]]] = {}
+        self.lookups = 0
+        self.matches = 0
+        self.hits = 0  # matches that were still cached, counted by request_completion
+    
+    @staticmethod
+    def terms(text: str) -> frozenset:
+        """Normalize a query to its set of significant terms."""
+        terms = set()
+        for token in _QUERY_TOKEN.findall(text.casefold()):
+            token = token.rstrip(".-")
+            if not token or token in _QUERY_STOPWORDS:
+                continue
+            plural = len(token) > 3 and token.endswith("s") and not token.endswith("ss")
+            if plural and token not in _QUERY_SYNONYMS:
+                token = token[:-1]
+            terms.add(sys.intern(_QUERY_SYNONYMS.get(token, token)))
+        return frozenset(terms)
+    
+    @staticmethod
+    def _numeric(terms: frozenset) -> Tuple[str, ...]:
+        """Terms containing digits (years, versions), sorted."""
+        return tuple(sorted(term for term in terms if any(ch.isdigit() for ch in term)))
+    
+    def _bucket_ids(self, scope: str, terms: frozenset) -> Tuple[int, ...]:
+        """MinHash the terms and hash each band (with the scope) to a bucket ID."""
+        digest_size = 2 * self._num_perm
+        signature = [min(column) for column in zip(*(
+            self._unpack(hashlib.blake2b(term.encode(), digest_size=digest_size).digest())
+            for term in terms
+        ))]
+        return tuple(
+            hash((scope, band, *signature[band * self.rows:(band + 1) * self.rows]))
+            for band in range(self.bands)
+        )
+    
+    def add(self, scope: str, text: str, key: str) -> None:
+        """Index a cached request's query text under its response cache key."""
+        terms = self.terms(text)
+        if not terms:
+            return
+        self.discard(key)
+        bucket_ids = self._bucket_ids(scope, terms)
+        self._entries[key] = (bucket_ids, tuple(terms), self._numeric(terms))
+        buckets = self._buckets
+        for bucket_id in bucket_ids:
+            bucket = buckets.get(bucket_id)
+            if bucket is None:
+                buckets[bucket_id] = key
+            elif isinstance(bucket, str):
+                buckets[bucket_id] = [bucket, key]
+            else:
+                bucket.append(key)
+        while len(self._entries) > self.max_entries:
+            self.discard(next(iter(self._entries)))
+    
+    def discard(self, key: str) -> None:
+        """Remove a cache key from the index (no-op if absent)."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for bucket_id in entry[0]:
+            bucket = self._buckets.get(bucket_id)
+            if bucket == key:
+                del self._buckets[bucket_id]
+            elif isinstance(bucket, list) and key in bucket:
+                bucket.remove(key)
+                if len(bucket) == 1:
+                    self._buckets[bucket_id] = bucket[0]
+    
+    def lookup(self, scope: str, text: str) -> Optional[str]:
+        """
+        Find the cache key of the most similar indexed query in the scope.
+        
+        Returns:
+            Response cache key, or None if no query is similar enough
+        """
+        self.lookups += 1
+        terms = self.terms(text)
+        if not terms:
+            return None
+        numeric = self._numeric(terms)
+        best_key, best_score = None, self.threshold
+        seen = set()
+        for bucket_id in self._bucket_ids(scope, terms):
+            bucket = self._buckets.get(bucket_id, ())
+            # Buckets crowded by very common terms are scanned newest first
+            # and only in part; a true near-duplicate shares several bands
+            for key in (bucket,) if isinstance(bucket, str) else bucket[-self.bucket_scan:]:
+                if key in seen:
+                    continue
+                seen.add(key)
+                _, other, other_numeric = self._entries[key]
+                if other_numeric != numeric:
+                    continue
+                shared = len(terms.intersection(other))
+                score = shared / (len(terms) + len(other) - shared)
+                if score >= best_score:
+                    best_key, best_score = key, score
+        if best_key is not None:
+            self.matches += 1
+        return best_key
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": SIMILAR_CACHE_ENABLED,
+            "threshold": self.threshold,
+            "entries": len(self._entries),
+            "lookups": self.lookups,
+            "matches": self.matches,
+            "hits": self.hits
+        }
+
+
+similar_queries = NearDuplicateIndex()
+
+
+# =============================================================================
+# RESULT PAGES
+# =============================================================================
+
+CHARS_PER_TOKEN = 4  # rough average for English text
+
+
+def estimate_tokens(text_or_chars: Union[str, int]) -> int:
+    """Estimate the token count of a text (or of a number of characters)."""
+    chars = text_or_chars if isinstance(text_or_chars, int) else len(text_or_chars)
+    return -(-chars // CHARS_PER_TOKEN)
+
+
+_PAGE_BREAKS = ("\n#", "\n\n", "\n", ". ", " ")  # best first
+
+
+def page_end(text: str, offset: int, max_tokens: int = PAGE_TOKENS) -> int:
+    """
+    Return where the page starting at offset should end.
+    
+    The page holds at most max_tokens (estimated) and ends before a heading
+    if possible, else after a paragraph, line, sentence or word, so words
+    and sections are not cut. A break is only used if it keeps the page at
+    least half full.
+    """
+    limit = max_tokens * CHARS_PER_TOKEN
+    if len(text) - offset <= limit:
+        return len(text)
+    window = text[offset:offset + limit]
+    for separator in _PAGE_BREAKS:
+        position = window.rfind(separator)
+        if position >= limit // 2:
+            # Headings start the next page; other separators end this one
+            return offset + position + (1 if separator == "\n#" else len(separator))
+    return offset + limit
+
+
+class ResultStore:
+    """
+    Full tool results kept for page-by-page retrieval.
+    
+    Bounded by total characters (least recently read results are evicted
+    first) and by age, so pages of an abandoned result do not pile up.
+    Each result belongs to the client that produced it; other clients
+    cannot read it even with the handle.
+    """
+    
+    def __init__(self, max_chars: int = RESULT_STORE_MAX_CHARS, ttl: float = RESULT_STORE_TTL):
+        self.max_chars = max_chars
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, str, str]]" = OrderedDict()  # expiry, text, owner
+        self._chars = 0
+        self.stored = 0
+        self.pages_served = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def _drop(self, handle: str) -> None:
+        _, text, _ = self._entries.pop(handle)
+        self._chars -= len(text)
+    
+    def put(self, text: str, owner: str) -> str:
+        """Store a result for the owner's client key and return its handle."""
+        handle = secrets.token_urlsafe(9)
+        self._entries[handle] = (time.monotonic() + self.ttl, text, owner)
+        self._chars += len(text)
+        self.stored += 1
+        while self._chars > self.max_chars and len(self._entries) > 1:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+        return handle
+    
+    def get(self, handle: str, owner: str) -> Optional[str]:
+        """Return a stored result, or None if unknown, evicted, expired or not the owner's."""
+        entry = self._entries.get(handle)
+        if entry is None or entry[2] != owner:
+            return None
+        if entry[0] <= time.monotonic():
+            self._drop(handle)
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(handle)
+        return entry[1]
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "chars": self._chars,
+            "max_chars": self.max_chars,
+            "stored": self.stored,
+            "pages_served": self.pages_served,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+
+result_store = ResultStore()
+
+
+def page_info(handle: str, next_offset: int, total_chars: int) -> Dict[str, Any]:
+    """Describe where the next page of a stored result starts."""
+    return {
+        "handle": handle,
+        "next_offset": next_offset,
+        "total_chars": total_chars,
+        "remaining_tokens": estimate_tokens(total_chars - next_offset)
+    }
+
+
+def paginate(content: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Return the first page of a result, storing the full text if more follow.
+    
+    Args:
+        content: Complete result text
+        
+    Returns:
+        Tuple of (first page, page_info() for the next page or None if the
+        content fits on one page)
+    """
+    end = page_end(content, 0)
+    if end >= len(content):
+        return content, None
+    return content[:end], page_info(result_store.put(content, _client_key.get()), end, len(content))
+
+
+def page_footer(page: Dict[str, Any]) -> str:
+    """Markdown note telling the caller how to fetch the next page."""
+    return (
+        f"\n\n---\n**📄 More:** ~{page['remaining_tokens']:,} more tokens "
+        f"({page['total_chars'] - page['next_offset']:,} characters). Call "
+        f"`sonar_get_page` with handle `{page['handle']}` and offset "
+        f"{page['next_offset']} for the next page."
+    )
+
+
+# =============================================================================
+# CONVERSATION SESSIONS
+# =============================================================================
+
+_CITATION_MARKERS = re.compile(r"\s*\[\d+\]")
+_MARKDOWN_NOISE = re.compile(r"[#*_`>|]+")
+SESSION_FACT_CHARS = 400  # answer text kept per condensed turn
+
+
+def condense_turn(prompt: str, answer: str, citations: List[Dict[str, str]]) -> str:
+    """
+    Reduce an earlier turn to its question, leading facts and sources.
+    
+    The answer's first sentences (up to SESSION_FACT_CHARS, markdown and
+    [n] markers removed) stand in for the whole answer; source URLs are
+    kept so follow-ups can refer back to them.
+    """
+    text = " ".join(_MARKDOWN_NOISE.sub(" ", _CITATION_MARKERS.sub("", answer)).split())
+    facts = ""
+    for sentence in re.split(r"(?<=[.!?])\s+", text):
+        if facts and len(facts) + len(sentence) > SESSION_FACT_CHARS:
+            break
+        facts = f"{facts} {sentence}".strip()
+    lines = [f"- Q: {' '.join(prompt.split())}", f"  A: {facts[:SESSION_FACT_CHARS]}"]
+    urls = [c["url"] for c in citations[:5] if c.get("url")]
+    if urls:
+        lines.append(f"  Sources: {', '.join(urls)}")
+    return "\n".join(lines)
+
+
+class Conversation:
+    """
+    One session's history: recent turns verbatim, older ones condensed.
+    
+    messages() renders it for the next request as a system message with
+    the condensed turns followed by alternating user/assistant messages.
+    """
+    
+    def __init__(self, ttl: float):
+        self.turns: List[Tuple[str, str, List[Dict[str, str]]]] = []  # (prompt, answer, citations)
+        self.condensed: List[str] = []
+        self.turn_count = 0
+        self.full_tokens = 0  # estimated tokens of the history if nothing were condensed
+        self.expires = time.monotonic() + ttl
+        self.lock = asyncio.Lock()  # one turn at a time, so each follow-up sees the last answer
+    
+    def messages(self) -> List[Dict[str, str]]:
+        """Chat messages carrying the history, oldest first."""
+        messages = []
+        if self.condensed:
+            messages.append({
+                "role": "system",
+                "content": "Earlier in this conversation (condensed):\n" + "\n".join(self.condensed)
+            })
+        for prompt, answer, _ in self.turns:
+            messages.append({"role": "user", "content": prompt})
+            messages.append({"role": "assistant", "content": answer})
+        return messages
+    
+    def tokens(self) -> int:
+        """Estimated tokens of the history as sent."""
+        return sum(estimate_tokens(m["content"]) for m in self.messages())
+    
+    def add(
+        self,
+        prompt: str,
+        answer: str,
+        citations: List[Dict[str, str]],
+        max_tokens: int,
+        recent_turns: int
+    ) -> int:
+        """
+        Append a turn and condense or drop the oldest ones to fit max_tokens.
+        
+        Returns:
+            Number of turns condensed
+        """
+        self.turns.append((prompt, answer, citations))
+        self.turn_count += 1
+        self.full_tokens += estimate_tokens(prompt) + estimate_tokens(answer)
+        condensed = 0
+        while self.turns and (len(self.turns) > recent_turns or self.tokens() > max_tokens):
+            self.condensed.append(condense_turn(*self.turns.pop(0)))
+            condensed += 1
+        while self.condensed and self.tokens() > max_tokens:
+            self.condensed.pop(0)
+        return condensed
+
+
+class SessionStore:
+    """
+    Conversations behind sonar_ask's session_id, per client.
+    
+    Each follow-up sends the session's history, kept within
+    history_tokens: the last recent_turns turns verbatim, earlier ones
+    condensed to question, key facts and sources, the oldest dropped.
+    Sessions idle for ttl seconds expire; beyond max_sessions the least
+    recently used is evicted.
+    """
+    
+    def __init__(
+        self,
+        max_sessions: int = SESSION_MAX,
+        ttl: float = SESSION_TTL,
+        history_tokens: int = SESSION_HISTORY_TOKENS,
+        recent_turns: int = SESSION_RECENT_TURNS
+    ):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.history_tokens = history_tokens
+        self.recent_turns = recent_turns
+        self._sessions: "OrderedDict[str, Conversation]" = OrderedDict()
+        self.created = 0
+        self.turns = 0
+        self.condensed_turns = 0
+        self.tokens_sent = 0
+        self.tokens_saved = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def open(self, session_id: str) -> Conversation:
+        """Return the caller's conversation with this ID, starting a new one if needed."""
+        now = time.monotonic()
+        # Least recently used first, so expired sessions are at the front
+        while self._sessions and next(iter(self._sessions.values())).expires <= now:
+            self._sessions.popitem(last=False)
+            self.expirations += 1
+        key = f"{_client_key.get()}|{session_id}"
+        conversation = self._sessions.get(key)
+        if conversation is None:
+            conversation = self._sessions[key] = Conversation(self.ttl)
+            self.created += 1
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+        self._sessions.move_to_end(key)
+        conversation.expires = now + self.ttl
+        return conversation
+    
+    def history(self, conversation: Conversation) -> Tuple[List[Dict[str, str]], int]:
+        """Messages to send before the next question and their estimated tokens."""
+        messages = conversation.messages()
+        sent = sum(estimate_tokens(m["content"]) for m in messages)
+        self.tokens_sent += sent
+        self.tokens_saved += max(0, conversation.full_tokens - sent)
+        return messages, sent
+    
+    def record(self, conversation: Conversation, prompt: str, answer: str, citations: List[Dict[str, str]]) -> None:
+        """Add a finished turn to the conversation."""
+        self.turns += 1
+        self.condensed_turns += conversation.add(
+            prompt, answer, citations, self.history_tokens, self.recent_turns
+        )
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._sessions),
+            "created": self.created,
+            "turns": self.turns,
+            "condensed_turns": self.condensed_turns,
+            "history_tokens_sent": self.tokens_sent,
+            "history_tokens_saved": self.tokens_saved,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+
+sessions = SessionStore()
+
+
+# =============================================================================
+# IN-FLIGHT REQUEST DEDUPLICATION
+# =============================================================================
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key into one upstream request.
+    
+    The first caller starts the work as a task; later callers with the same
+    key await that task. Each waiter is shielded, so cancelling one caller
+    does not cancel the request for the others, and an exception is
+    re-raised to every waiter. Progress of a call is forwarded to the
+    callbacks of the callers still waiting for it, so a caller that left
+    (or whose client went away) no longer affects the shared request.
+    """
+    
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._listeners: Dict[str, List[ProgressCallback]] = {}
+        self.started = 0
+        self.coalesced = 0
+    
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every waiter went away
+    
+    async def do(
+        self,
+        key: str,
+        func: Callable[[], Awaitable[Any]],
+        on_progress: Optional[ProgressCallback] = None
+    ) -> Any:
+        """
+        Run func() once per key at a time and share its outcome.
+        
+        on_progress receives progress() updates for key while this caller waits.
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        if on_progress is None:
+            return await asyncio.shield(task)
+        self._listeners.setdefault(key, []).append(on_progress)
+        try:
+            return await asyncio.shield(task)
+        finally:
+            listeners = self._listeners[key]
+            listeners.remove(on_progress)
+            if not listeners:
+                del self._listeners[key]
+    
+    async def progress(self, key: str, tokens: int, message: str) -> None:
+        """Forward a progress update of the call for key to its waiting callers."""
+        for listener in list(self._listeners.get(key, ())):
+            try:
+                await listener(tokens, message)
+            except Exception as e:
+                # One caller's failed notification must not fail the shared call
+                logger.debug("Progress notification failed: %s", e)
+    
+    def stats(self) -> Dict[str, int]:
+        """Return current and cumulative flight counters."""
+        return {
+            "in_flight": len(self._calls),
+            "started": self.started,
+            "coalesced": self.coalesced
+        }
+
+
+upstream_flights = SingleFlight()
+
+
+async def request_completion(
+    messages: List[Dict[str, str]],
+    model: str,
+    max_tokens: int,
+    temperature: float,
+    ttl: float = 0.0,
+    use_cache: bool = True,
+    stream: bool = False,
+    on_progress: Optional[ProgressCallback] = None,
+    deadline: Optional[float] = None,
+    hedge: bool = False,
+    similar: Optional[Tuple[str, str]] = None
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Get a completion through the response cache and in-flight deduplication.
+    
+    Concurrent identical requests share one upstream round trip; streaming
+    progress goes to every caller still waiting for it.
+    
+    The calling client's budget is checked first and max_tokens may be
+    lowered as the budget nears its limit; usage is charged to the caller
+    that started the upstream request.
+    
+    Args:
+        messages: List of message dicts with 'role' and 'content'
+        model: Model identifier
+        max_tokens: Maximum tokens in response
+        temperature: Response temperature
+        ttl: Seconds a fresh response stays cached (0 disables caching)
+        use_cache: False to skip the lookup (the fresh answer is still stored)
+        stream: Use the streaming (SSE) upstream path
+        on_progress: Progress callback for streamed requests
+        deadline: time.monotonic() value retries must finish by
+            (default: the current request deadline)
+        hedge: Send a backup request if the first one is slower than p95
+        similar: Optional (scope, query text); with SONAR_SIMILAR_CACHE, a
+            cached answer to a rephrased query in the same scope is served
+        
+    Returns:
+        Tuple of (API response dictionary, whether it came from the cache)
+    """
+    client = _client_key.get()
+    budget.check(client)
+    max_tokens = budget.adjust_max_tokens(client, max_tokens)
+    
+    key = ResponseCache.make_key(messages, model, max_tokens, temperature)
+    caching = CACHE_ENABLED and ttl > 0
+    
+    similar_scope = None
+    if caching and SIMILAR_CACHE_ENABLED and similar is not None:
+        similar_scope = f"{model}|{max_tokens}|{temperature}|{similar[0]}"
+    
+    if caching and use_cache:
+        cached = await response_cache.get(key)
+        if cached is not None:
+            return cached, True
+        if similar_scope is not None:
+            similar_key = similar_queries.lookup(similar_scope, similar[1])
+            if similar_key is not None:
+                cached = await response_cache.get(similar_key)
+                if cached is not None:
+                    similar_queries.hits += 1
+                    return cached, True
+                similar_queries.discard(similar_key)
+    
+    async def attempt() -> Dict[str, Any]:
+        if stream:
+            return await call_openrouter_stream(
+                messages, model, max_tokens, temperature,
+                functools.partial(upstream_flights.progress, key)
+            )
+        return await call_openrouter(messages, model, max_tokens, temperature)
+    
+    async def fetch() -> Dict[str, Any]:
+        response = await call_with_retries(
+            attempt,
+            deadline=deadline,
+            hedge_key=f"{model}:{max_tokens}" if hedge and not stream else None
+        )
+        budget.record(client, served_model(response, model), response.get("usage"))
+        await budget.save()
+        if caching and not response.get("fallback_from"):
+            await response_cache.set(key, response, ttl)
+            if similar_scope is not None:
+                similar_queries.add(similar_scope, similar[1], key)
+        return response
+    
+    return await upstream_flights.do(key, fetch, on_progress), False
+
+
+# =============================================================================
+# MODEL ROUTING
+# =============================================================================
+
+# Wording that asks for explanation or comparison rather than a single fact
+_ANALYTICAL_QUERY = re.compile(
+    r"\b(why|how (?:does|do|did|can|could|should|would|to)|explain|compare|comparison|versus|vs\.?|"
+    r"differences?|difference between|pros and cons|trade-?offs?|analy[sz]e|analysis|evaluate|"
+    r"assess|implications?|impact of|strategy|strategies|recommend|should (?:i|we)|best way)\b"
+)
+# Openings of a single-fact lookup
+_LOOKUP_QUERY = re.compile(
+    r"^(who|what|when|where|which|how (?:many|much|old|tall|long|far|big)|is|are|does|did|"
+    r"define|definition of|meaning of|capital of|population of|price of|current|latest)\b"
+)
+
+
+def classify_query(text: str, depth: Optional[SearchDepth] = None, follow_up: bool = False) -> Tuple[str, str]:
+    """
+    Pick a model tier for a search or question, without calling a model.
+    
+    An explicit depth decides (quick: 'fast', detailed: 'standard'); so
+    does a conversation follow-up ('standard'). Otherwise short lookups
+    (who/what/when... with at most ROUTER_FAST_MAX_WORDS words and a
+    single question) go to 'fast', and anything long, multi-part or
+    analytical (why, how does, compare, pros and cons...) to 'standard',
+    as does whatever is not clearly a lookup.
+    
+    Returns:
+        Tuple of (tier, reason)
+    """
+    if depth == SearchDepth.QUICK:
+        return "fast", "quick_depth"
+    if depth == SearchDepth.DETAILED:
+        return "standard", "detailed_depth"
+    if follow_up:
+        return "standard", "follow_up"
+    query = " ".join(text.lower().split())
+    if len(query.split()) > ROUTER_FAST_MAX_WORDS:
+        return "standard", "long"
+    if query.count("?") > 1 or "; " in query:
+        return "standard", "multi_part"
+    if _ANALYTICAL_QUERY.search(query):
+        return "standard", "analytical"
+    if _LOOKUP_QUERY.match(query):
+        return "fast", "lookup"
+    return "standard", "default"
+
+
+class ModelRouter:
+    """
+    Maps request complexity to a model tier and keeps per-tier figures.
+    
+    A tier without a configured model uses the tool's default model, so
+    the DEFAULT_*_MODEL settings remain the fallback policy.
+    """
+    
+    def __init__(self, tiers: Dict[str, str] = MODEL_TIERS):
+        unknown = [tier for tier in tiers if tier not in MODEL_TIER_NAMES]
+        if unknown:
+            raise ValueError(
+                f"Unknown model tier {', '.join(unknown)}; available: {', '.join(MODEL_TIER_NAMES)}"
+            )
+        self.tiers = dict(tiers)
+        self.cached: Dict[str, int] = {}
+    
+    def route(
+        self,
+        default_model: str,
+        text: str,
+        depth: Optional[SearchDepth] = None,
+        follow_up: bool = False
+    ) -> Tuple[str, str, str]:
+        """
+        Choose the model for a request, without recording anything.
+        
+        Returns:
+            Tuple of (model, tier, reason)
+        """
+        tier, reason = classify_query(text, depth, follow_up)
+        return self.tiers.get(tier) or default_model, tier, reason
+    
+    def count(self, tool: str, tier: str, reason: str) -> None:
+        """Record a routing decision for a request that is being sent."""
+        ROUTER_DECISIONS.inc(tool, tier, reason)
+    
+    def record(
+        self,
+        tier: str,
+        cached: bool,
+        upstream_seconds: float,
+        usage: Optional[Dict[str, Any]]
+    ) -> None:
+        """Record a routed request's upstream time and tokens."""
+        if cached:
+            self.cached[tier] = self.cached.get(tier, 0) + 1
+            return
+        ROUTER_LATENCY.observe(upstream_seconds, tier)
+        for kind in ("prompt_tokens", "completion_tokens"):
+            ROUTER_TOKENS.inc(tier, kind, amount=(usage or {}).get(kind, 0) or 0)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Tier models, decisions per tool and reason, and mean latency and tokens per tier."""
+        decisions: Dict[str, Dict[str, int]] = {}
+        reasons: Dict[str, int] = {}
+        for (tool, tier, reason), count in ROUTER_DECISIONS.values.items():
+            decisions.setdefault(tool, {})[tier] = decisions.get(tool, {}).get(tier, 0) + int(count)
+            reasons[reason] = reasons.get(reason, 0) + int(count)
+        tiers = {}
+        for tier in MODEL_TIER_NAMES:
+            series = ROUTER_LATENCY.values.get((tier,))
+            calls = int(sum(series[:-1])) if series else 0
+            mean = lambda total: round(total / calls, 1) if calls else 0.0
+            tiers[tier] = {
+                "model": self.tiers.get(tier, "tool default"),
+                "calls": calls,
+                "cached": self.cached.get(tier, 0),
+                "mean_upstream_ms": mean(series[-1] * 1000) if series else 0.0,
+                "mean_prompt_tokens": mean(ROUTER_TOKENS.values.get((tier, "prompt_tokens"), 0)),
+                "mean_completion_tokens": mean(ROUTER_TOKENS.values.get((tier, "completion_tokens"), 0))
+            }
+        return {"tiers": tiers, "decisions": decisions, "reasons": reasons}
+
+
+model_router = ModelRouter()
+
+
+# =============================================================================
+# REQUEST PIPELINE
+# =============================================================================
+
+class ToolRequest:
+    """
+    One tool call's upstream request and what became of it.
+    
+    Tools build it (prompt, model, limits and their own metadata for the
+    answer); middleware may change it before the upstream call and read the
+    response, answer and stage timings afterwards.
     
     Args:
-        response: API response dictionary
+        tool: Tool name, used as the metrics label
+        prompt: User message sent upstream
+        model, max_tokens, temperature, ttl, use_cache, stream, on_progress,
+            hedge, similar: As for request_completion()
+        response_format: Format respond() renders the answer in
+        metadata: Tool-specific fields shown with the answer
+        history: Earlier messages of a conversation, sent before the prompt
+        fetch: Replaces the single upstream call (research fan-out);
+            returns (content, citations, usage)
+    """
+    
+    def __init__(
+        self,
+        tool: str,
+        prompt: str,
+        model: str,
+        max_tokens: int,
+        temperature: float,
+        response_format: ResponseFormat = ResponseFormat.MARKDOWN,
+        ttl: float = 0.0,
+        use_cache: bool = True,
+        stream: bool = False,
+        on_progress: Optional[ProgressCallback] = None,
+        hedge: bool = False,
+        similar: Optional[Tuple[str, str]] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        history: Optional[List[Dict[str, str]]] = None,
+        fetch: Optional[Callable[[], Awaitable[Tuple[str, List[Dict[str, str]], Dict[str, int]]]]] = None
+    ):
+        self.tool = tool
+        self.messages = [*(history or ()), {"role": "user", "content": prompt}]
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.response_format = response_format
+        self.ttl = ttl
+        self.use_cache = use_cache
+        self.stream = stream
+        self.on_progress = on_progress
+        self.hedge = hedge
+        self.similar = similar
+        self.metadata = metadata or {}
+        self.fetch = fetch
+        self.search: Optional[Tuple[str, SearchDepth]] = None  # query and requested depth
+        self.routing: Optional[Tuple[str, Optional[SearchDepth]]] = None  # text and depth the router classifies
+        self.route: Optional[Tuple[str, str]] = None  # tier and reason the router chose
+        # Filled in by the pipeline
+        self.response: Optional[Dict[str, Any]] = None
+        self.cached = False
+        self.content = ""
+        self.citations: List[Dict[str, str]] = []
+        self.usage: Optional[Dict[str, int]] = None
+        self.timings: Dict[str, float] = {}  # stage -> seconds
+    
+    @property
+    def served_model(self) -> str:
+        """Model that answered (the fallback if one stood in), else the one requested."""
+        return served_model(self.response, self.model) if self.response else self.model
+    
+    def cache_key(self) -> str:
+        """
+        The response cache key request_completion() stores this request under.
         
-    Returns:
-        Dictionary with token usage info or None if not available
+        Uses the current client's budget-scaled max_tokens, without
+        counting the scaling as a downgrade.
+        """
+        return ResponseCache.make_key(
+            self.messages, self.model,
+            budget.adjust_max_tokens(_client_key.get(), self.max_tokens, record=False),
+            self.temperature
+        )
+    
+    def answer_metadata(self, page: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Metadata rendered with the answer (model, usage, tool fields, page)."""
+        metadata = {
+            "model": self.served_model,
+            "fallback_from": self.response.get("fallback_from") if self.response else None,
+            "tokens": self.usage,
+            **self.metadata
+        }
+        if self.ttl:
+            metadata["cached"] = self.cached
+        metadata["page"] = page
+        return metadata
+
+
+class Middleware:
     """
-    try:
-        usage = response.get("usage", {})
-        return {
-            "prompt_tokens": usage.get("prompt_tokens", 0),
-            "completion_tokens": usage.get("completion_tokens", 0),
-            "total_tokens": usage.get("total_tokens", 0)
+    A pipeline stage around the upstream call; override the hooks needed.
+    
+    prepare() settles what will be sent (model, limits) and must not record
+    anything: it also runs when the cache warmer predicts a request's cache
+    key. before() runs in pipeline order and may change the request; after()
+    runs in reverse order once the answer is extracted; on_error() runs in
+    reverse order for every middleware whose before() was entered when a
+    stage fails (the error still propagates); on_stage() is told how long
+    each stage took.
+    """
+    
+    name = "middleware"
+    
+    def prepare(self, request: ToolRequest) -> None:
+        pass
+    
+    async def before(self, request: ToolRequest) -> None:
+        pass
+    
+    async def after(self, request: ToolRequest) -> None:
+        pass
+    
+    async def on_error(self, request: ToolRequest, error: Exception) -> None:
+        pass
+    
+    def on_stage(self, request: ToolRequest, stage: str, seconds: float) -> None:
+        pass
+
+
+class WarmerMiddleware(Middleware):
+    """Count interactive searches for the cache warmer (not its own refreshes)."""
+    
+    name = "warmer"
+    
+    async def before(self, request: ToolRequest) -> None:
+        if request.search is not None and _client_key.get() != WARMER_CLIENT:
+            cache_warmer.observe(*request.search)
+
+
+class TimingsMiddleware(Middleware):
+    """Add the time spent in each stage so far to the answer's metadata."""
+    
+    name = "timings"
+    
+    async def after(self, request: ToolRequest) -> None:
+        request.metadata["timings_ms"] = {
+            stage: round(seconds * 1000, 1) for stage, seconds in request.timings.items()
         }
-    except Exception:
-        return None
 
 
-def format_markdown_response(
-    content: str, 
-    metadata: Optional[Dict[str, Any]] = None
-) -> str:
+class RouterMiddleware(Middleware):
     """
-    Format response as Markdown with optional metadata header.
+    Send sonar_search and sonar_ask requests to the tier their complexity calls for.
     
-    Args:
-        content: Main content
-        metadata: Optional metadata (model, tokens, timestamp, etc.)
+    Routes in prepare(), so the cache and deduplication keys (and the cache
+    warmer's freshness checks) use the routed model; counts the decision
+    before the upstream call and records the tier's upstream time and
+    tokens after.
+    """
+    
+    name = "router"
+    
+    def prepare(self, request: ToolRequest) -> None:
+        if request.routing is None or request.route is not None:
+            return
+        text, depth = request.routing
+        request.model, tier, reason = model_router.route(
+            request.model, text, depth, follow_up=len(request.messages) > 1
+        )
+        request.route = (tier, reason)
+        request.metadata["tier"] = tier
+    
+    async def before(self, request: ToolRequest) -> None:
+        if request.route is not None:
+            model_router.count(request.tool, *request.route)
+    
+    async def after(self, request: ToolRequest) -> None:
+        if request.route is not None:
+            model_router.record(
+                request.route[0], request.cached,
+                request.timings.get("upstream", 0.0), request.usage
+            )
+
+
+PIPELINE_MIDDLEWARE_TYPES = {
+    WarmerMiddleware.name: WarmerMiddleware,
+    TimingsMiddleware.name: TimingsMiddleware,
+    RouterMiddleware.name: RouterMiddleware
+}
+
+
+class RequestPipeline:
+    """
+    Runs every tool's upstream request through the same stages.
+    
+    Stages: 'prompt' (from the start of the tool call to its first
+    request: argument checks and prompt building), 'before:<name>' per
+    middleware, 'upstream' (budget, cache, deduplication, retries and the
+    HTTP call), 'extract' (answer, citations and usage), 'after:<name>' per
+    middleware in reverse order, then 'paginate' and 'format' in respond().
+    Each stage's time is added to request.timings and the
+    sonar_pipeline_stage_seconds histogram, and is a tracing span.
+    """
+    
+    def __init__(self, middleware: Optional[List[Middleware]] = None):
+        self.middleware = list(middleware or [])
+    
+    def prepare(self, request: ToolRequest) -> ToolRequest:
+        """Apply every middleware's prepare(); safe to repeat."""
+        for middleware in self.middleware:
+            middleware.prepare(request)
+        return request
+    
+    def use(self, middleware: Middleware) -> Middleware:
+        """Append a middleware; it runs after those already registered."""
+        self.middleware.append(middleware)
+        return middleware
+    
+    @contextmanager
+    def stage(self, request: ToolRequest, stage: str):
+        """Time one stage of a request."""
+        started = time.perf_counter()
+        try:
+            with tracing.span(stage):
+                yield
+        finally:
+            self._record(request, stage, time.perf_counter() - started)
+    
+    def _record(self, request: ToolRequest, stage: str, seconds: float) -> None:
+        request.timings[stage] = request.timings.get(stage, 0.0) + seconds
+        PIPELINE_STAGE.observe(seconds, request.tool, stage)
+        for middleware in self.middleware:
+            middleware.on_stage(request, stage, seconds)
+    
+    async def run(self, request: ToolRequest) -> ToolRequest:
+        """
+        Send the request upstream and extract the answer.
+        
+        Returns:
+            The same request with response, content, citations and usage set
+        """
+        call = _request_timings.get()
+        if call is not None and not call.prompt_recorded:
+            call.prompt_recorded = True
+            seconds = time.perf_counter() - call.started
+            self._record(request, "prompt", seconds)
+            tracing.record("prompt", seconds)
         
+        self.prepare(request)
+        entered: List[Middleware] = []
+        try:
+            for middleware in self.middleware:
+                entered.append(middleware)
+                with self.stage(request, f"before:{middleware.name}"):
+                    await middleware.before(request)
+            
+            with self.stage(request, "upstream"):
+                if request.fetch is not None:
+                    request.content, request.citations, request.usage = await request.fetch()
+                else:
+                    request.response, request.cached = await request_completion(
+                        messages=request.messages,
+                        model=request.model,
+                        max_tokens=request.max_tokens,
+                        temperature=request.temperature,
+                        ttl=request.ttl,
+                        use_cache=request.use_cache,
+                        stream=request.stream,
+                        on_progress=request.on_progress,
+                        hedge=request.hedge,
+                        similar=request.similar
+                    )
+            
+            if request.response is not None:
+                with self.stage(request, "extract"):
+                    request.content, request.citations = extract_answer(request.response)
+                    request.usage = get_usage_info(request.response)
+            if tracing.enabled:
+                tracing.set_attributes({
+                    "gen_ai.request.model": request.model,
+                    "gen_ai.request.max_tokens": request.max_tokens,
+                    "gen_ai.response.model": request.served_model,
+                    "gen_ai.usage.input_tokens": (request.usage or {}).get("prompt_tokens"),
+                    "gen_ai.usage.output_tokens": (request.usage or {}).get("completion_tokens"),
+                    "sonar.cached": request.cached
+                })
+            
+            for middleware in reversed(self.middleware):
+                with self.stage(request, f"after:{middleware.name}"):
+                    await middleware.after(request)
+        except Exception as e:
+            for middleware in reversed(entered):
+                await middleware.on_error(request, e)
+            raise
+        return request
+    
+    async def respond(self, request: ToolRequest) -> str:
+        """
+        Run the request and render the answer as the tool's result.
+        
+        Long answers are paged; the rest is fetched with sonar_get_page.
+        """
+        await self.run(request)
+        with self.stage(request, "paginate"):
+            content, page = paginate(request.content)
+        with self.stage(request, "format"):
+            metadata = request.answer_metadata(page)
+            if request.response_format == ResponseFormat.MARKDOWN:
+                metadata["timestamp"] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
+                return format_markdown_response(content, metadata, request.citations)
+            return format_json_response(content, metadata, request.citations)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Middleware order and mean time per tool and stage."""
+        stages: Dict[str, Dict[str, Any]] = {}
+        for (tool, stage), series in PIPELINE_STAGE.values.items():
+            count = sum(series[:-1])
+            stages.setdefault(tool, {})[stage] = {
+                "count": int(count),
+                "mean_ms": round(series[-1] / count * 1000, 2) if count else 0.0
+            }
+        return {"middleware": [m.name for m in self.middleware], "stages": stages}
+
+
+def build_pipeline(names: List[str]) -> RequestPipeline:
+    """Create the pipeline with the named built-in middleware, in order."""
+    unknown = [name for name in names if name not in PIPELINE_MIDDLEWARE_TYPES]
+    if unknown:
+        raise ValueError(
+            f"Unknown pipeline middleware {', '.join(unknown)}; "
+            f"available: {', '.join(PIPELINE_MIDDLEWARE_TYPES)}"
+        )
+    return RequestPipeline([PIPELINE_MIDDLEWARE_TYPES[name]() for name in names])
+
+
+def _configured_pipeline(names: List[str]) -> RequestPipeline:
+    """build_pipeline() for SONAR_PIPELINE_MIDDLEWARE; unknown names are logged and skipped."""
+    known = [name for name in names if name in PIPELINE_MIDDLEWARE_TYPES]
+    for name in names:
+        if name not in PIPELINE_MIDDLEWARE_TYPES:
+            logger.warning(
+                "Ignoring SONAR_PIPELINE_MIDDLEWARE entry %r (available: %s)",
+                name, ", ".join(PIPELINE_MIDDLEWARE_TYPES)
+            )
+    return build_pipeline(known)
+
+
+pipeline = _configured_pipeline(PIPELINE_MIDDLEWARE)
+
+
+# =============================================================================
+# SHARED TOOL LOGIC
+# =============================================================================
+
+# Map search depth to max_tokens
+SEARCH_DEPTH_TOKENS = {
+    SearchDepth.QUICK: 1000,
+    SearchDepth.STANDARD: 2000,
+    SearchDepth.DETAILED: 4000
+}
+
+
+def search_request(
+    query: str,
+    depth: SearchDepth,
+    use_cache: bool = True,
+    tool: str = "sonar_search",
+    response_format: ResponseFormat = ResponseFormat.MARKDOWN,
+    record: bool = True
+) -> ToolRequest:
+    """
+    Build the pipeline request for one web search.
+    
+    Falls back to quick depth when the caller's budget is near its limit;
+    the answer's metadata still shows the requested depth.
+    
+    Args:
+        query: Search query
+        depth: Search depth, mapped to max_tokens
+        use_cache: Whether a cached answer may be served
+        tool: Calling tool, for metrics
+        response_format: Format of the rendered answer
+        record: False to build the request without counting a budget downgrade
+            (the cache warmer only predicts its cache key)
+    """
+    requested = depth
+    if depth != SearchDepth.QUICK and budget.near_limit(_client_key.get()):
+        depth = SearchDepth.QUICK
+        if record:
+            budget.degraded += 1
+    
+    request = ToolRequest(
+        tool,
+        query,
+        model=DEFAULT_SEARCH_MODEL,
+        max_tokens=SEARCH_DEPTH_TOKENS[depth],
+        temperature=0.2,
+        response_format=response_format,
+        ttl=SEARCH_CACHE_TTL,
+        use_cache=use_cache,
+        hedge=HEDGE_QUICK_SEARCH and depth == SearchDepth.QUICK,
+        similar=("search", query),
+        metadata={"depth": requested.value}
+    )
+    request.search = (query, requested)
+    request.routing = (query, depth)
+    return request
+
+
+async def run_search(
+    query: str,
+    depth: SearchDepth,
+    use_cache: bool = True,
+    tool: str = "sonar_search"
+) -> ToolRequest:
+    """
+    Run one web search through the pipeline without rendering it.
+    
+    Used by sonar_batch_search and the cache warmer, which handle paging
+    and formatting themselves.
+    
     Returns:
-        Formatted Markdown string
+        The finished request: content, citations, usage, cached and served_model
     """
-    output = []
+    return await pipeline.run(search_request(query, depth, use_cache, tool))
+
+
+def merge_research_sections(
+    sections: List[Dict[str, Any]]
+) -> Tuple[str, List[Dict[str, str]]]:
+    """
+    Join per-focus-area research into one report with a shared source list.
     
-    if metadata:
-        output.append("---")
-        if metadata.get("model"):
-            output.append(f"**Model:** {metadata['model']}")
-        if metadata.get("tokens"):
-            tokens = metadata["tokens"]
-            output.append(
-                f"**Tokens:** {tokens.get('total_tokens', 0)} "
-                f"(prompt: {tokens.get('prompt_tokens', 0)}, "
-                f"completion: {tokens.get('completion_tokens', 0)})"
-            )
-        if metadata.get("timestamp"):
-            output.append(f"**Timestamp:** {metadata['timestamp']}")
-        output.append("---\n")
+    Citations are deduplicated by URL in section order and each section's
+    [n] markers are renumbered to the merged list, so the output depends
+    only on the inputs.
     
-    output.append(content)
+    Args:
+        sections: Dicts with 'area' and either 'content' + 'citations' or 'error'
+        
+    Returns:
+        Tuple of (markdown report, merged citations)
+    """
+    positions: Dict[str, int] = {}
+    sources: List[Dict[str, str]] = []
+    parts = []
+    for number, section in enumerate(sections, 1):
+        if "error" in section:
+            parts.append(
+                f"## {number}. {section['area']}\n\n"
+                f"**⚠️ Not available:** {section['error']}"
+            )
+            continue
+        
+        mapping = {}
+        for index, citation in enumerate(section["citations"], 1):
+            if citation["url"] not in positions:
+                positions[citation["url"]] = len(sources) + 1
+                sources.append(citation)
+            mapping[index] = positions[citation["url"]]
+        
+        content = renumber_citations(section["content"].strip(), mapping)
+        parts.append(f"## {number}. {section['area']}\n\n{content}")
     
-    return '\n'.join(output)
+    return "\n\n".join(parts), sources
 
 
-def format_json_response(
-    content: str, 
-    metadata: Optional[Dict[str, Any]] = None
-) -> str:
+async def run_research_fanout(
+    topic: str,
+    focus_areas: List[str],
+    max_tokens: int,
+    on_branch_done: Optional[Callable[[int, int, str], Awaitable[None]]] = None
+) -> Tuple[str, List[Dict[str, str]], Dict[str, int], int]:
     """
-    Format response as JSON.
+    Research the focus areas concurrently and merge the results.
+    
+    The token budget is split evenly across branches and never exceeded:
+    when it cannot give every area FANOUT_MIN_BRANCH_TOKENS, neighbouring
+    areas share a branch. A branch that fails or exceeds
+    FANOUT_BRANCH_TIMEOUT is reported in place instead of failing the
+    report; a failing progress callback is ignored.
     
     Args:
-        content: Main content
-        metadata: Optional metadata
+        topic: Research topic
+        focus_areas: Aspects to research, one request each where the budget allows
+        max_tokens: Total token budget requested by the caller
+        on_branch_done: Optional async callback(completed_count, branch_count, area)
         
     Returns:
-        JSON string
+        Tuple of (merged markdown, merged citations, summed token usage,
+        failed branch count)
+        
+    Raises:
+        ValueError: If every branch failed
     """
-    result = {
-        "content": content,
-        "timestamp": datetime.utcnow().isoformat() + "Z"
+    count = max(1, min(len(focus_areas), max_tokens // FANOUT_MIN_BRANCH_TOKENS))
+    branch_areas = [
+        " / ".join(focus_areas[i * len(focus_areas) // count:(i + 1) * len(focus_areas) // count])
+        for i in range(count)
+    ]
+    branch_tokens = max_tokens // count
+    completed = 0
+    
+    async def branch(area: str) -> Dict[str, Any]:
+        nonlocal completed
+        prompt = (
+            f"Conduct focused research on: {topic}\n\n"
+            f"Cover only this part of the topic: {area}\n\n"
+            "Provide a concise analysis with multiple sources and citations. "
+            "Use short subheadings; do not repeat the topic introduction."
+        )
+        try:
+            response, _ = await request_completion(
+                messages=[{"role": "user", "content": prompt}],
+                model=DEFAULT_RESEARCH_MODEL,
+                max_tokens=branch_tokens,
+                temperature=0.2,
+                deadline=current_deadline(FANOUT_BRANCH_TIMEOUT)
+            )
+            content, citations = extract_answer(response)
+            section = {
+                "area": area,
+                "content": content,
+                "citations": citations,
+                "tokens": get_usage_info(response) or {}
+            }
+        except Exception as e:
+            section = {"area": area, "error": str(e)}
+        completed += 1
+        if on_branch_done:
+            try:
+                await on_branch_done(completed, count, area)
+            except Exception as e:
+                logger.debug("Research progress notification failed: %s", e)
+        return section
+    
+    sections = await asyncio.gather(*(branch(area) for area in branch_areas))
+    failed = sum(1 for section in sections if "error" in section)
+    if failed == len(sections):
+        raise ValueError(f"All {failed} research branches failed: {sections[0]['error']}")
+    
+    usage = {
+        field: sum(section.get("tokens", {}).get(field, 0) for section in sections)
+        for field in ("prompt_tokens", "completion_tokens", "total_tokens")
     }
+    content, citations = merge_research_sections(sections)
+    return content, citations, usage, failed
+
+
+# =============================================================================
+# CACHE WARMER
+# =============================================================================
+
+WARMER_CLIENT = "warmer"  # budget key of warm-up requests
+_WARMER_MAX_TRACKED = 1000  # distinct queries remembered, least popular dropped first
+
+
+def _parse_hours(spec: str) -> Optional[frozenset]:
+    """
+    Parse '6-9' or '22-2,13' into the set of local hours covered (None: always).
     
-    if metadata:
-        result["metadata"] = metadata
+    An invalid spec is logged and treated as always, like an empty one.
+    """
+    if not spec.strip():
+        return None
+    hours = set()
+    for part in spec.split(","):
+        start, _, end = part.strip().partition("-")
+        try:
+            first, last = int(start), int(end or start)
+        except ValueError:
+            first = last = -1
+        if not (0 <= first <= 23 and 0 <= last <= 23):
+            logger.warning(
+                "Ignoring SONAR_WARMER_HOURS %r (expected hours 0-23, e.g. '6-9' or '22-2,13'); "
+                "warming at all hours", spec
+            )
+            return None
+        hour = first
+        while True:
+            hours.add(hour % 24)
+            if hour % 24 == last % 24:
+                break
+            hour += 1
+    return frozenset(hours)
+
+
+class CacheWarmer:
+    """
+    Refresh the most requested sonar_search queries before their cache entries expire.
+    
+    Every search is counted with exponential decay (WARMER_HALF_LIFE), so
+    the ranking follows recurring topics and forgets old ones. During the
+    configured hours, each pass re-runs the top queries whose cached answer
+    is missing or expires within WARMER_REFRESH_AHEAD seconds, through
+    run_search and therefore the rate governor, at most WARMER_CONCURRENCY
+    at a time and within WARMER_DAILY_TOKENS per day. A pass is skipped
+    while interactive requests are queued for an upstream slot.
+    """
+    
+    def __init__(
+        self,
+        hours: str = WARMER_HOURS,
+        top_queries: int = WARMER_TOP_QUERIES,
+        min_count: float = WARMER_MIN_COUNT,
+        refresh_ahead: float = WARMER_REFRESH_AHEAD,
+        daily_tokens: int = WARMER_DAILY_TOKENS,
+        concurrency: int = WARMER_CONCURRENCY,
+        half_life: float = WARMER_HALF_LIFE,
+        state_path: str = WARMER_STATE_PATH
+    ):
+        self.hours = _parse_hours(hours)
+        self.top_queries = top_queries
+        self.min_count = min_count
+        self.refresh_ahead = refresh_ahead
+        self.daily_tokens = daily_tokens
+        self.concurrency = max(1, concurrency)
+        self.half_life = half_life
+        self.state_path = state_path
+        # (normalized query, depth) -> [decayed count, last update (epoch), query text]
+        self.queries: Dict[str, List[Any]] = {}
+        self.day = ""
+        self.tokens_today = 0
+        self.refreshed = 0
+        self.skipped_busy = 0
+        self.errors = 0
+        self._task: Optional[asyncio.Task] = None
+        self._dirty = False
+        if state_path:
+            self._load()
+    
+    def _decayed(self, entry: List[Any], now: float) -> float:
+        return entry[0] * 0.5 ** ((now - entry[1]) / self.half_life)
+    
+    def observe(self, query: str, depth: SearchDepth) -> None:
+        """Count one interactive search."""
+        now = time.time()
+        key = f"{depth.value}|{' '.join(query.split()).casefold()}"
+        entry = self.queries.get(key)
+        if entry is None:
+            if len(self.queries) >= _WARMER_MAX_TRACKED:
+                least = min(self.queries, key=lambda k: self._decayed(self.queries[k], now))
+                del self.queries[least]
+            self.queries[key] = [1.0, now, query]
+        else:
+            entry[:] = [self._decayed(entry, now) + 1.0, now, query]
+        self._dirty = True
+    
+    def popular(self) -> List[Tuple[str, SearchDepth, float]]:
+        """Top queries at or above min_count, most popular first."""
+        now = time.time()
+        ranked = sorted(
+            ((self._decayed(entry, now), key, entry[2]) for key, entry in self.queries.items()),
+            reverse=True
+        )
+        # Rounded: a query just asked min_count times has decayed a hair below min_count
+        return [
+            (query, SearchDepth(key.split("|", 1)[0]), round(count, 2))
+            for count, key, query in ranked[:self.top_queries]
+            if round(count, 2) >= self.min_count
+        ]
+    
+    def _needs_refresh(self, query: str, depth: SearchDepth) -> bool:
+        # Key the refresh would store: same request, budget downgrades and routing included
+        client_token = _client_key.set(WARMER_CLIENT)
+        try:
+            key = pipeline.prepare(
+                search_request(query, depth, use_cache=False, tool=WARMER_CLIENT, record=False)
+            ).cache_key()
+        finally:
+            _client_key.reset(client_token)
+        remaining = response_cache.expires_in(key)
+        return remaining is None or remaining < self.refresh_ahead
+    
+    def _budget_left(self) -> int:
+        today = datetime.now().strftime("%Y-%m-%d")
+        if today != self.day:
+            self.day, self.tokens_today = today, 0
+        return self.daily_tokens - self.tokens_today
+    
+    async def warm(self) -> int:
+        """
+        Run one warm-up pass.
+        
+        Returns:
+            Number of queries refreshed
+        """
+        if self.hours is not None and datetime.now().hour not in self.hours:
+            return 0
+        due = [(query, depth) for query, depth, _ in self.popular() if self._needs_refresh(query, depth)]
+        if not due or self._budget_left() <= 0:
+            return 0
+        if upstream_router.total("waiting") > 0:
+            self.skipped_busy += 1
+            return 0
+        
+        semaphore = asyncio.Semaphore(self.concurrency)
+        refreshed = 0
+        
+        async def refresh(query: str, depth: SearchDepth) -> None:
+            nonlocal refreshed
+            async with semaphore:
+                if self._budget_left() <= 0:
+                    return
+                client_token = _client_key.set(WARMER_CLIENT)
+                deadline_token = _deadline.set(time.monotonic() + tool_timeout("sonar_search", depth.value))
+                try:
+                    request = await run_search(query, depth, use_cache=False, tool=WARMER_CLIENT)
+                    self.tokens_today += (request.usage or {}).get("total_tokens", 0)
+                    self._dirty = True
+                    refreshed += 1
+                except Exception:
+                    self.errors += 1
+                finally:
+                    _deadline.reset(deadline_token)
+                    _client_key.reset(client_token)
+        
+        await asyncio.gather(*(refresh(query, depth) for query, depth in due))
+        self.refreshed += refreshed
+        return refreshed
+    
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(WARMER_INTERVAL)
+            try:
+                await self.warm()
+                await self.save()
+            except Exception as e:
+                # A failed pass (e.g. an unwritable state file) must not end the warmer
+                self.errors += 1
+                logger.warning("Cache warm-up pass failed: %r", e)
+    
+    def start(self) -> None:
+        """Start the periodic warm-up task if SONAR_WARMER is enabled."""
+        if WARMER_ENABLED and CACHE_ENABLED and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+    
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    def _load(self) -> None:
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring warmer state %s: %s", self.state_path, e)
+            return
+        self.queries = state.get("queries", {})
+        self.day = state.get("day", "")
+        self.tokens_today = state.get("tokens_today", 0)
+    
+    def _write(self, state: Dict[str, Any]) -> None:
+        directory = os.path.dirname(self.state_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = f"{self.state_path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(state, f, separators=(",", ":"))
+        os.replace(temporary, self.state_path)
+    
+    async def save(self) -> None:
+        """Persist query counts and today's token use if they changed."""
+        if not self.state_path or not self._dirty:
+            return
+        self._dirty = False
+        state = {"queries": self.queries, "day": self.day, "tokens_today": self.tokens_today}
+        await asyncio.to_thread(self._write, state)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": WARMER_ENABLED,
+            "running": self._task is not None,
+            "tracked_queries": len(self.queries),
+            "popular": [
+                {"query": query, "depth": depth.value, "count": count}
+                for query, depth, count in self.popular()[:5]
+            ],
+            "tokens_today": self.tokens_today,
+            "daily_tokens": self.daily_tokens,
+            "refreshed": self.refreshed,
+            "skipped_busy": self.skipped_busy,
+            "errors": self.errors
+        }
+
+
+cache_warmer = CacheWarmer()
+
+
+# =============================================================================
+# BACKGROUND JOBS
+# =============================================================================
+
+JOB_STATES = ("queued", "running", "succeeded", "failed", "cancelled")
+_FINISHED_STATES = ("succeeded", "failed", "cancelled")
+
+
+class Job:
+    """One background tool call and, once finished, its result."""
+    
+    def __init__(
+        self,
+        job_id: str,
+        tool: str,
+        params: Dict[str, Any],
+        client_key: str,
+        run: Optional[Callable[["JobContext"], Awaitable[str]]] = None
+    ):
+        self.id = job_id
+        self.tool = tool
+        self.params = params
+        self.client_key = client_key
+        self.run = run
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.progress: Optional[Dict[str, Any]] = None
+        self.result: Optional[str] = None
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self.ended: Optional[asyncio.Event] = None  # set once a run has been recorded
+        self.queue_key: Optional[Tuple[int, int]] = None  # (priority, sequence) in the run queue
+    
+    @property
+    def finished(self) -> bool:
+        return self.status in _FINISHED_STATES
+    
+    def to_record(self) -> Dict[str, Any]:
+        """Everything but the runner, for persistence."""
+        return {
+            "id": self.id, "tool": self.tool, "params": self.params,
+            "client_key": self.client_key, "status": self.status,
+            "created_at": self.created_at, "started_at": self.started_at,
+            "finished_at": self.finished_at, "result": self.result, "error": self.error
+        }
+    
+    @classmethod
+    def from_record(cls, record: Dict[str, Any]) -> "Job":
+        job = cls(record["id"], record["tool"], record["params"], record["client_key"])
+        for field in ("status", "created_at", "started_at", "finished_at", "result", "error"):
+            setattr(job, field, record.get(field))
+        return job
+    
+    def describe(self, position: Optional[int] = None) -> Dict[str, Any]:
+        """Status summary (without the result) for the job tools."""
+        now = time.time()
+        info = {"job_id": self.id, "tool": self.tool, "status": self.status}
+        if position is not None:
+            info["queue_position"] = position
+        if self.progress:
+            info["progress"] = self.progress
+        info["created_at"] = datetime.utcfromtimestamp(self.created_at).isoformat() + "Z"
+        info["queued_seconds"] = round((self.started_at or now) - self.created_at, 1)
+        if self.started_at is not None:
+            info["run_seconds"] = round((self.finished_at or now) - self.started_at, 1)
+        if self.error:
+            info["error"] = self.error
+        return info
+
+
+class JobContext:
+    """Stands in for the MCP Context while a tool runs as a job: keeps its progress."""
+    
+    def __init__(self, job: Job):
+        self.job = job
+    
+    async def report_progress(
+        self, progress: float, total: Optional[float] = None, message: Optional[str] = None
+    ) -> None:
+        self.job.progress = {"progress": progress, "total": total, "message": message}
+
+
+class JobManager:
+    """
+    Bounded queue and worker pool for tool calls that outlive the request.
+    
+    Jobs wait in a priority queue (JOB_PRIORITIES by tool, then submission
+    order) and run on a fixed number of worker tasks, each through the
+    tool's normal code path with its deadline, retries and metrics. Finished
+    jobs are kept for JOB_RESULT_TTL seconds (at most JOB_MAX_KEPT); with a
+    database path they are also written to SQLite so results survive a
+    restart. Jobs that were queued or running when the server stopped are
+    reported as failed.
+    """
+    
+    def __init__(
+        self,
+        workers: int = JOB_WORKERS,
+        max_queued: int = JOB_QUEUE_MAX,
+        ttl: float = JOB_RESULT_TTL,
+        max_kept: int = JOB_MAX_KEPT,
+        db_path: str = JOB_DB_PATH
+    ):
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self.max_kept = max_kept
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._sequence = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        if db_path:
+            self._open_db(db_path)
+    
+    def _open_db(self, db_path: str) -> None:
+        """Open (or create) the SQLite store and load jobs that have not expired."""
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, created_at REAL NOT NULL, job TEXT NOT NULL)"
+        )
+        self._db.execute("DELETE FROM jobs WHERE created_at <= ?", (time.time() - self.ttl,))
+        self._db.commit()
+        for (record,) in self._db.execute("SELECT job FROM jobs ORDER BY created_at"):
+            job = Job.from_record(json.loads(record))
+            if not job.finished:
+                job.status = "failed"
+                job.error = "The server restarted before the job finished; submit it again"
+                job.finished_at = time.time()
+                self._save(job)
+            self._jobs[job.id] = job
+        self._db.commit()
+    
+    def _save(self, job: Job) -> None:
+        if self._db is None:
+            return
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs (id, created_at, job) VALUES (?, ?, ?)",
+                (job.id, job.created_at, json.dumps(job.to_record(), separators=(",", ":")))
+            )
+            self._db.commit()
+    
+    def _forget(self, job_id: str) -> None:
+        self._jobs.pop(job_id, None)
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                self._db.commit()
+    
+    def _purge(self) -> None:
+        """Drop finished jobs past their TTL, then the oldest beyond max_kept."""
+        cutoff = time.time() - self.ttl
+        finished = [job for job in self._jobs.values() if job.finished]
+        excess = len(finished) - self.max_kept
+        for job in finished:
+            if job.finished_at <= cutoff or excess > 0:
+                excess -= 1
+                self._forget(job.id)
+    
+    def _ensure_workers(self) -> None:
+        """Start the worker tasks on the running loop (again after a loop change)."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and all(not task.done() for task in self._worker_tasks):
+            return
+        self._loop = loop
+        self._queue = asyncio.PriorityQueue()
+        # Workers start from an empty context, not the submitting request's
+        self._worker_tasks = [
+            contextvars.Context().run(loop.create_task, self._worker())
+            for _ in range(self.workers)
+        ]
+        for job in self._jobs.values():
+            if job.status == "queued" and job.run is not None:
+                self._enqueue(job)
+    
+    def _enqueue(self, job: Job) -> None:
+        self._sequence += 1
+        job.queue_key = (JOB_PRIORITIES.get(job.tool, 9), self._sequence)
+        self._queue.put_nowait((*job.queue_key, job.id))
+    
+    def count(self, status: str) -> int:
+        return sum(1 for job in self._jobs.values() if job.status == status)
+    
+    def position(self, job: Job) -> Optional[int]:
+        """1-based place of a queued job in the run order (the queue's own ordering)."""
+        if job.status != "queued" or job.queue_key is None:
+            return None
+        return 1 + sum(
+            1 for other in self._jobs.values()
+            if other.status == "queued" and other.queue_key is not None and other.queue_key < job.queue_key
+        )
+    
+    def submit(
+        self,
+        tool: str,
+        params: Dict[str, Any],
+        client_key: str,
+        run: Callable[[JobContext], Awaitable[str]]
+    ) -> Job:
+        """
+        Queue a tool call.
+        
+        Raises:
+            ValueError: If JOB_QUEUE_MAX jobs are already waiting
+        """
+        self._purge()
+        if self.count("queued") >= self.max_queued:
+            self.rejected += 1
+            raise ValueError(
+                f"Job queue is full ({self.max_queued} jobs waiting); retry later "
+                "or call the tool without background"
+            )
+        self._ensure_workers()
+        job = Job(secrets.token_urlsafe(12), tool, params, client_key, run)
+        self._jobs[job.id] = job
+        self.submitted += 1
+        self._save(job)
+        self._enqueue(job)
+        return job
+    
+    def get(self, job_id: str) -> Optional[Job]:
+        self._purge()
+        return self._jobs.get(job_id)
+    
+    async def cancel(self, job: Job) -> None:
+        """Cancel a queued or running job; finished jobs are left as they are."""
+        if job.status == "queued":
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            JOBS_FINISHED.inc(job.tool, job.status)
+            self._save(job)
+        elif job.status == "running" and job.task is not None:
+            job.task.cancel()
+            # Wait for the worker to record the outcome so the status is final
+            try:
+                await asyncio.wait_for(job.ended.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _worker(self) -> None:
+        while True:
+            _, _, job_id = await self._queue.get()
+            job = self._jobs.get(job_id)
+            if job is None or job.status != "queued":
+                continue
+            await self._run(job)
+    
+    async def _run(self, job: Job) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        job.ended = asyncio.Event()
+        JOB_QUEUE_WAIT.observe(job.started_at - job.created_at, job.tool)
+        token = _client_key.set(job.client_key)
+        try:
+            job.task = asyncio.create_task(job.run(JobContext(job)))
+        finally:
+            _client_key.reset(token)
+        try:
+            # wait() returns when the job ends, however it ends; only
+            # cancelling this worker raises here
+            await asyncio.wait({job.task})
+        finally:
+            if job.status == "running":  # else already recorded by shutdown()
+                if not job.task.done():
+                    job.task.cancel()
+                    job.status, job.error = "failed", "The server shut down before the job finished"
+                elif job.task.cancelled():
+                    job.status = "cancelled"
+                elif job.task.exception() is not None:
+                    job.status, job.error = "failed", str(job.task.exception())
+                else:
+                    job.status, job.result = "succeeded", job.task.result()
+                job.finished_at = time.time()
+                self._save(job)
+            job.task = None
+            JOB_RUN_TIME.observe(job.finished_at - job.started_at, job.tool)
+            JOBS_FINISHED.inc(job.tool, job.status)
+            job.ended.set()
+    
+    def shutdown(self) -> None:
+        """
+        Stop the workers and record unfinished jobs as failed.
+        
+        Does not wait for the cancelled tasks, so it also works from a
+        lifespan that is itself being cancelled.
+        """
+        for job in self._jobs.values():
+            if job.status in ("queued", "running"):
+                stage = "started" if job.status == "queued" else "finished"
+                job.status, job.error = "failed", f"The server shut down before the job {stage}"
+                job.finished_at = time.time()
+                if job.task is not None:
+                    job.task.cancel()
+                self._save(job)
+        for task in self._worker_tasks:
+            task.cancel()
+        self._worker_tasks = []
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "max_queued": self.max_queued,
+            "persistent": self._db is not None,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            **{status: self.count(status) for status in JOB_STATES}
+        }
+
+
+job_manager = JobManager()
+
+
+def format_job(job: Job, response_format: ResponseFormat, note: str = "") -> str:
+    """Render a job's status for the job tools."""
+    info = job.describe(job_manager.position(job))
+    if response_format == ResponseFormat.JSON:
+        return dump_json({**info, "note": note} if note else info)
+    lines = [f"**Job:** `{job.id}` ({job.tool})", f"**Status:** {job.status}"]
+    if "queue_position" in info:
+        lines.append(f"**Queue position:** {info['queue_position']}")
+    if job.progress and job.progress.get("message"):
+        lines.append(f"**Progress:** {job.progress['message']}")
+    if "run_seconds" in info:
+        lines.append(f"**Run time:** {info['run_seconds']} s (queued {info['queued_seconds']} s)")
+    if job.error:
+        lines.append(f"**Error:** {job.error}")
+    if note:
+        lines.append(f"\n{note}")
+    return "\n".join(lines)
+
+
+def find_job(job_id: str) -> Job:
+    """
+    Look up one of the calling client's jobs for the job tools.
     
-    return json.dumps(result, indent=2, ensure_ascii=False)
+    Another client's job is reported as unknown, so job IDs cannot be
+    used to read or cancel someone else's work.
+    
+    Raises:
+        ValueError: If the job ID is unknown, the job has expired or it
+            was submitted by another client
+    """
+    job = job_manager.get(job_id)
+    if job is None or job.client_key != _client_key.get():
+        raise ValueError(f"Job '{job_id}' is unknown or its result has expired")
+    return job
 
 
-def check_and_truncate(content: str, limit: int = CHARACTER_LIMIT) -> str:
+def background_job(tool: str):
     """
-    Check if content exceeds character limit and truncate if necessary.
+    Decorator letting a tool run as a background job when params.background is set.
     
-    Args:
-        content: Content to check
-        limit: Character limit
-        
-    Returns:
-        Content (possibly truncated with warning message)
+    Apply between @mcp.tool and @instrumented: a background call returns a
+    job ID at once, and the job later runs the instrumented tool (with
+    background cleared) on the job pool, outside the client's request.
     """
-    if len(content) > limit:
-        truncated = content[:limit]
-        message = (
-            f"\n\n---\n**⚠️ TRUNCATED:** Response exceeded {limit:,} characters. "
-            f"Showing first {limit:,} characters. Consider:\n"
-            f"- Using a more specific query\n"
-            f"- Reducing max_tokens parameter\n"
-            f"- Using 'quick' or 'standard' depth instead of 'detailed'"
-        )
-        return truncated + message
-    return content
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(params: BaseModel, ctx: Context) -> str:
+            if not getattr(params, "background", False):
+                return await func(params=params, ctx=ctx)
+            params = params.model_copy(update={"background": False})
+            job = job_manager.submit(
+                tool,
+                params.model_dump(mode="json"),
+                client_key_from_context(ctx),
+                lambda job_ctx: func(params=params, ctx=job_ctx)
+            )
+            return format_job(
+                job, params.response_format,
+                "Poll with sonar_job_status and fetch the answer with sonar_job_result."
+            )
+        return wrapper
+    return decorate
 
 
 # =============================================================================
@@ -477,7 +5733,8 @@ def check_and_truncate(content: str, limit: int = CHARACTER_LIMIT) -> str:
         "openWorldHint": True
     }
 )
-async def sonar_search(params: SonarSearchInput) -> str:
+@instrumented("sonar_search")
+async def sonar_search(params: SonarSearchInput, ctx: Context) -> str:
     """
     Search the web using Perplexity's Sonar Pro with real-time information.
     
@@ -503,6 +5760,9 @@ async def sonar_search(params: SonarSearchInput) -> str:
             - query: Search query (3-500 chars)
             - depth: 'quick' (~1000 tokens), 'standard' (~2000), 'detailed' (~4000)
             - response_format: 'markdown' or 'json'
+            - use_cache: Reuse a recent cached answer (default true)
+            - timeout_seconds: Optional limit in seconds, retries included
+        ctx (Context): MCP request context identifying the client for budgets
     
     Returns:
         str: Search results with citations in specified format
@@ -516,51 +5776,136 @@ async def sonar_search(params: SonarSearchInput) -> str:
         ...     "depth": "detailed"
         ... })
     """
-    # Map depth to max_tokens
-    depth_tokens = {
-        SearchDepth.QUICK: 1000,
-        SearchDepth.STANDARD: 2000,
-        SearchDepth.DETAILED: 4000
+    return await pipeline.respond(search_request(
+        params.query, params.depth, params.use_cache, response_format=params.response_format
+    ))
+
+
+@mcp.tool(
+    name="sonar_batch_search",
+    annotations={
+        "title": "Sonar Batch Web Search",
+        "readOnlyHint": True,
+        "destructiveHint": False,
+        "idempotentHint": False,
+        "openWorldHint": True
     }
-    max_tokens = depth_tokens[params.depth]
+)
+@instrumented("sonar_batch_search")
+async def sonar_batch_search(params: SonarBatchSearchInput, ctx: Context) -> str:
+    """
+    Run many web searches concurrently in a single call.
     
-    # Construct search message
-    messages = [
-        {
-            "role": "user",
-            "content": params.query
-        }
-    ]
+    Instead of one sonar_search round trip per query, this tool runs up to
+    max_concurrency searches at once, so total time approaches that of the
+    slowest query. A failing query is reported in its own result and does
+    not fail the batch. Progress notifications are sent as each query
+    completes.
     
-    # Call API
-    response = await call_openrouter(
-        messages=messages,
-        model=DEFAULT_SEARCH_MODEL,
-        max_tokens=max_tokens,
-        temperature=0.2
-    )
+    Use Cases:
+    - Pipelines that research a list of entities: "pricing of X", "pricing of Y", ...
+    - Gathering news for several topics at once
+    - Fact-checking a list of claims
     
-    # Extract content
-    content = extract_content(response)
-    usage = get_usage_info(response)
+    Args:
+        params (SonarBatchSearchInput): Contains:
+            - queries: List of {query, depth, use_cache} (1-20 items)
+            - max_concurrency: Parallel searches (default 5)
+            - order: 'input' or 'completion'
+            - response_format: 'markdown' or 'json'
+            - timeout_seconds: Optional limit in seconds, retries included
+        ctx (Context): MCP request context used for progress notifications
+    
+    Returns:
+        str: One result (or error) per query in the requested order
+    
+    Example:
+        >>> result = await sonar_batch_search({
+        ...     "queries": [
+        ...         {"query": "latest PostgreSQL release"},
+        ...         {"query": "latest MySQL release", "depth": "quick"}
+        ...     ],
+        ...     "max_concurrency": 2
+        ... })
+    """
+    semaphore = asyncio.Semaphore(params.max_concurrency)
+    total = len(params.queries)
+    completed: List[Dict[str, Any]] = []
+    
+    async def run_one(index: int, item: BatchSearchQuery) -> Dict[str, Any]:
+        result: Dict[str, Any] = {"index": index, "query": item.query, "depth": item.depth.value}
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                request = await run_search(item.query, item.depth, item.use_cache, tool="sonar_batch_search")
+                result.update(
+                    answer=request.content, citations=request.citations, usage=request.usage,
+                    cached=request.cached, model=request.served_model
+                )
+                if params.response_format == ResponseFormat.JSON:
+                    result["answer"], result["page"] = paginate(request.content)
+            except Exception as e:
+                result["error"] = str(e)
+            result["elapsed_ms"] = round((time.perf_counter() - started) * 1000)
+        completed.append(result)
+        status = "failed" if "error" in result else "done"
+        try:
+            await ctx.report_progress(len(completed), total, f"{status}: {item.query}")
+        except Exception as e:
+            # Progress is best effort (client gone, no request context)
+            logger.debug("Batch progress notification failed: %s", e)
+        return result
     
-    # Truncate if needed
-    content = check_and_truncate(content)
+    outcomes = await asyncio.gather(
+        *(run_one(i, q) for i, q in enumerate(params.queries, 1)), return_exceptions=True
+    )
+    # Anything run_one did not catch still only fails its own item
+    results = []
+    for index, (item, outcome) in enumerate(zip(params.queries, outcomes), 1):
+        if isinstance(outcome, BaseException):
+            if not isinstance(outcome, Exception):
+                raise outcome
+            outcome = {"index": index, "query": item.query, "depth": item.depth.value, "error": str(outcome)}
+            completed.append(outcome)
+        results.append(outcome)
+    if params.order == BatchOrder.COMPLETION:
+        results = completed
+    
+    failed = sum(1 for r in results if "error" in r)
+    # Queries may be answered by different models (routing, fallbacks)
+    models = ", ".join(sorted({r["model"] for r in results if "model" in r})) or DEFAULT_SEARCH_MODEL
+    tokens = {
+        field: sum((r.get("usage") or {}).get(field, 0) for r in results)
+        for field in ("prompt_tokens", "completion_tokens", "total_tokens")
+    }
     
     # Format response
     if params.response_format == ResponseFormat.MARKDOWN:
+        sections = []
+        for r in results:
+            if "error" in r:
+                body = f"**⚠️ Error:** {r['error']}"
+            elif r["citations"]:
+                body = f"{r['answer']}\n\n**Sources**\n\n{format_sources(r['citations'])}"
+            else:
+                body = r["answer"]
+            sections.append(f"## {r['index']}. {r['query']}\n\n{body}")
+        header = f"**Queries:** {total} ({total - failed} succeeded, {failed} failed)\n\n"
+        content, page = paginate(header + "\n\n".join(sections))
         metadata = {
-            "model": DEFAULT_SEARCH_MODEL,
-            "tokens": usage,
-            "depth": params.depth.value,
+            "model": models,
+            "tokens": tokens,
+            "page": page,
             "timestamp": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
         }
         return format_markdown_response(content, metadata)
     else:
-        return format_json_response(content, {
-            "model": DEFAULT_SEARCH_MODEL,
-            "tokens": usage,
-            "depth": params.depth.value
+        return dump_json({
+            "results": results,
+            "model": models,
+            "usage": tokens,
+            "metadata": {"queries": total, "failed": failed},
+            "timestamp": datetime.utcnow().isoformat() + "Z"
         })
 
 
@@ -574,7 +5919,8 @@ async def sonar_search(params: SonarSearchInput) -> str:
         "openWorldHint": True
     }
 )
-async def sonar_ask(params: SonarAskInput) -> str:
+@instrumented("sonar_ask")
+async def sonar_ask(params: SonarAskInput, ctx: Context) -> str:
     """
     Ask Sonar a conversational question with web-augmented knowledge.
     
@@ -586,6 +5932,7 @@ async def sonar_ask(params: SonarAskInput) -> str:
     - Natural language conversation
     - Web-augmented responses with citations
     - Optional context for personalized answers
+    - Follow-up questions in a session (session_id)
     - Adjustable response length
     
     Use Cases:
@@ -599,8 +5946,13 @@ async def sonar_ask(params: SonarAskInput) -> str:
         params (SonarAskInput): Contains:
             - question: Conversational question (10-1000 chars)
             - context: Optional context to personalize answer (max 500 chars)
+            - session_id: Optional conversation ID; earlier turns are sent
+              along, the older ones condensed to key facts and sources
             - max_tokens: Response length (500-4000)
             - response_format: 'markdown' or 'json'
+            - use_cache: Reuse a recent cached answer (default true)
+            - timeout_seconds: Optional limit in seconds, retries included
+        ctx (Context): MCP request context identifying the client for budgets
     
     Returns:
         str: Detailed answer with citations
@@ -617,45 +5969,42 @@ async def sonar_ask(params: SonarAskInput) -> str:
     """
     # Construct message with optional context
     if params.context:
-        content = f"Context: {params.context}\n\nQuestion: {params.question}"
+        prompt = f"Context: {params.context}\n\nQuestion: {params.question}"
     else:
-        content = params.question
-    
-    messages = [
-        {
-            "role": "user",
-            "content": content
-        }
-    ]
-    
-    # Call API
-    response = await call_openrouter(
-        messages=messages,
-        model=DEFAULT_ASK_MODEL,
-        max_tokens=params.max_tokens,
-        temperature=0.3
-    )
+        prompt = params.question
     
-    # Extract content
-    content = extract_content(response)
-    usage = get_usage_info(response)
+    def ask_request(history: List[Dict[str, str]], metadata: Optional[Dict[str, Any]] = None) -> ToolRequest:
+        request = ToolRequest(
+            "sonar_ask",
+            prompt,
+            model=DEFAULT_ASK_MODEL,
+            max_tokens=params.max_tokens,
+            temperature=0.3,
+            response_format=params.response_format,
+            ttl=ASK_CACHE_TTL,
+            use_cache=params.use_cache,
+            # Rephrasings only match without history; the exact cache key covers it
+            similar=None if history else (f"ask|{params.context or ''}", params.question),
+            metadata=metadata,
+            history=history
+        )
+        request.routing = (params.question, None)
+        return request
     
-    # Truncate if needed
-    content = check_and_truncate(content)
+    if not params.session_id:
+        return await pipeline.respond(ask_request([]))
     
-    # Format response
-    if params.response_format == ResponseFormat.MARKDOWN:
-        metadata = {
-            "model": DEFAULT_ASK_MODEL,
-            "tokens": usage,
-            "timestamp": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
-        }
-        return format_markdown_response(content, metadata)
-    else:
-        return format_json_response(content, {
-            "model": DEFAULT_ASK_MODEL,
-            "tokens": usage
-        })
+    conversation = sessions.open(params.session_id)
+    async with conversation.lock:
+        history, history_tokens = sessions.history(conversation)
+        request = ask_request(history, {"session": {
+            "id": params.session_id,
+            "turn": conversation.turn_count + 1,
+            "history_tokens": history_tokens
+        }})
+        answer = await pipeline.respond(request)
+        sessions.record(conversation, prompt, request.content, request.citations)
+    return answer
 
 
 @mcp.tool(
@@ -668,7 +6017,9 @@ async def sonar_ask(params: SonarAskInput) -> str:
         "openWorldHint": True
     }
 )
-async def sonar_research(params: SonarResearchInput) -> str:
+@background_job("sonar_research")
+@instrumented("sonar_research")
+async def sonar_research(params: SonarResearchInput, ctx: Context) -> str:
     """
     Conduct comprehensive research on a topic with deep analysis.
     
@@ -696,6 +6047,11 @@ async def sonar_research(params: SonarResearchInput) -> str:
             - focus_areas: Optional list of specific aspects (max 5)
             - max_tokens: Response length (2000-6000)
             - response_format: 'markdown' or 'json'
+            - fan_out: Research focus areas concurrently and merge (default false)
+            - stream: Stream the response with progress updates (default true)
+            - background: Return a job ID at once and run as a background job
+            - timeout_seconds: Optional limit in seconds, retries included
+        ctx (Context): MCP request context used for progress notifications
     
     Returns:
         str: Comprehensive research report with citations
@@ -714,6 +6070,30 @@ async def sonar_research(params: SonarResearchInput) -> str:
         ...     "max_tokens": 5000
         ... })
     """
+    # Fan-out mode: one concurrent request per focus area
+    if params.fan_out and params.focus_areas and len(params.focus_areas) > 1:
+        async def report_branch(completed: int, total: int, area: str) -> None:
+            await ctx.report_progress(completed, total, f"done: {area}")
+        
+        async def fan_out() -> Tuple[str, List[Dict[str, str]], Dict[str, int]]:
+            content, citations, usage, failed = await run_research_fanout(
+                params.topic, params.focus_areas, params.max_tokens, report_branch
+            )
+            request.metadata["failed_areas"] = failed
+            return content, citations, usage
+        
+        request = ToolRequest(
+            "sonar_research",
+            params.topic,
+            model=DEFAULT_RESEARCH_MODEL,
+            max_tokens=params.max_tokens,
+            temperature=0.2,
+            response_format=params.response_format,
+            metadata={"focus_areas": params.focus_areas, "fan_out": True},
+            fetch=fan_out
+        )
+        return await pipeline.respond(request)
+    
     # Construct research prompt
     base_prompt = f"Conduct comprehensive research on: {params.topic}\n\n"
     base_prompt += "Provide a detailed analysis with multiple sources and citations. "
@@ -724,43 +6104,24 @@ async def sonar_research(params: SonarResearchInput) -> str:
         for i, area in enumerate(params.focus_areas, 1):
             base_prompt += f"{i}. {area}\n"
     
-    messages = [
-        {
-            "role": "user",
-            "content": base_prompt
-        }
-    ]
+    async def report_progress(tokens: int, message: str) -> None:
+        try:
+            await ctx.report_progress(tokens, params.max_tokens, message)
+        except Exception as e:
+            # Progress is best effort (client gone, no request context)
+            logger.debug("Progress notification failed: %s", e)
     
-    # Call API
-    response = await call_openrouter(
-        messages=messages,
+    return await pipeline.respond(ToolRequest(
+        "sonar_research",
+        base_prompt,
         model=DEFAULT_RESEARCH_MODEL,
         max_tokens=params.max_tokens,
-        temperature=0.2
-    )
-    
-    # Extract content
-    content = extract_content(response)
-    usage = get_usage_info(response)
-    
-    # Truncate if needed
-    content = check_and_truncate(content)
-    
-    # Format response
-    if params.response_format == ResponseFormat.MARKDOWN:
-        metadata = {
-            "model": DEFAULT_RESEARCH_MODEL,
-            "tokens": usage,
-            "focus_areas": params.focus_areas,
-            "timestamp": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
-        }
-        return format_markdown_response(content, metadata)
-    else:
-        return format_json_response(content, {
-            "model": DEFAULT_RESEARCH_MODEL,
-            "tokens": usage,
-            "focus_areas": params.focus_areas
-        })
+        temperature=0.2,
+        response_format=params.response_format,
+        stream=params.stream,
+        on_progress=report_progress,
+        metadata={"focus_areas": params.focus_areas}
+    ))
 
 
 @mcp.tool(
@@ -773,7 +6134,9 @@ async def sonar_research(params: SonarResearchInput) -> str:
         "openWorldHint": True
     }
 )
-async def sonar_reason(params: SonarReasonInput) -> str:
+@background_job("sonar_reason")
+@instrumented("sonar_reason")
+async def sonar_reason(params: SonarReasonInput, ctx: Context) -> str:
     """
     Solve complex problems with step-by-step reasoning.
     
@@ -801,6 +6164,10 @@ async def sonar_reason(params: SonarReasonInput) -> str:
             - constraints: Optional constraints (max 500 chars)
             - max_tokens: Response length (1000-5000)
             - response_format: 'markdown' or 'json'
+            - stream: Stream the response with progress updates (default true)
+            - background: Return a job ID at once and run as a background job
+            - timeout_seconds: Optional limit in seconds, retries included
+        ctx (Context): MCP request context used for progress notifications
     
     Returns:
         str: Detailed reasoning with step-by-step analysis
@@ -830,43 +6197,540 @@ async def sonar_reason(params: SonarReasonInput) -> str:
         "5. Implementation considerations"
     )
     
-    messages = [
-        {
-            "role": "user",
-            "content": prompt
-        }
-    ]
+    # Call the reasoning model
+    async def report_progress(tokens: int, message: str) -> None:
+        try:
+            await ctx.report_progress(tokens, params.max_tokens, message)
+        except Exception as e:
+            # Progress is best effort (client gone, no request context)
+            logger.debug("Progress notification failed: %s", e)
     
-    # Call API with reasoning model
-    response = await call_openrouter(
-        messages=messages,
+    return await pipeline.respond(ToolRequest(
+        "sonar_reason",
+        prompt,
         model=DEFAULT_REASON_MODEL,
         max_tokens=params.max_tokens,
-        temperature=0.2
-    )
+        temperature=0.2,
+        response_format=params.response_format,
+        stream=params.stream,
+        on_progress=report_progress,
+        metadata={"constraints": params.constraints}
+    ))
+
+
+@mcp.tool(
+    name="sonar_get_page",
+    annotations={
+        "title": "Get Next Page of a Sonar Result",
+        "readOnlyHint": True,
+        "destructiveHint": False,
+        "idempotentHint": True,
+        "openWorldHint": False
+    }
+)
+@instrumented("sonar_get_page")
+async def sonar_get_page(params: SonarGetPageInput, ctx: Context) -> str:
+    """
+    Fetch a further page of a long result without another upstream call.
     
-    # Extract content
-    content = extract_content(response)
-    usage = get_usage_info(response)
+    Answers longer than one page (SONAR_PAGE_TOKENS, about 12,500 tokens)
+    end with a note (markdown) or a 'page' entry (JSON) giving a handle and
+    the offset of the next page. Pages end at a heading, paragraph or
+    sentence boundary. Stored results expire after SONAR_RESULT_STORE_TTL
+    seconds or when memory is needed for newer results. Only the client
+    that received the first page can fetch the others.
     
-    # Truncate if needed
-    content = check_and_truncate(content)
+    Args:
+        params (SonarGetPageInput): Contains:
+            - handle: Result handle from the previous page
+            - offset: 'next_offset' from the previous page
+            - max_tokens: Approximate page size in tokens
+            - response_format: 'markdown' or 'json'
+        ctx (Context): MCP request context identifying the client
+    
+    Returns:
+        str: The page, followed by the position of the next one if any
+        
+    Raises:
+        ValueError: If the handle is unknown or expired, or the offset is
+            past the end of the result
+    """
+    text = result_store.get(params.handle, _client_key.get())
+    if text is None:
+        raise ValueError(
+            f"Result '{params.handle}' is unknown or has expired; repeat the original request"
+        )
+    if params.offset >= len(text):
+        raise ValueError(f"Offset {params.offset} is past the end of the result ({len(text)} characters)")
+    
+    end = page_end(text, params.offset, params.max_tokens)
+    page = page_info(params.handle, end, len(text)) if end < len(text) else None
+    result_store.pages_served += 1
     
-    # Format response
     if params.response_format == ResponseFormat.MARKDOWN:
-        metadata = {
-            "model": DEFAULT_REASON_MODEL,
-            "tokens": usage,
-            "constraints": params.constraints,
-            "timestamp": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
-        }
-        return format_markdown_response(content, metadata)
+        return format_markdown_response(text[params.offset:end], {"page": page} if page else None)
+    return dump_json({
+        "answer": text[params.offset:end],
+        "offset": params.offset,
+        "total_chars": len(text),
+        "page": page
+    })
+
+
+@mcp.tool(
+    name="sonar_job_status",
+    annotations={
+        "title": "Background Job Status",
+        "readOnlyHint": True,
+        "destructiveHint": False,
+        "idempotentHint": True,
+        "openWorldHint": False
+    }
+)
+@instrumented("sonar_job_status")
+async def sonar_job_status(params: SonarJobInput, ctx: Context) -> str:
+    """
+    Report the state of a background job.
+    
+    Jobs are submitted by calling sonar_research or sonar_reason with
+    "background": true. A job is 'queued', 'running', 'succeeded', 'failed'
+    or 'cancelled'; queued jobs report their queue position and running
+    ones their latest progress message. Only the client that submitted a
+    job can see it.
+    
+    Args:
+        params (SonarJobInput): Contains:
+            - job_id: ID returned on submission
+            - response_format: 'markdown' or 'json'
+        ctx (Context): MCP request context identifying the client
+    
+    Returns:
+        str: Job status, timings and error if it failed
+        
+    Raises:
+        ValueError: If the job ID is unknown or has expired
+    """
+    return format_job(find_job(params.job_id), params.response_format)
+
+
+@mcp.tool(
+    name="sonar_job_result",
+    annotations={
+        "title": "Background Job Result",
+        "readOnlyHint": True,
+        "destructiveHint": False,
+        "idempotentHint": True,
+        "openWorldHint": False
+    }
+)
+@instrumented("sonar_job_result")
+async def sonar_job_result(params: SonarJobInput, ctx: Context) -> str:
+    """
+    Return the answer of a finished background job.
+    
+    The answer is formatted as requested when the job was submitted. While
+    the job is still queued or running, its status is returned instead.
+    Results are kept for SONAR_JOB_RESULT_TTL seconds after the job ends.
+    
+    Args:
+        params (SonarJobInput): Contains:
+            - job_id: ID returned on submission
+            - response_format: Format of the status if the job is not done
+        ctx (Context): MCP request context identifying the client
+    
+    Returns:
+        str: The tool's answer, or the job status if it is not finished
+        
+    Raises:
+        ValueError: If the job is unknown, failed or was cancelled
+    """
+    job = find_job(params.job_id)
+    if job.status == "succeeded":
+        return job.result
+    if job.status in ("failed", "cancelled"):
+        raise ValueError(f"Job {job.id} {job.status}" + (f": {job.error}" if job.error else ""))
+    return format_job(job, params.response_format, "Not finished yet; poll again later.")
+
+
+@mcp.tool(
+    name="sonar_job_cancel",
+    annotations={
+        "title": "Cancel Background Job",
+        "readOnlyHint": False,
+        "destructiveHint": True,
+        "idempotentHint": True,
+        "openWorldHint": False
+    }
+)
+@instrumented("sonar_job_cancel")
+async def sonar_job_cancel(params: SonarJobInput, ctx: Context) -> str:
+    """
+    Cancel a queued or running background job.
+    
+    A queued job is removed from the queue; a running job is interrupted
+    and its upstream request abandoned. Finished jobs are left unchanged.
+    Only the client that submitted a job can cancel it.
+    
+    Args:
+        params (SonarJobInput): Contains:
+            - job_id: ID returned on submission
+            - response_format: 'markdown' or 'json'
+        ctx (Context): MCP request context identifying the client
+    
+    Returns:
+        str: Job status after the cancellation request
+        
+    Raises:
+        ValueError: If the job ID is unknown or has expired
+    """
+    job = find_job(params.job_id)
+    await job_manager.cancel(job)
+    return format_job(job, params.response_format)
+
+
+@mcp.tool(
+    name="sonar_stats",
+    annotations={
+        "title": "Sonar Server Statistics",
+        "readOnlyHint": True,
+        "destructiveHint": False,
+        "idempotentHint": False,
+        "openWorldHint": False
+    }
+)
+async def sonar_stats(params: Optional[SonarStatsInput] = None) -> str:
+    """
+    Report server performance statistics.
+    
+    In 'json' format, returns response cache counters (hits, misses,
+    evictions, expirations, current size), upstream request counters (in
+    flight, started, coalesced), streaming time-to-first-token figures, rate
+    limiter state (queue depth, concurrency limit, throttle events),
+    retry, hedge and retry-budget counters, result page store usage,
+    background job counts, request pipeline middleware with the mean time
+    per tool and stage, model router decisions with latency and tokens per
+    tier, sonar_ask session counts and history tokens saved, tracing
+    exporter state, and token/cost totals per model with per-client quota
+    counters.
+    
+    In 'prometheus' format, returns every metric in Prometheus text format:
+    per-tool and per-model request counts, queue/upstream/processing and
+    pipeline stage latency histograms, token counters, errors by class and cache/pool gauges. The
+    same output is served on /metrics when SONAR_METRICS_PORT is set.
+    
+    Args:
+        params (SonarStatsInput): Optional, contains:
+            - format: 'json' (default) or 'prometheus'
+    
+    Returns:
+        str: Statistics in the requested format
+    """
+    if params is not None and params.format == StatsFormat.PROMETHEUS:
+        return metrics.render()
+    
+    return dump_json({
+        "cache": {**response_cache.stats(), "similar": similar_queries.stats()},
+        "upstream_requests": upstream_flights.stats(),
+        "streaming": stream_stats.stats(),
+        "upstreams": upstream_router.stats(),
+        "circuit_breakers": model_breakers.stats(),
+        "timeouts": {"tools": TOOL_TIMEOUTS, "adaptive": adaptive_timeouts.stats()},
+        "result_pages": result_store.stats(),
+        "jobs": job_manager.stats(),
+        "warmer": cache_warmer.stats(),
+        "pipeline": pipeline.stats(),
+        "router": model_router.stats(),
+        "sessions": sessions.stats(),
+        "tracing": tracing.stats(),
+        "retries": retry_engine_stats(),
+        "budget": budget.stats()
+    })
+
+
+# =============================================================================
+# NETWORK TRANSPORT AND HEALTH
+# =============================================================================
+
+_active_calls = 0  # tool calls currently running
+_accepting = False  # HTTP app started and not draining
+_draining = False  # shutdown requested; new tool calls are refused
+_drain_task: Optional[asyncio.Task] = None
+
+
+@mcp.custom_route("/health/live", methods=["GET"])
+async def health_live(request: Request) -> JSONResponse:
+    """Liveness probe: the process is up and the event loop responds."""
+    return JSONResponse({"status": "ok"})
+
+
+@mcp.custom_route("/health/ready", methods=["GET"])
+async def health_ready(request: Request) -> JSONResponse:
+    """
+    Readiness probe: accepting calls, not draining, API key configured.
+    
+    Returns 503 while starting up, while draining on shutdown, or when the
+    API key is missing, so load balancers stop routing to this worker.
+    """
+    checks = {
+        "accepting": _accepting,
+        "api_key": upstream_router.has_credentials()
+    }
+    ready = all(checks.values())
+    return JSONResponse(
+        {
+            "status": "ready" if ready else "unavailable",
+            "checks": checks,
+            "active_calls": _active_calls,
+            "queue_depth": upstream_router.total("waiting")
+        },
+        status_code=200 if ready else 503
+    )
+
+
+def stop_accepting() -> None:
+    """Report not ready and refuse new tool calls."""
+    global _accepting, _draining
+    _accepting = False
+    _draining = True
+
+
+async def drain_active_calls(timeout: float = DRAIN_TIMEOUT) -> None:
+    """Stop accepting work and wait up to timeout seconds for running tool calls."""
+    stop_accepting()
+    deadline = time.monotonic() + timeout
+    while _active_calls and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+
+
+def _drain_before_exit() -> None:
+    """
+    Wrap uvicorn's SIGINT/SIGTERM handlers so a shutdown drains first.
+    
+    uvicorn closes its connections as soon as the signal arrives and only
+    runs the app lifespan shutdown afterwards, so readiness would stay 200
+    and calls would keep arriving until the very end. The first signal now
+    flips readiness to 503 and refuses new calls, running calls get up to
+    SONAR_DRAIN_TIMEOUT seconds, and then uvicorn's own handler runs. A
+    second signal goes straight to uvicorn.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    loop = asyncio.get_running_loop()
+    
+    def start_drain(handler, signum):
+        global _drain_task
+        _drain_task = loop.create_task(drain_active_calls())
+        _drain_task.add_done_callback(lambda _: handler(signum, None))
+    
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        handler = signal.getsignal(sig)
+        if not callable(handler):
+            continue
+        
+        def on_signal(signum, frame, handler=handler):
+            if _draining:
+                handler(signum, frame)
+                return
+            stop_accepting()
+            loop.call_soon_threadsafe(start_drain, handler, signum)
+        
+        signal.signal(sig, on_signal)
+
+
+def create_http_app():
+    """
+    Build the ASGI app for the streamable HTTP or SSE transport.
+    
+    The app lifespan holds the shared resources (HTTP client, metrics
+    listener, budgets) for the life of the process, so they are not torn
+    down when individual MCP sessions end. On shutdown, readiness turns 503
+    and new calls are refused first, running tool calls are drained, and
+    only then are sessions and the shared client closed. With several
+    workers, streamable HTTP runs stateless because sessions cannot follow
+    a client across processes.
+    
+    Returns:
+        Starlette application
+    """
+    if SERVER_WORKERS > 1:
+        mcp.settings.stateless_http = True
+    app = mcp.sse_app() if SERVER_TRANSPORT == "sse" else mcp.streamable_http_app()
+    transport_lifespan = app.router.lifespan_context
+    
+    @asynccontextmanager
+    async def lifespan(app):
+        global _accepting, _draining, _drain_task
+        async with server_lifespan(mcp):
+            async with transport_lifespan(app):
+                _accepting, _draining, _drain_task = True, False, None
+                _drain_before_exit()
+                try:
+                    yield
+                finally:
+                    if _drain_task is not None:
+                        await _drain_task
+                    else:
+                        await drain_active_calls()
+    
+    app.router.lifespan_context = lifespan
+    return app
+
+
+def run_http_server() -> None:
+    """Serve the network transport with uvicorn, optionally with several workers."""
+    import uvicorn
+    
+    options = {
+        "host": SERVER_HOST,
+        "port": SERVER_PORT,
+        "timeout_graceful_shutdown": int(DRAIN_TIMEOUT),
+        "log_level": "info"
+    }
+    if SERVER_WORKERS > 1:
+        # Workers import the module by name and read SONAR_TRANSPORT themselves
+        os.environ["SONAR_TRANSPORT"] = SERVER_TRANSPORT
+        uvicorn.run(
+            "sonar_mcp_server:create_http_app", factory=True, workers=SERVER_WORKERS, **options
+        )
     else:
-        return format_json_response(content, {
-            "model": DEFAULT_REASON_MODEL,
-            "tokens": usage,
-            "constraints": params.constraints
+        uvicorn.run(create_http_app(), **options)
+
+
+def run_healthcheck() -> int:
+    """
+    Container health check.
+    
+    For network transports, queries the readiness endpoint; for stdio,
+    checks that the server imports and an API key is configured.
+    
+    Returns:
+        Process exit code (0 = healthy)
+    """
+    if SERVER_TRANSPORT == "stdio":
+        return 0 if upstream_router.has_credentials() else 1
+    host = "127.0.0.1" if SERVER_HOST in ("0.0.0.0", "::") else SERVER_HOST
+    try:
+        response = httpx.get(f"http://{host}:{SERVER_PORT}/health/ready", timeout=5.0)
+    except httpx.HTTPError:
+        return 1
+    return 0 if response.status_code == 200 else 1
+
+
+def _time_to_ready(command: List[str], cwd: str) -> Tuple[float, float]:
+    """
+    Start one stdio server and time its initialize and tools/list replies.
+    
+    Returns:
+        Seconds from process start to each reply
+    """
+    import subprocess
+    
+    def send(message: Dict[str, Any]) -> None:
+        process.stdin.write(json.dumps(message) + "\n")
+        process.stdin.flush()
+    
+    def reply(request_id: int) -> None:
+        for line in process.stdout:
+            if json.loads(line).get("id") == request_id:
+                return
+        raise RuntimeError("server exited before replying")
+    
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        command, cwd=cwd, env={**os.environ, "SONAR_TRANSPORT": "stdio"}, text=True,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    try:
+        send({
+            "jsonrpc": "2.0", "id": 1, "method": "initialize",
+            "params": {
+                "protocolVersion": "2025-06-18",
+                "capabilities": {},
+                "clientInfo": {"name": "startup-benchmark", "version": "1"}
+            }
         })
+        reply(1)
+        initialized = time.perf_counter() - started
+        send({"jsonrpc": "2.0", "method": "notifications/initialized"})
+        send({"jsonrpc": "2.0", "id": 2, "method": "tools/list"})
+        reply(2)
+        listed = time.perf_counter() - started
+    finally:
+        process.stdin.close()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return initialized, listed
+
+
+def _import_breakdown(cwd: str) -> Tuple[float, List[Tuple[str, float]]]:
+    """
+    Import the server under -X importtime.
+    
+    Returns:
+        The module's own import time and (module, cumulative time) for each
+        of its direct imports, in milliseconds, slowest first
+    """
+    import subprocess
+    
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import sonar_mcp_server"],
+        cwd=cwd, capture_output=True, text=True, check=True
+    )
+    direct: List[Tuple[str, float]] = []
+    own = 0.0
+    for line in result.stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        level = (len(name) - len(name.lstrip())) // 2
+        if level == 1:
+            direct.append((name.strip(), int(fields[1]) / 1000))
+        elif level == 0 and name.strip() == "sonar_mcp_server":
+            own = int(fields[0]) / 1000
+            break
+        elif level == 0:
+            direct = []
+    return own, sorted(direct, key=lambda item: item[1], reverse=True)
+
+
+def run_startup_benchmark(runs: int = 5) -> int:
+    """
+    Report cold-start time to ready and where import time goes.
+    
+    Starts the server over stdio `runs` times with the same entry point as
+    this process (script or -m), after one unmeasured start that writes the
+    bytecode cache, and times the initialize and tools/list replies. Then
+    imports the module under -X importtime for a per-module breakdown.
+    
+    Returns:
+        Process exit code
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    if __spec__ is not None:
+        command = [sys.executable, "-m", "sonar_mcp_server"]
+    else:
+        command = [sys.executable, os.path.abspath(__file__)]
+    _time_to_ready(command, cwd)
+    samples = [_time_to_ready(command, cwd) for _ in range(runs)]
+    
+    print(f"command: {' '.join(command)}")
+    print(f"tool schema cache: {TOOL_CACHE_PATH} "
+          f"({'current' if load_tool_cache(TOOL_CACHE_PATH) else 'missing or stale'})")
+    print(f"time to ready over {runs} starts (ms)      min   median      max")
+    for label, values in (("initialize reply", [s[0] for s in samples]),
+                          ("tools/list reply", [s[1] for s in samples])):
+        values = sorted(v * 1000 for v in values)
+        print(f"  {label:<34}{values[0]:>7.0f}{values[len(values) // 2]:>9.0f}{values[-1]:>9.0f}")
+    
+    own, direct = _import_breakdown(cwd)
+    print(f"import time (ms): {own + sum(ms for _, ms in direct):.0f} total")
+    print(f"  {'sonar_mcp_server (own code)':<34}{own:>7.1f}")
+    for name, ms in direct[:10]:
+        print(f"  {name:<34}{ms:>7.1f}")
+    return 0
 
 
 # =============================================================================
@@ -874,5 +6738,16 @@ async def sonar_reason(params: SonarReasonInput) -> str:
 # =============================================================================
 
 if __name__ == "__main__":
-    # Run the MCP server
-    mcp.run()
+    if "--healthcheck" in sys.argv[1:]:
+        sys.exit(run_healthcheck())
+    if "--write-tool-cache" in sys.argv[1:]:
+        print(f"wrote {write_tool_cache(TOOL_CACHE_PATH)} tool schemas to {TOOL_CACHE_PATH}")
+        sys.exit(0)
+    if "--benchmark-startup" in sys.argv[1:]:
+        sys.exit(run_startup_benchmark())
+    
+    if SERVER_TRANSPORT == "stdio":
+        # Run the MCP server on stdin/stdout (one client per process)
+        mcp.run()
+    else:
+        run_http_server()
@@ -0,0 +1,106 @@
+"""
+Shared fixtures for the test suite.
+
+The server reads its settings at import, so the environment is prepared
+here before any test module imports it: upstream calls go to the local
+OpenRouter stub in benchmarks/ (started per test by run_with_stub), never
+to a live endpoint.
+"""
+
+import asyncio
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+from openrouter_stub import free_port, running_stub  # noqa: E402
+
+STUB_PORT = free_port()
+os.environ["OPENROUTER_API_URL"] = f"http://127.0.0.1:{STUB_PORT}/chat/completions"
+os.environ["OPENROUTER_API_KEY"] = "test"
+os.environ["SONAR_RATE_LIMIT_RPS"] = "0"
+for name in ("SONAR_UPSTREAMS", "OPENROUTER_API_KEYS", "SONAR_CACHE_DB", "SONAR_JOB_DB",
+             "SONAR_BUDGET_STATE", "SONAR_WARMER_STATE", "SONAR_TRACING"):
+    os.environ.pop(name, None)
+
+import sonar_mcp_server as server  # noqa: E402
+from mcp.shared.memory import create_connected_server_and_client_session  # noqa: E402
+
+
+class FakeClock:
+    """
+    Stand-in for the server's `time` module with a manually advanced clock.
+    
+    monotonic() and time() only move when advance() is called; everything
+    else is the real time module.
+    """
+    
+    def __init__(self, start: float = 1000.0):
+        self.now = start
+    
+    def monotonic(self) -> float:
+        return self.now
+    
+    def time(self) -> float:
+        return self.now
+    
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+    
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    """Freeze the server's clock; the event loop keeps real time."""
+    fake = FakeClock()
+    monkeypatch.setattr(server, "time", fake)
+    return fake
+
+
+def run_with_stub(test, **stub_options):
+    """
+    Run `await test(url)` against a freshly started stub.
+    
+    The shared HTTP client is closed afterwards, since it is bound to the
+    event loop of the test that created it.
+    """
+    async def main():
+        async with running_stub(STUB_PORT, **stub_options) as url:
+            try:
+                return await test(url)
+            finally:
+                await server.close_http_client()
+    
+    return asyncio.run(main())
+
+
+@asynccontextmanager
+async def mcp_session():
+    """In-memory MCP client session connected to the server."""
+    async with create_connected_server_and_client_session(server.mcp._mcp_server) as session:
+        yield session
+
+
+async def call(session, tool: str, client_id: str = "", **arguments) -> str:
+    """
+    Call a tool as the client with client_id and return its text.
+    
+    Raises:
+        ValueError: With the error text if the tool failed
+    """
+    result = await session.call_tool(
+        tool, {"params": arguments}, meta={"client_id": client_id} if client_id else None
+    )
+    text = result.content[0].text
+    if result.isError:
+        raise ValueError(text)
+    return text
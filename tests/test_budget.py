@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from conftest import run_with_stub
+import sonar_mcp_server as server
+
+
+def usage(prompt, completion):
+    return {"prompt_tokens": prompt, "completion_tokens": completion}
+
+
+def test_cost_follows_the_price_table():
+    tracker = server.BudgetTracker()
+    assert tracker.cost("perplexity/sonar-pro", 1_000_000, 100_000) == pytest.approx(4.5)
+    assert tracker.cost("unknown/model", 1_000_000, 1_000_000) == 0.0
+
+
+def test_quota_rejects_until_usage_leaves_the_window(clock):
+    tracker = server.BudgetTracker(window=3600, client_tokens=1000)
+    tracker.record("alice", "perplexity/sonar", usage(400, 600))
+    with pytest.raises(ValueError, match="Usage budget exhausted"):
+        tracker.check("alice")
+    tracker.check("bob")
+    clock.advance(3540)
+    with pytest.raises(ValueError):
+        tracker.check("alice")
+    clock.advance(60)
+    tracker.check("alice")
+    assert tracker.rejected == 2
+
+
+def test_cost_quota(clock):
+    tracker = server.BudgetTracker(window=3600, client_cost=1.0)
+    tracker.record("alice", "perplexity/sonar-pro", usage(0, 60_000))
+    assert tracker.used_fraction("alice") == pytest.approx(0.9)
+    assert tracker.near_limit("alice")
+    tracker.record("alice", "perplexity/sonar-pro", usage(0, 10_000))
+    with pytest.raises(ValueError):
+        tracker.check("alice")
+
+
+def test_max_tokens_shrink_past_the_soft_limit(clock):
+    tracker = server.BudgetTracker(window=3600, client_tokens=10_000, soft_limit=0.8)
+    assert tracker.adjust_max_tokens("alice", 4000) == 4000
+    tracker.record("alice", "perplexity/sonar", usage(4000, 5000))
+    assert tracker.adjust_max_tokens("alice", 4000) == 1000
+    assert tracker.adjust_max_tokens("alice", 4000, record=False) == 1000
+    tracker.record("alice", "perplexity/sonar", usage(0, 900))
+    assert tracker.adjust_max_tokens("alice", 4000) == server.BUDGET_MIN_TOKENS
+    assert tracker.degraded == 2
+
+
+def test_without_quotas_only_model_totals_are_kept(clock):
+    tracker = server.BudgetTracker()
+    tracker.record("alice", "perplexity/sonar", usage(10, 20))
+    tracker.record("alice", "perplexity/sonar", None)
+    assert tracker.clients == {}
+    assert tracker.stats()["models"]["perplexity/sonar"]["completion_tokens"] == 20
+    assert tracker.adjust_max_tokens("alice", 4000) == 4000
+
+
+def test_state_survives_a_restart(clock, tmp_path):
+    path = str(tmp_path / "budget.json")
+    tracker = server.BudgetTracker(window=3600, client_tokens=1000, state_path=path)
+    tracker.record("alice", "perplexity/sonar", usage(300, 200))
+    asyncio.run(tracker.save(force=True))
+    restored = server.BudgetTracker(window=3600, client_tokens=1000, state_path=path)
+    assert restored.usage("alice") == (500, pytest.approx(0.0005))
+    assert restored.stats()["models"]["perplexity/sonar"]["requests"] == 1
+    
+    (tmp_path / "budget.json").write_text("{truncated")
+    assert server.BudgetTracker(state_path=path).models == {}
+
+
+def test_invalid_price_overrides_are_ignored(monkeypatch, caplog):
+    monkeypatch.setenv(
+        "SONAR_PRICE_TABLE",
+        '{"custom/model": {"prompt": 2, "completion": 4}, "bad/model": {"prompt": "cheap"},'
+        ' "perplexity/sonar": {"prompt": -1}}'
+    )
+    table = server._load_price_table()
+    assert table["custom/model"] == {"prompt": 2, "completion": 4}
+    assert "bad/model" not in table
+    assert table["perplexity/sonar"] == server.DEFAULT_PRICE_TABLE["perplexity/sonar"]
+    assert len(caplog.records) == 2
+    monkeypatch.setenv("SONAR_PRICE_TABLE", "{not json")
+    assert server._load_price_table() == server.DEFAULT_PRICE_TABLE
+
+
+def test_requests_are_charged_to_the_calling_client_and_stopped_at_quota(monkeypatch):
+    tracker = server.BudgetTracker(window=3600, client_tokens=100)
+    monkeypatch.setattr(server, "budget", tracker)
+    messages = [{"role": "user", "content": "charge me"}]
+    
+    async def test(url):
+        token = server._client_key.set("alice")
+        try:
+            await server.request_completion(messages, "perplexity/sonar", 500, 0.2)
+            with pytest.raises(ValueError, match="Usage budget exhausted"):
+                await server.request_completion(messages, "perplexity/sonar", 500, 0.2)
+        finally:
+            server._client_key.reset(token)
+        await server.request_completion(messages, "perplexity/sonar", 500, 0.2)
+    
+    run_with_stub(test, response_chars=800)
+    assert tracker.usage("alice")[0] > 100
+    assert tracker.usage("local")[0] > 0
+    assert tracker.rejected == 1
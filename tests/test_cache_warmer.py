@@ -0,0 +1,102 @@
+import asyncio
+import json
+
+import pytest
+
+from conftest import run_with_stub
+import sonar_mcp_server as server
+
+
+def test_hour_ranges_wrap_around_midnight():
+    assert server._parse_hours("") is None
+    assert server._parse_hours("6-9") == {6, 7, 8, 9}
+    assert server._parse_hours("22-2, 13") == {22, 23, 0, 1, 2, 13}
+
+
+@pytest.mark.parametrize("spec", ["6-x", "morning", "25", "3-24"])
+def test_invalid_hours_mean_always(spec, caplog):
+    assert server._parse_hours(spec) is None
+    assert "SONAR_WARMER_HOURS" in caplog.text
+
+
+def test_popularity_decays_with_the_half_life(clock):
+    warmer = server.CacheWarmer(min_count=1, half_life=3600)
+    for _ in range(4):
+        warmer.observe("What is MCP?", server.SearchDepth.QUICK)
+    warmer.observe("what  is mcp?", server.SearchDepth.QUICK)
+    warmer.observe("rare query", server.SearchDepth.STANDARD)
+    assert warmer.popular() == [
+        ("what  is mcp?", server.SearchDepth.QUICK, 5.0),
+        ("rare query", server.SearchDepth.STANDARD, 1.0)
+    ]
+    clock.advance(3600)
+    assert [count for _, _, count in warmer.popular()] == [2.5]
+
+
+def test_popular_queries_are_refreshed_once_until_they_are_due_again(monkeypatch):
+    warmer = server.CacheWarmer(min_count=1, refresh_ahead=1, daily_tokens=100_000)
+    monkeypatch.setattr(server, "response_cache", server.ResponseCache(100))
+    warmer.observe("warm me", server.SearchDepth.QUICK)
+    
+    async def test(url):
+        return await warmer.warm(), await warmer.warm()
+    
+    assert run_with_stub(test) == (1, 0)
+    assert warmer.tokens_today > 0
+    assert server.response_cache.stats()["entries"] == 1
+    assert not warmer._needs_refresh("warm me", server.SearchDepth.QUICK)
+
+
+def test_no_refresh_without_daily_tokens_or_while_requests_queue(monkeypatch):
+    monkeypatch.setattr(server, "response_cache", server.ResponseCache(100))
+    spent = server.CacheWarmer(min_count=1, daily_tokens=0)
+    spent.observe("warm me", server.SearchDepth.QUICK)
+    assert asyncio.run(spent.warm()) == 0
+    
+    busy = server.CacheWarmer(min_count=1)
+    busy.observe("warm me", server.SearchDepth.QUICK)
+    monkeypatch.setattr(server.upstream_router, "total", lambda field: 1)
+    assert asyncio.run(busy.warm()) == 0
+    assert busy.skipped_busy == 1
+
+
+def test_failed_pass_does_not_stop_the_warmer(monkeypatch, caplog):
+    monkeypatch.setattr(server, "WARMER_INTERVAL", 0)
+    warmer = server.CacheWarmer()
+    passes = 0
+    
+    async def warm():
+        nonlocal passes
+        passes += 1
+        return 0
+    
+    async def save():
+        raise OSError("disk full")
+    
+    monkeypatch.setattr(warmer, "warm", warm)
+    monkeypatch.setattr(warmer, "save", save)
+    
+    async def main():
+        task = asyncio.create_task(warmer._run())
+        while passes < 3:
+            await asyncio.sleep(0)
+        assert not task.done()
+        task.cancel()
+    
+    asyncio.run(main())
+    assert warmer.errors >= 2
+    assert "disk full" in caplog.text
+
+
+def test_state_survives_a_restart_and_a_corrupt_file_is_ignored(tmp_path):
+    path = tmp_path / "warmer.json"
+    warmer = server.CacheWarmer(state_path=str(path))
+    warmer.observe("persist me", server.SearchDepth.DETAILED)
+    warmer.tokens_today = 42
+    asyncio.run(warmer.save())
+    restored = server.CacheWarmer(min_count=1, state_path=str(path))
+    assert restored.popular()[0][:2] == ("persist me", server.SearchDepth.DETAILED)
+    assert restored.tokens_today == 42
+    
+    path.write_text("{truncated")
+    assert server.CacheWarmer(state_path=str(path)).queries == {}
@@ -0,0 +1,82 @@
+import sonar_mcp_server as server
+
+
+def make_breaker():
+    return server.CircuitBreaker(
+        "test/model", window=60, min_calls=4, failure_rate=0.5,
+        slow_call=10, slow_rate=0.75, open_seconds=30, probes=2
+    )
+
+
+def record(breaker, *outcomes, seconds=1.0):
+    for failed in outcomes:
+        assert breaker.allow()
+        breaker.record(failed, seconds)
+
+
+def test_opens_once_failure_rate_is_reached_with_enough_calls(clock):
+    breaker = make_breaker()
+    record(breaker, True, True, True)
+    assert breaker.state == "closed"  # below min_calls
+    record(breaker, False)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.rejected == 1
+    assert breaker.retry_in() == 30
+
+
+def test_slow_calls_open_the_circuit(clock):
+    breaker = make_breaker()
+    record(breaker, False, False, False, seconds=10)
+    record(breaker, False)
+    assert breaker.state == "open"
+
+
+def test_outcomes_outside_the_window_are_forgotten(clock):
+    breaker = make_breaker()
+    record(breaker, True, True, True)
+    clock.advance(61)
+    record(breaker, False, False, False, False)
+    assert breaker.state == "closed"
+    assert breaker.stats()["recent_calls"] == 4
+
+
+def test_half_open_admits_probes_and_closes_when_all_succeed(clock):
+    breaker = make_breaker()
+    record(breaker, True, True, True, True)
+    clock.advance(29.9)
+    assert not breaker.allow()
+    clock.advance(0.1)
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()  # both probes in flight
+    breaker.record(False, 1.0)
+    assert breaker.state == "half_open"
+    breaker.record(False, 1.0)
+    assert breaker.state == "closed"
+    assert breaker.stats()["recent_calls"] == 0
+
+
+def test_failed_or_slow_probe_reopens(clock):
+    breaker = make_breaker()
+    record(breaker, True, True, True, True)
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.record(True, 1.0)
+    assert breaker.state == "open"
+    assert breaker.retry_in() == 30
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.record(False, 10.0)
+    assert breaker.state == "open"
+
+
+def test_released_probe_frees_its_slot(clock):
+    breaker = make_breaker()
+    record(breaker, True, True, True, True)
+    clock.advance(30)
+    assert breaker.allow() and breaker.allow()
+    breaker.release()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
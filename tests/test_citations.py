@@ -0,0 +1,17 @@
+import sonar_mcp_server as server
+
+
+def test_renumber_citations_keeps_unmapped_markers():
+    text = "A [1], B [2][3] and C [10]."
+    assert server.renumber_citations(text, {1: 2, 2: 1, 3: 1}) == "A [2], B [1][1] and C [10]."
+
+
+def test_duplicate_urls_in_a_response_share_one_number():
+    response = {
+        "choices": [{"message": {"content": "X [1]. Y [2]. Z [3]."}}],
+        "citations": ["https://a.example", "https://b.example", "https://a.example"],
+        "search_results": [{"url": "https://b.example", "title": "B"}]
+    }
+    content, citations = server.extract_answer(response)
+    assert content == "X [1]. Y [2]. Z [1]."
+    assert citations == [{"url": "https://a.example"}, {"url": "https://b.example", "title": "B"}]
@@ -0,0 +1,102 @@
+import asyncio
+from typing import Optional
+
+import pytest
+from pydantic import BaseModel
+
+import sonar_mcp_server as server
+
+
+class SearchParams(BaseModel):
+    depth: server.SearchDepth = server.SearchDepth.QUICK
+    timeout_seconds: Optional[float] = None
+
+
+def deadline_seen_by(tool: str, params: BaseModel) -> Optional[float]:
+    @server.instrumented(tool)
+    async def probe(params):
+        return server.current_deadline()
+    
+    return asyncio.run(probe(params))
+
+
+def test_tool_timeouts_prefer_depth_then_tool_then_request_deadline():
+    assert server.tool_timeout("sonar_search", "quick") == 30.0
+    assert server.tool_timeout("sonar_search", "detailed") == 90.0
+    assert server.tool_timeout("sonar_research") == 240.0
+    assert server.tool_timeout("sonar_get_page") == server.REQUEST_DEADLINE
+
+
+@pytest.mark.parametrize("key, seconds", [
+    ("sonar_unknown", 10),
+    ("sonar_search:extreme", 10),
+    ("sonar_ask", 0),
+    ("sonar_ask", True),
+    ("sonar_ask", float("inf")),
+    ("sonar_ask", "60")
+])
+def test_invalid_tool_timeout_overrides_are_rejected(key, seconds):
+    assert not server._valid_tool_timeout(key, seconds)
+
+
+def test_instrumented_call_deadline_comes_from_timeout_seconds_or_tool_limit(clock):
+    assert deadline_seen_by("sonar_search", SearchParams()) == clock.now + 30.0
+    assert deadline_seen_by("sonar_search", SearchParams(timeout_seconds=5)) == clock.now + 5
+    assert server._deadline.get() is None
+
+
+def test_current_deadline_only_tightens(clock):
+    assert server.current_deadline() is None
+    assert server.current_deadline(within=20) == clock.now + 20
+    token = server._deadline.set(clock.now + 10)
+    try:
+        assert server.current_deadline() == clock.now + 10
+        assert server.current_deadline(within=20) == clock.now + 10
+        assert server.current_deadline(within=5) == clock.now + 5
+    finally:
+        server._deadline.reset(token)
+
+
+def test_request_timeout_phases_never_outlast_the_deadline(clock):
+    unbounded = server.request_timeout("perplexity/sonar", 1000)
+    assert unbounded.connect == server.CONNECT_TIMEOUT
+    assert unbounded.read == server.REQUEST_TIMEOUT
+    token = server._deadline.set(clock.now + 4)
+    try:
+        bounded = server.request_timeout("perplexity/sonar", 1000, stream=True)
+        assert (bounded.connect, bounded.read, bounded.write, bounded.pool) == (4, 4, 4, 4)
+        clock.advance(10)
+        assert server.request_timeout("perplexity/sonar", 1000).read == 0.1
+    finally:
+        server._deadline.reset(token)
+
+
+def test_adaptive_read_timeout_follows_p99_within_bounds():
+    timeouts = server.AdaptiveTimeouts(enabled=True, multiplier=3.0, floor=10.0, min_samples=5)
+    for seconds in (1, 2, 2, 3, 8):
+        timeouts.record("perplexity/sonar", 900, seconds)
+    assert timeouts.read_timeout("perplexity/sonar", 1000) == 24.0
+    # Token budgets share a window per thousand, so 1,500 is a fresh bucket
+    assert timeouts.read_timeout("perplexity/sonar", 1500) == server.REQUEST_TIMEOUT
+    
+    fast = server.AdaptiveTimeouts(enabled=True, multiplier=3.0, floor=10.0, min_samples=5)
+    slow = server.AdaptiveTimeouts(enabled=True, multiplier=3.0, floor=10.0, min_samples=5)
+    off = server.AdaptiveTimeouts(enabled=False, min_samples=5)
+    for _ in range(5):
+        fast.record("perplexity/sonar", 1000, 0.5)
+        slow.record("perplexity/sonar", 1000, 100)
+        off.record("perplexity/sonar", 1000, 0.5)
+    assert fast.read_timeout("perplexity/sonar", 1000) == 10.0
+    assert slow.read_timeout("perplexity/sonar", 1000) == server.REQUEST_TIMEOUT
+    assert off.read_timeout("perplexity/sonar", 1000) == server.REQUEST_TIMEOUT
+
+
+def test_call_gives_up_at_the_deadline_with_a_hint():
+    async def hang():
+        await asyncio.sleep(10)
+    
+    async def main():
+        return await server.call_with_retries(hang, server.time.monotonic() + 0.1)
+    
+    with pytest.raises(server.UpstreamError, match="timeout_seconds"):
+        asyncio.run(main())
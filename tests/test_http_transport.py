@@ -0,0 +1,75 @@
+import asyncio
+import json
+import signal
+
+import pytest
+
+from conftest import call, mcp_session
+import sonar_mcp_server as server
+
+
+def readiness() -> tuple:
+    async def probe():
+        response = await server.health_ready(None)
+        return response.status_code, json.loads(response.body)
+    return asyncio.run(probe())
+
+
+@pytest.fixture
+def recorded_sigterm():
+    """Stand in for uvicorn's SIGTERM handler and record when it runs."""
+    calls = []
+    previous = signal.signal(signal.SIGTERM, lambda signum, frame: calls.append(signum))
+    yield calls
+    signal.signal(signal.SIGTERM, previous)
+
+
+def test_sigterm_flips_readiness_and_refuses_calls_before_draining(monkeypatch, recorded_sigterm):
+    monkeypatch.setattr(server, "DRAIN_TIMEOUT", 5.0)
+    app = server.create_http_app()
+    seen = {}
+    
+    async def main():
+        async with app.router.lifespan_context(app):
+            seen["ready"] = (await server.health_ready(None)).status_code
+            # A call that is still running when the signal arrives
+            server._active_calls += 1
+            signal.raise_signal(signal.SIGTERM)
+            seen["draining"] = (await server.health_ready(None)).status_code
+            async with mcp_session() as session:
+                with pytest.raises(ValueError, match="shutting down"):
+                    await call(session, "sonar_get_page", handle="missing", offset=0)
+            await asyncio.sleep(0.3)
+            seen["handed_over_while_busy"] = list(recorded_sigterm)
+            server._active_calls -= 1
+            await server._drain_task
+            seen["handed_over"] = list(recorded_sigterm)
+    
+    try:
+        asyncio.run(main())
+    finally:
+        server._draining = False
+    assert seen["ready"] == 200
+    assert seen["draining"] == 503
+    assert seen["handed_over_while_busy"] == []
+    assert seen["handed_over"] == [signal.SIGTERM]
+
+
+def test_drain_gives_up_after_timeout(clock):
+    server._active_calls += 1
+    
+    async def main():
+        task = asyncio.create_task(server.drain_active_calls(timeout=1.0))
+        await asyncio.sleep(0.15)
+        assert not task.done()
+        clock.advance(1.5)
+        await asyncio.wait_for(task, timeout=1.0)
+    
+    try:
+        asyncio.run(main())
+        status, body = readiness()
+    finally:
+        server._active_calls -= 1
+        server._draining = False
+    assert status == 503
+    assert body["checks"]["accepting"] is False
@@ -0,0 +1,133 @@
+import asyncio
+import json
+
+import pytest
+
+from conftest import call, mcp_session, run_with_stub
+import sonar_mcp_server as server
+
+
+def blocked_runner(release, ran, name):
+    async def run(job_ctx):
+        ran.append(name)
+        await release.wait()
+        return name
+    return run
+
+
+def test_jobs_run_in_priority_then_submission_order_and_report_positions(clock):
+    manager = server.JobManager(workers=1)
+    ran = []
+    
+    async def main():
+        release = asyncio.Event()
+        first = manager.submit("sonar_research", {}, "alice", blocked_runner(release, ran, "first"))
+        await asyncio.sleep(0)
+        # Same clock tick: only the queue's sequence tells these apart
+        jobs = [
+            manager.submit(tool, {}, "alice", blocked_runner(release, ran, name))
+            for tool, name in (("sonar_research", "r1"), ("sonar_research", "r2"), ("sonar_reason", "x"))
+        ]
+        positions = [manager.position(job) for job in (first, *jobs)]
+        release.set()
+        while manager.count("succeeded") < 4:
+            await asyncio.sleep(0)
+        manager.shutdown()
+        return positions, [job.result for job in jobs]
+    
+    positions, results = asyncio.run(main())
+    assert positions == [None, 2, 3, 1]
+    assert ran == ["first", "x", "r1", "r2"]
+    assert results == ["r1", "r2", "x"]
+
+
+def test_full_queue_rejects_submissions():
+    manager = server.JobManager(workers=1, max_queued=1)
+    
+    async def main():
+        release = asyncio.Event()
+        manager.submit("sonar_research", {}, "alice", blocked_runner(release, [], "a"))
+        await asyncio.sleep(0)
+        manager.submit("sonar_research", {}, "alice", blocked_runner(release, [], "b"))
+        with pytest.raises(ValueError, match="Job queue is full"):
+            manager.submit("sonar_research", {}, "alice", blocked_runner(release, [], "c"))
+        manager.shutdown()
+    
+    asyncio.run(main())
+    assert manager.rejected == 1
+
+
+def test_cancel_queued_and_running_jobs():
+    manager = server.JobManager(workers=1)
+    
+    async def main():
+        release = asyncio.Event()
+        running = manager.submit("sonar_research", {}, "alice", blocked_runner(release, [], "a"))
+        queued = manager.submit("sonar_research", {}, "alice", blocked_runner(release, [], "b"))
+        await asyncio.sleep(0)
+        await manager.cancel(queued)
+        await manager.cancel(running)
+        manager.shutdown()
+        return running.status, queued.status
+    
+    assert asyncio.run(main()) == ("cancelled", "cancelled")
+
+
+def test_failed_job_keeps_its_error():
+    manager = server.JobManager(workers=1)
+    
+    async def fail(job_ctx):
+        await job_ctx.report_progress(1, 2, "halfway")
+        raise ValueError("upstream broke")
+    
+    async def main():
+        job = manager.submit("sonar_reason", {}, "alice", fail)
+        while not job.finished:
+            await asyncio.sleep(0)
+        manager.shutdown()
+        return job
+    
+    job = asyncio.run(main())
+    assert (job.status, job.error) == ("failed", "upstream broke")
+    assert job.describe()["progress"]["message"] == "halfway"
+
+
+def test_unfinished_jobs_are_failed_after_a_restart(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    manager = server.JobManager(workers=1, db_path=path)
+    
+    async def main():
+        release = asyncio.Event()
+        done = manager.submit("sonar_research", {}, "alice", lambda job_ctx: asyncio.sleep(0, result="answer"))
+        manager.submit("sonar_research", {}, "alice", blocked_runner(release, [], "b"))
+        queued = manager.submit("sonar_research", {}, "alice", blocked_runner(release, [], "c"))
+        while not done.finished:
+            await asyncio.sleep(0)
+        # The process "dies" here: the loop ends with the last job still queued
+        return done.id, queued.id
+    
+    done_id, pending_id = asyncio.run(main())
+    restored = server.JobManager(db_path=path)
+    assert restored.get(done_id).result == "answer"
+    assert restored.get(pending_id).status == "failed"
+    assert "restarted" in restored.get(pending_id).error
+
+
+def test_jobs_are_only_visible_to_their_client():
+    async def test(url):
+        async with mcp_session() as session:
+            submitted = await call(
+                session, "sonar_reason", client_id="alice", problem="Pick a queue design for jobs",
+                background=True, response_format="json"
+            )
+            job_id = json.loads(submitted)["job_id"]
+            for tool in ("sonar_job_status", "sonar_job_result", "sonar_job_cancel"):
+                with pytest.raises(ValueError, match="unknown"):
+                    await call(session, tool, client_id="bob", job_id=job_id)
+            while json.loads(await call(
+                session, "sonar_job_status", client_id="alice", job_id=job_id, response_format="json"
+            ))["status"] != "succeeded":
+                await asyncio.sleep(0.01)
+            return await call(session, "sonar_job_result", client_id="alice", job_id=job_id)
+    
+    assert "lorem ipsum" in run_with_stub(test)
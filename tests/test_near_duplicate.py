@@ -0,0 +1,80 @@
+from conftest import run_with_stub
+import sonar_mcp_server as server
+
+
+def test_terms_fold_case_stop_words_plurals_and_synonyms():
+    terms = server.NearDuplicateIndex.terms
+    assert terms("What are the LATEST Python releases?") == terms("newest python release")
+    assert terms("the of and") == frozenset()
+
+
+def test_rephrased_query_finds_the_indexed_key():
+    index = server.NearDuplicateIndex(threshold=0.8)
+    index.add("search", "latest python release notes", "key-1")
+    assert index.lookup("search", "What are the newest Python releases notes?") == "key-1"
+    assert index.lookup("search", "python packaging tutorial") is None
+    assert index.stats()["lookups"] == 2
+    assert index.stats()["matches"] == 1
+
+
+def test_numbers_and_versions_must_match_exactly():
+    index = server.NearDuplicateIndex(threshold=0.5)
+    index.add("search", "python 3.12 release highlights", "py312")
+    assert index.lookup("search", "python 3.13 release highlights") is None
+    assert index.lookup("search", "release highlights python 3.12") == "py312"
+
+
+def test_scopes_are_isolated():
+    index = server.NearDuplicateIndex()
+    index.add("perplexity/sonar|1000|0.2|search", "kubernetes pod autoscaling", "sonar")
+    assert index.lookup("perplexity/sonar-pro|1000|0.2|search", "kubernetes pod autoscaling") is None
+    assert index.lookup("perplexity/sonar|1000|0.2|search", "Kubernetes pods autoscaling") == "sonar"
+
+
+def test_discard_and_eviction_remove_keys_from_their_buckets():
+    index = server.NearDuplicateIndex(max_entries=2)
+    index.add("s", "rust async runtime comparison", "rust")
+    index.add("s", "go garbage collector tuning", "go")
+    index.discard("go")
+    index.discard("go")
+    assert index.lookup("s", "go garbage collector tuning") is None
+    index.add("s", "zig build system", "zig")
+    index.add("s", "ocaml effect handlers", "ocaml")
+    assert index.stats()["entries"] == 2
+    assert index.lookup("s", "rust async runtime comparison") is None
+    assert not any(
+        key == "rust" or (isinstance(key, list) and "rust" in key) for key in index._buckets.values()
+    )
+
+
+def test_re_adding_a_key_replaces_its_old_query():
+    index = server.NearDuplicateIndex()
+    index.add("s", "redis cluster failover", "key")
+    index.add("s", "postgres logical replication", "key")
+    assert index.lookup("s", "redis cluster failover") is None
+    assert index.lookup("s", "postgres logical replication") == "key"
+
+
+def test_rephrased_request_is_served_from_the_cache(monkeypatch):
+    monkeypatch.setattr(server, "CACHE_ENABLED", True)
+    monkeypatch.setattr(server, "SIMILAR_CACHE_ENABLED", True)
+    monkeypatch.setattr(server, "response_cache", server.ResponseCache())
+    monkeypatch.setattr(server, "similar_queries", server.NearDuplicateIndex())
+    
+    def ask(query):
+        return server.request_completion(
+            [{"role": "user", "content": query}], "perplexity/sonar", 500, 0.2,
+            ttl=60, similar=("search", query)
+        )
+    
+    async def test(url):
+        first, cached = await ask("latest python release notes")
+        again, again_cached = await ask("What are the newest Python releases notes?")
+        other, other_cached = await ask("python 3.13 release notes")
+        return first["id"], cached, again["id"], again_cached, other["id"], other_cached
+    
+    first, cached, again, again_cached, other, other_cached = run_with_stub(test)
+    assert (cached, again_cached, other_cached) == (False, True, False)
+    assert again == first
+    assert other != first
+    assert server.similar_queries.hits == 1
@@ -0,0 +1,86 @@
+import asyncio
+import json
+
+import pytest
+
+import sonar_mcp_server as server
+
+
+def test_text_that_fits_is_one_page():
+    text = "x" * 40
+    assert server.page_end(text, 0, max_tokens=10) == 40
+    assert server.page_end(text + "tail", 4, max_tokens=10) == 44
+
+
+def test_page_ends_before_a_heading():
+    text = "intro text, long enough." + "\n# Heading\n" + "y" * 60
+    end = server.page_end(text, 0, max_tokens=10)
+    assert text[:end] == "intro text, long enough.\n"
+    assert text[end:].startswith("# Heading")
+
+
+def test_page_ends_after_the_best_separator():
+    text = "a" * 25 + "\n\n" + "b" * 5 + ". " + "c" * 40
+    assert server.page_end(text, 0, max_tokens=10) == 27
+    text = "a" * 30 + ". " + "b" * 3 + " " + "c" * 40
+    assert server.page_end(text, 0, max_tokens=10) == 32
+
+
+def test_break_that_would_leave_the_page_under_half_full_is_skipped():
+    text = "a" * 5 + "\n\n" + "b" * 80
+    assert server.page_end(text, 0, max_tokens=10) == 40
+
+
+def test_later_pages_are_measured_from_their_offset():
+    text = "w" * 50 + "words " * 20
+    assert server.page_end(text, 50, max_tokens=10) == 86
+
+
+def test_paginate_stores_the_rest_for_the_next_page():
+    content = "word " * (server.PAGE_TOKENS * server.CHARS_PER_TOKEN // 4)
+    page, info = server.paginate(content)
+    assert info["next_offset"] == len(page) == server.page_end(content, 0)
+    assert info["total_chars"] == len(content)
+    assert server.result_store.get(info["handle"], "local") == content
+    assert server.paginate("short") == ("short", None)
+
+
+def test_stored_results_expire_and_are_evicted_by_size(clock):
+    store = server.ResultStore(max_chars=100, ttl=60)
+    old = store.put("a" * 60, "alice")
+    new = store.put("b" * 30, "alice")
+    clock.advance(59)
+    assert store.get(old, "alice") == "a" * 60
+    newest = store.put("c" * 30, "alice")  # over 100 chars: least recently read goes
+    assert store.get(new, "alice") is None
+    assert store.get(old, "alice") is not None
+    clock.advance(1)
+    assert store.get(old, "alice") is None
+    assert store.get(newest, "alice") == "c" * 30
+    assert (store.evictions, store.expirations) == (1, 1)
+
+
+def test_results_are_only_readable_by_their_client():
+    store = server.ResultStore()
+    handle = store.put("private answer", "session:alice")
+    assert store.get(handle, "session:bob") is None
+    assert store.get(handle, "session:alice") == "private answer"
+
+
+def test_get_page_serves_later_pages_to_the_same_client_only():
+    text = "First part. " * 20 + "\n\n" + "Second part. " * 20
+    
+    def get_page(client, **params):
+        async def main():
+            token = server._client_key.set(client)
+            try:
+                return await server.sonar_get_page(server.SonarGetPageInput(**params), None)
+            finally:
+                server._client_key.reset(token)
+        return asyncio.run(main())
+    
+    handle = server.result_store.put(text, "session:alice")
+    page = get_page("session:alice", handle=handle, offset=240, response_format="json")
+    assert json.loads(page)["answer"] == text[240:]
+    with pytest.raises(ValueError, match="unknown or has expired"):
+        get_page("session:bob", handle=handle, offset=240)
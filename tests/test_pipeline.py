@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+import pytest
+
+from conftest import run_with_stub
+import sonar_mcp_server as server
+
+
+class Recorder(server.Middleware):
+    """Middleware appending each hook it runs to a shared event list."""
+    
+    def __init__(self, name, events, fail_before=False):
+        self.name = name
+        self.events = events
+        self.fail_before = fail_before
+    
+    def prepare(self, request):
+        self.events.append(f"prepare:{self.name}")
+    
+    async def before(self, request):
+        self.events.append(f"before:{self.name}")
+        if self.fail_before:
+            raise RuntimeError("refused")
+    
+    async def after(self, request):
+        self.events.append(f"after:{self.name}")
+    
+    async def on_error(self, request, error):
+        self.events.append(f"on_error:{self.name}")
+
+
+def fetched_request(fetch=None):
+    async def answer():
+        return "answer", [], {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3}
+    
+    return server.ToolRequest(
+        "sonar_research", "prompt", "perplexity/sonar", 500, 0.2, fetch=fetch or answer
+    )
+
+
+def test_hooks_run_in_order_before_and_in_reverse_after():
+    events = []
+    pipeline = server.RequestPipeline([Recorder("a", events), Recorder("b", events)])
+    request = asyncio.run(pipeline.run(fetched_request()))
+    assert events == ["prepare:a", "prepare:b", "before:a", "before:b", "after:b", "after:a"]
+    assert request.content == "answer"
+    assert list(request.timings) == ["before:a", "before:b", "upstream", "after:b", "after:a"]
+
+
+def test_failing_before_unwinds_only_the_middleware_entered():
+    events = []
+    pipeline = server.RequestPipeline([
+        Recorder("a", events), Recorder("b", events, fail_before=True), Recorder("c", events)
+    ])
+    with pytest.raises(RuntimeError, match="refused"):
+        asyncio.run(pipeline.run(fetched_request()))
+    assert events[3:] == ["before:a", "before:b", "on_error:b", "on_error:a"]
+
+
+def test_upstream_failure_reaches_every_middleware_in_reverse():
+    events = []
+    pipeline = server.RequestPipeline([Recorder("a", events)])
+    pipeline.use(Recorder("b", events))
+    
+    async def fail():
+        raise server.UpstreamError("down", 503)
+    
+    with pytest.raises(server.UpstreamError):
+        asyncio.run(pipeline.run(fetched_request(fail)))
+    assert events[2:] == ["before:a", "before:b", "on_error:b", "on_error:a"]
+
+
+def test_build_pipeline_uses_the_registry_in_the_given_order():
+    pipeline = server.build_pipeline(["timings", "warmer"])
+    assert [m.name for m in pipeline.middleware] == ["timings", "warmer"]
+    with pytest.raises(ValueError, match="available: warmer, timings, router"):
+        server.build_pipeline(["warmer", "compression"])
+
+
+def test_timings_middleware_adds_stage_times_to_the_answer():
+    pipeline = server.build_pipeline(["timings"])
+    
+    async def test(url):
+        request = server.ToolRequest(
+            "sonar_ask", "What is MCP?", "perplexity/sonar", 500, 0.2,
+            response_format=server.ResponseFormat.JSON
+        )
+        return json.loads(await pipeline.respond(request))
+    
+    answer = run_with_stub(test)
+    timings = answer["metadata"]["timings_ms"]
+    assert set(timings) == {"before:timings", "upstream", "extract"}
+
+
+def test_unknown_configured_middleware_is_skipped_with_a_warning(caplog):
+    pipeline = server._configured_pipeline(["warmer", "compression", "router"])
+    assert [m.name for m in pipeline.middleware] == ["warmer", "router"]
+    assert "compression" in caplog.text
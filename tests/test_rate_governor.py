@@ -0,0 +1,80 @@
+import asyncio
+
+import httpx
+import pytest
+
+import sonar_mcp_server as server
+
+
+def run_calls(governor, *responses):
+    """Run one call per response (None: no response seen) through the governor, in order."""
+    async def main():
+        for response in responses:
+            async with governor.slot() as observe:
+                if response is not None:
+                    observe(response)
+    
+    asyncio.run(main())
+
+
+def test_limit_grows_additively_up_to_the_maximum(clock):
+    governor = server.RateGovernor(rate=0, initial_limit=2, max_limit=3, max_wait=0)
+    run_calls(governor, httpx.Response(200))
+    assert governor.limit == 2.5
+    run_calls(governor, httpx.Response(200))
+    assert governor.limit == 2.9
+    run_calls(governor, *[httpx.Response(200)] * 5)
+    assert governor.limit == 3.0
+
+
+def test_limit_halves_on_throttling_but_not_below_one(clock):
+    governor = server.RateGovernor(rate=0, initial_limit=8, max_limit=8, max_wait=0)
+    run_calls(governor, httpx.Response(429))
+    assert governor.limit == 4.0
+    run_calls(governor, httpx.Response(503), httpx.Response(429), httpx.Response(429))
+    assert governor.limit == 1.0
+    run_calls(governor, httpx.Response(500), httpx.Response(404))
+    assert governor.limit == 1.0
+    assert governor.throttled == 4
+
+
+def test_retry_after_pauses_new_calls(clock):
+    governor = server.RateGovernor(rate=0, initial_limit=4, max_limit=4, max_wait=0)
+    run_calls(governor, httpx.Response(429, headers={"Retry-After": "5"}))
+    assert governor.stats()["paused_for_seconds"] == 5.0
+    with pytest.raises(ValueError, match="Server is busy"):
+        run_calls(governor, httpx.Response(200))
+    clock.advance(5)
+    run_calls(governor, httpx.Response(200))
+    assert governor.queue_timeouts == 1
+
+
+def test_exhausted_rate_limit_window_pauses_without_halving(clock):
+    governor = server.RateGovernor(rate=0, initial_limit=2, max_limit=2, max_wait=0)
+    headers = {"x-ratelimit-remaining": "0", "x-ratelimit-reset": str(clock.now + 3)}
+    run_calls(governor, httpx.Response(200, headers=headers))
+    assert governor.limit == 2.0
+    assert governor.stats()["paused_for_seconds"] == 3.0
+
+
+def test_full_concurrency_limit_rejects_after_max_wait(clock):
+    governor = server.RateGovernor(rate=0, initial_limit=1, max_limit=1, max_wait=0)
+    
+    async def main():
+        async with governor.slot():
+            with pytest.raises(ValueError, match="Server is busy"):
+                async with governor.slot():
+                    pass
+            assert governor.in_flight == 1
+        assert governor.in_flight == 0
+    
+    asyncio.run(main())
+
+
+def test_token_bucket_allows_a_burst_then_refills(clock):
+    governor = server.RateGovernor(rate=2, burst=2, initial_limit=4, max_limit=4, max_wait=0)
+    run_calls(governor, None, None)
+    with pytest.raises(ValueError, match="Server is busy"):
+        run_calls(governor, None)
+    clock.advance(0.5)
+    run_calls(governor, None)
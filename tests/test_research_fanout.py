@@ -0,0 +1,25 @@
+import sonar_mcp_server as server
+
+
+def test_merged_sections_share_a_deduplicated_source_list():
+    sections = [
+        {
+            "area": "History",
+            "content": "  Old [1], older [2].  ",
+            "citations": [{"url": "https://a.example"}, {"url": "https://b.example"}]
+        },
+        {"area": "Pricing", "error": "timed out"},
+        {
+            "area": "Outlook",
+            "content": "Next [1], also [2].",
+            "citations": [{"url": "https://c.example"}, {"url": "https://a.example"}]
+        }
+    ]
+    report, sources = server.merge_research_sections(sections)
+    assert [s["url"] for s in sources] == ["https://a.example", "https://b.example", "https://c.example"]
+    assert report == (
+        "## 1. History\n\nOld [1], older [2].\n\n"
+        "## 2. Pricing\n\n**⚠️ Not available:** timed out\n\n"
+        "## 3. Outlook\n\nNext [3], also [1]."
+    )
+
@@ -0,0 +1,53 @@
+import asyncio
+
+import sonar_mcp_server as server
+
+
+def test_entries_expire_after_their_ttl(clock):
+    cache = server.ResponseCache(max_entries=10)
+    
+    async def main():
+        await cache.set("key", {"id": 1}, ttl=60)
+        clock.advance(59.9)
+        fresh = await cache.get("key")
+        clock.advance(0.1)
+        return fresh, await cache.get("key")
+    
+    assert asyncio.run(main()) == ({"id": 1}, None)
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = server.ResponseCache(max_entries=2)
+    
+    async def main():
+        await cache.set("a", {"id": "a"}, ttl=60)
+        await cache.set("b", {"id": "b"}, ttl=60)
+        await cache.get("a")
+        await cache.set("c", {"id": "c"}, ttl=60)
+        return [await cache.get(key) for key in ("a", "b", "c")]
+    
+    assert asyncio.run(main()) == [{"id": "a"}, None, {"id": "c"}]
+    assert cache.evictions == 1
+
+
+def test_persisted_entries_survive_a_restart_until_they_expire(clock, tmp_path):
+    path = str(tmp_path / "cache.db")
+    
+    async def main():
+        await server.ResponseCache(db_path=path).set("key", {"id": 1}, ttl=60)
+        restored = await server.ResponseCache(db_path=path).get("key")
+        clock.advance(60)
+        return restored, await server.ResponseCache(db_path=path).get("key")
+    
+    assert asyncio.run(main()) == ({"id": 1}, None)
+
+
+def test_key_ignores_whitespace_and_case_but_not_parameters():
+    key = server.ResponseCache.make_key
+    messages = [{"role": "user", "content": "What  is\nMCP?"}]
+    same = [{"role": "user", "content": "what is mcp?"}]
+    assert key(messages, "m", 100, 0.2) == key(same, "m", 100, 0.2)
+    assert key(messages, "m", 100, 0.2) != key(messages, "m", 200, 0.2)
+    assert key(messages, "m", 100, 0.2) != key(messages, "other", 100, 0.2)
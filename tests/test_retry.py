@@ -0,0 +1,166 @@
+import asyncio
+
+import httpx
+import pytest
+
+import sonar_mcp_server as server
+
+
+@pytest.fixture(autouse=True)
+def fresh_engine(monkeypatch):
+    monkeypatch.setattr(server, "retry_budget", server.RetryBudget(ratio=0.1, capacity=10))
+    monkeypatch.setattr(server, "retry_stats", dict.fromkeys(server.retry_stats, 0))
+
+
+def no_wait_policy(max_attempts=3):
+    return server.RetryPolicy(max_attempts=max_attempts, base_delay=0, max_delay=0)
+
+
+def failing_then(result, *errors):
+    """Attempt factory raising errors in order, then returning result."""
+    calls = []
+    
+    async def attempt():
+        calls.append(len(calls))
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+    
+    return attempt, calls
+
+
+def test_transient_failures_are_retried(clock):
+    attempt, calls = failing_then("ok", server.UpstreamError("busy", 503), server.UpstreamError("busy", 429))
+    result = asyncio.run(server.call_with_retries(attempt, clock.now + 60, no_wait_policy()))
+    assert result == "ok"
+    assert len(calls) == 3
+    assert server.retry_stats["retries"] == 2
+
+
+def test_client_errors_and_exhausted_attempts_are_not_retried(clock):
+    attempt, calls = failing_then("ok", server.UpstreamError("bad request", 400))
+    with pytest.raises(server.UpstreamError, match="bad request"):
+        asyncio.run(server.call_with_retries(attempt, clock.now + 60, no_wait_policy()))
+    assert len(calls) == 1
+    
+    attempt, calls = failing_then("ok", *[server.UpstreamError("down", 502)] * 2)
+    with pytest.raises(server.UpstreamError, match="down"):
+        asyncio.run(server.call_with_retries(attempt, clock.now + 60, no_wait_policy(max_attempts=2)))
+    assert len(calls) == 2
+
+
+def test_network_errors_are_retried_by_cause(clock):
+    error = server.UpstreamError("unreachable")
+    error.__cause__ = httpx.ConnectError("refused")
+    attempt, calls = failing_then("ok", error)
+    assert asyncio.run(server.call_with_retries(attempt, clock.now + 60, no_wait_policy())) == "ok"
+
+
+def test_empty_retry_budget_stops_retries(clock, monkeypatch):
+    monkeypatch.setattr(server, "retry_budget", server.RetryBudget(ratio=0.1, capacity=0))
+    attempt, calls = failing_then("ok", server.UpstreamError("busy", 503))
+    with pytest.raises(server.UpstreamError):
+        asyncio.run(server.call_with_retries(attempt, clock.now + 60, no_wait_policy()))
+    assert len(calls) == 1
+    assert server.retry_budget.exhausted == 1
+
+
+def test_budget_refills_by_ratio_per_first_attempt():
+    budget = server.RetryBudget(ratio=0.5, capacity=2)
+    assert budget.try_spend() and budget.try_spend()
+    assert not budget.try_spend()
+    budget.deposit()
+    assert not budget.try_spend()
+    budget.deposit()
+    assert budget.try_spend()
+    assert (budget.spent, budget.exhausted) == (3, 2)
+
+
+def test_retry_after_beyond_the_deadline_gives_up(clock):
+    attempt, calls = failing_then("ok", server.UpstreamError("slow down", 429, retry_after=30))
+    with pytest.raises(server.UpstreamError, match="slow down"):
+        asyncio.run(server.call_with_retries(attempt, clock.now + 10, no_wait_policy()))
+    assert len(calls) == 1
+    assert server.retry_stats["gave_up_deadline"] == 1
+
+
+def test_passed_deadline_fails_without_calling_upstream(clock):
+    attempt, calls = failing_then("ok")
+    with pytest.raises(server.UpstreamError, match="deadline exceeded"):
+        asyncio.run(server.call_with_retries(attempt, clock.now - 1, no_wait_policy()))
+    assert calls == []
+
+
+def test_backoff_is_jittered_below_the_ceiling_and_honours_retry_after():
+    policy = server.RetryPolicy(base_delay=1, max_delay=3)
+    assert all(0 <= policy.backoff(1) <= 1 for _ in range(50))
+    assert all(0 <= policy.backoff(5) <= 3 for _ in range(50))
+    assert policy.backoff(1, retry_after=7) == 7
+
+
+def test_slow_primary_is_hedged_and_the_hedge_wins():
+    calls = 0
+    
+    async def call():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(1 if calls == 1 else 0)
+        return calls
+    
+    assert asyncio.run(server._hedged(call, 0.01)) == 2
+    assert server.retry_stats["hedges"] == server.retry_stats["hedge_wins"] == 1
+
+
+def test_fast_primary_is_not_hedged():
+    assert asyncio.run(server._hedged(lambda: asyncio.sleep(0, result="primary"), 1)) == "primary"
+    assert server.retry_stats["hedges"] == 0
+
+
+def test_hedge_succeeding_alongside_a_failed_primary_wins():
+    async def main():
+        release = asyncio.Event()
+        calls = 0
+        
+        async def call():
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                await release.wait()
+                raise server.UpstreamError("primary failed", 502)
+            release.set()
+            await asyncio.sleep(0)
+            return "hedge"
+        
+        return await server._hedged(call, 0.01)
+    
+    for _ in range(5):
+        assert asyncio.run(main()) == "hedge"
+
+
+def test_primary_error_is_raised_when_every_copy_fails():
+    calls = 0
+    
+    async def call():
+        nonlocal calls
+        calls += 1
+        number = calls
+        await asyncio.sleep(0.05 if number == 1 else 0.1)
+        raise server.UpstreamError(f"copy {number} failed", 502)
+    
+    with pytest.raises(server.UpstreamError, match="failed"):
+        asyncio.run(server._hedged(call, 0.01))
+    assert calls == 2
+
+
+def test_no_hedge_without_retry_budget(monkeypatch):
+    monkeypatch.setattr(server, "retry_budget", server.RetryBudget(ratio=0.1, capacity=0))
+    calls = 0
+    
+    async def call():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return "primary"
+    
+    assert asyncio.run(server._hedged(call, 0.01)) == "primary"
+    assert calls == 1
@@ -0,0 +1,89 @@
+import asyncio
+
+from conftest import run_with_stub
+import sonar_mcp_server as server
+
+
+def test_waiters_share_one_call():
+    flights = server.SingleFlight()
+    calls = 0
+    
+    async def work():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "answer"
+    
+    async def main():
+        return await asyncio.gather(*(flights.do("key", work) for _ in range(3)))
+    
+    assert asyncio.run(main()) == ["answer"] * 3
+    assert calls == 1
+    assert flights.stats() == {"in_flight": 0, "started": 1, "coalesced": 2}
+
+
+def test_cancelled_waiter_does_not_cancel_the_call():
+    flights = server.SingleFlight()
+    release = None
+    
+    async def work():
+        await release.wait()
+        return "answer"
+    
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        first = asyncio.create_task(flights.do("key", work))
+        second = asyncio.create_task(flights.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return first, await second
+    
+    first, result = asyncio.run(main())
+    assert first.cancelled()
+    assert result == "answer"
+    assert flights.stats()["in_flight"] == 0
+
+
+def test_error_reaches_every_waiter_and_key_is_freed():
+    flights = server.SingleFlight()
+    
+    async def fail():
+        await asyncio.sleep(0)
+        raise server.UpstreamError("boom", 503)
+    
+    async def main():
+        results = await asyncio.gather(
+            flights.do("key", fail), flights.do("key", fail), return_exceptions=True
+        )
+        retried = await flights.do("key", lambda: asyncio.sleep(0, result="ok"))
+        return results, retried
+    
+    results, retried = asyncio.run(main())
+    assert all(isinstance(r, server.UpstreamError) for r in results)
+    assert retried == "ok"
+    assert flights.started == 2
+
+
+def test_concurrent_identical_requests_reach_the_stub_once():
+    messages = [{"role": "user", "content": "single flight over http"}]
+    
+    async def test(url):
+        started = server.upstream_flights.started
+        calls = [
+            asyncio.create_task(server.request_completion(messages, "perplexity/sonar", 200, 0.2))
+            for _ in range(3)
+        ]
+        await asyncio.sleep(0.05)
+        calls[0].cancel()
+        shared = await asyncio.gather(*calls[1:])
+        later, _ = await server.request_completion(messages, "perplexity/sonar", 200, 0.2)
+        return calls[0], shared, later, server.upstream_flights.started - started
+    
+    cancelled, shared, later, started = run_with_stub(test, latency=0.2)
+    assert cancelled.cancelled()
+    assert shared[0][0]["id"] == shared[1][0]["id"]
+    assert later["id"] != shared[0][0]["id"]
+    assert started == 2
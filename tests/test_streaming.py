@@ -0,0 +1,85 @@
+import asyncio
+
+from conftest import run_with_stub
+import sonar_mcp_server as server
+
+
+def test_streamed_response_has_the_non_streaming_shape(monkeypatch):
+    monkeypatch.setattr(server, "STREAM_PROGRESS_INTERVAL", 0)
+    progress = []
+    
+    async def on_progress(tokens, message):
+        progress.append(tokens)
+    
+    async def test(url):
+        messages = [{"role": "user", "content": "stream shape"}]
+        return await server.call_openrouter_stream(messages, "perplexity/sonar", 200, 0.2, on_progress)
+    
+    response = run_with_stub(test, response_chars=400, chunk_chars=40, citations=2)
+    content, citations = server.extract_answer(response)
+    assert content.startswith("lorem ipsum") and content.endswith("[1][2]")
+    assert len(citations) == 2
+    assert response["usage"]["completion_tokens"] > 0
+    assert progress == sorted(progress) and progress[-1] > 0
+
+
+def test_failing_progress_callback_does_not_abort_the_stream(monkeypatch):
+    monkeypatch.setattr(server, "STREAM_PROGRESS_INTERVAL", 0)
+    
+    async def on_progress(tokens, message):
+        raise RuntimeError("client went away")
+    
+    async def test(url):
+        messages = [{"role": "user", "content": "broken progress"}]
+        return await server.call_openrouter_stream(messages, "perplexity/sonar", 200, 0.2, on_progress)
+    
+    response = run_with_stub(test, response_chars=200, chunk_chars=20)
+    assert server.extract_content(response).startswith("lorem ipsum")
+
+
+def test_coalesced_stream_reports_progress_only_to_waiting_callers(monkeypatch):
+    monkeypatch.setattr(server, "STREAM_PROGRESS_INTERVAL", 0)
+    messages = [{"role": "user", "content": "shared stream"}]
+    first, second = [], []
+    
+    def collector(into):
+        async def on_progress(tokens, message):
+            into.append(tokens)
+        return on_progress
+    
+    async def test(url):
+        calls = [
+            asyncio.create_task(server.request_completion(
+                messages, "perplexity/sonar", 200, 0.2, stream=True, on_progress=collector(into)
+            ))
+            for into in (first, second)
+        ]
+        while not first:
+            await asyncio.sleep(0.005)
+        calls[0].cancel()
+        await asyncio.sleep(0)
+        received = len(first)
+        response, _ = await calls[1]
+        return received, response
+    
+    received, response = run_with_stub(test, response_chars=400, chunk_chars=20, chunk_delay=0.01)
+    assert server.extract_content(response).startswith("lorem ipsum")
+    assert len(first) == received
+    assert len(second) > received
+
+
+def test_error_chunk_becomes_an_upstream_error():
+    error = server.stream_error({"code": 502, "message": "Provider disconnected"})
+    assert isinstance(error, server.UpstreamError)
+    assert error.status_code == 502
+    assert "Provider disconnected" in str(error)
+    assert server.retry_policy.is_retryable(error)
+    assert server.is_endpoint_failure(error) and server.is_model_failure(error)
+    assert server.classify_error(error) == "server_error"
+
+
+def test_error_chunk_without_a_status_code_keeps_its_message():
+    error = server.stream_error({"code": "server_error", "message": "overloaded"})
+    assert error.status_code is None
+    assert str(error) == "OpenRouter stream error: overloaded"
+    assert server.stream_error("bare string").status_code is None
@@ -0,0 +1,34 @@
+import json
+
+import pytest
+
+import sonar_mcp_server as server
+
+
+def test_unknown_exporter_disables_tracing_instead_of_failing():
+    tracing = server.Tracing("jaeger")
+    assert not tracing.enabled
+    assert "unknown exporter 'jaeger'" in tracing.stats()["error"]
+    with tracing.span("tool sonar_search"):
+        pass
+    assert tracing.http_extensions() == {}
+
+
+def test_unwritable_trace_file_disables_tracing(tmp_path):
+    pytest.importorskip("opentelemetry.sdk")
+    tracing = server.Tracing("file", file_path=str(tmp_path / "missing" / "traces.jsonl"))
+    assert not tracing.enabled
+    assert "cannot open" in tracing.stats()["error"]
+
+
+def test_file_exporter_writes_nested_spans(tmp_path):
+    pytest.importorskip("opentelemetry.sdk")
+    path = tmp_path / "traces.jsonl"
+    tracing = server.Tracing("file", file_path=str(path))
+    with tracing.span("tool sonar_search", {"sonar.tool": "sonar_search"}):
+        with tracing.span("stage cache"):
+            pass
+    tracing.flush()
+    spans = {span["name"]: span for span in map(json.loads, path.read_text().splitlines())}
+    assert spans["stage cache"]["parent_id"] == spans["tool sonar_search"]["context"]["span_id"]
+    assert spans["tool sonar_search"]["attributes"] == {"sonar.tool": "sonar_search"}
@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+import sonar_mcp_server as server
+
+
+def endpoint(name, **options):
+    options.setdefault("failure_threshold", 2)
+    options.setdefault("cooldown", 10)
+    return server.Endpoint(name, f"https://{name}.example/chat/completions", api_key="key", **options)
+
+
+def fail(endpoint, status=None, retry_after=None):
+    endpoint.begin()
+    endpoint.failed(server.UpstreamError("failed", status, retry_after))
+
+
+def succeed(endpoint):
+    endpoint.begin()
+    endpoint.succeeded(0.1)
+
+
+def sender(outcomes, calls):
+    """send(endpoint) that raises or returns outcomes[endpoint.name]."""
+    async def send(endpoint):
+        calls.append(endpoint.name)
+        outcome = outcomes[endpoint.name]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    return send
+
+
+def test_consecutive_failures_eject_until_the_cooldown_ends(clock):
+    primary = endpoint("primary")
+    fail(primary, 503)
+    assert primary.available(clock.now)
+    fail(primary, 503)
+    assert primary.state == "open" and not primary.available(clock.now)
+    clock.advance(10)
+    assert primary.available(clock.now)
+
+
+def test_success_resets_the_consecutive_failure_count(clock):
+    primary = endpoint("primary")
+    fail(primary, 503)
+    succeed(primary)
+    fail(primary, 503)
+    assert primary.state == "closed"
+
+
+def test_rate_limit_and_auth_errors_eject_immediately(clock):
+    limited, revoked = endpoint("limited"), endpoint("revoked")
+    fail(limited, 429, retry_after=42)
+    assert limited.state == "open" and limited.open_until == clock.now + 42
+    fail(revoked, 401)
+    assert revoked.state == "open" and revoked.open_until == clock.now + 10
+
+
+def test_half_open_admits_one_probe_and_a_failed_probe_doubles_the_cooldown(clock):
+    primary = endpoint("primary")
+    fail(primary, 401)
+    clock.advance(10)
+    primary.begin()
+    assert primary.state == "half_open" and not primary.available(clock.now)
+    primary.failed(server.UpstreamError("still down", 503))
+    assert primary.state == "open" and primary.open_until == clock.now + 20
+    clock.advance(20)
+    succeed(primary)
+    assert primary.state == "closed" and primary.cooldown == 10
+
+
+def test_dispatch_fails_over_on_endpoint_failures(clock):
+    router = server.UpstreamRouter([endpoint("a"), endpoint("b")], strategy="ordered")
+    calls = []
+    outcomes = {"a": server.UpstreamError("down", 502), "b": "answer"}
+    assert asyncio.run(router.dispatch(sender(outcomes, calls))) == "answer"
+    assert calls == ["a", "b"]
+    assert router.failovers == 1
+    assert router.endpoints[0].failures == 1
+
+
+def test_request_errors_are_not_failed_over(clock):
+    router = server.UpstreamRouter([endpoint("a"), endpoint("b")], strategy="ordered")
+    calls = []
+    outcomes = {"a": server.UpstreamError("bad request", 400), "b": "answer"}
+    with pytest.raises(server.UpstreamError, match="bad request"):
+        asyncio.run(router.dispatch(sender(outcomes, calls)))
+    assert calls == ["a"]
+    assert router.endpoints[0].failures == 0
+
+
+def test_last_error_is_raised_once_every_endpoint_failed(clock):
+    router = server.UpstreamRouter([endpoint("a"), endpoint("b")], strategy="ordered")
+    calls = []
+    outcomes = {"a": server.UpstreamError("a down", 503), "b": server.UpstreamError("b down", 503)}
+    with pytest.raises(server.UpstreamError, match="b down"):
+        asyncio.run(router.dispatch(sender(outcomes, calls)))
+    assert calls == ["a", "b"]
+
+
+def test_ejected_endpoints_are_skipped_and_the_soonest_is_tried_when_all_are_out(clock):
+    a, b = endpoint("a"), endpoint("b")
+    router = server.UpstreamRouter([a, b], strategy="ordered")
+    fail(a, 429, retry_after=30)
+    assert router.choose([]) is b
+    fail(b, 429, retry_after=5)
+    assert router.choose([]) is b
+    assert router.choose(["b"]) is None
+
+
+def test_least_loaded_prefers_fewer_active_requests_per_weight(clock):
+    light, heavy = endpoint("light"), endpoint("heavy", weight=3)
+    router = server.UpstreamRouter([light, heavy])
+    heavy.active = 1
+    assert router.choose([]) is heavy
+    heavy.active = 3
+    assert router.choose([]) is light
+
+
+def test_invalid_upstream_config_is_skipped(caplog):
+    config = (
+        '[{"name": "good", "url": "https://good.example/v1/chat/completions"},'
+        ' {"name": "bad-weight", "weight": "heavy"}, {"url": "ftp://nope"},'
+        ' {"name": "good"}, "not an object"]'
+    )
+    assert [e.name for e in server._configured_endpoints(config)] == ["good"]
+    assert len(caplog.records) == 4
+    assert server._configured_endpoints("{not json") == []
+    assert server._configured_endpoints('{"url": "https://x.example"}') == []